@@ -10,5 +10,11 @@ setup(name="sf_databuffer_writer",
 
       license="GPL3",
 
-      packages=['sf_databuffer_writer']
+      packages=['sf_databuffer_writer'],
+
+      entry_points={
+          'console_scripts': [
+              'sf_databuffer_replay = sf_databuffer_writer.replay:run',
+          ],
+      }
       )
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread
+from time import time
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+AUDIT_FORMATS = ("text", "jsonl")
+FSYNC_POLICIES = ("always", "interval", "never")
+
+_FLUSH = object()
+_STOP = object()
+
+
+def format_audit_entry(audit_time, write_request, audit_format="text"):
+    """
+    text: "[<audit_time>] <write_request JSON>", the format of the .err files.
+    jsonl: one JSON object per line, with the audit_time and the decoded data_api_request and parameters.
+    """
+
+    if audit_format == "jsonl":
+        return json.dumps({"audit_time": audit_time,
+                           "data_api_request": json.loads(write_request["data_api_request"]),
+                           "parameters": json.loads(write_request["parameters"]),
+                           "timestamp": write_request["timestamp"]}) + "\n"
+
+    return "[%s] %s\n" % (audit_time, json.dumps(write_request))
+
+
+class AuditTrailWriter(object):
+    """
+    Append write requests to the audit trail file from a background thread.
+
+    write only queues the request. The flusher thread writes all the queued requests at once (group commit) to the
+    file it keeps open, and fsyncs it according to fsync_policy: after every batch (always), at most every
+    fsync_interval seconds (interval) or never. The file is rotated (filename.1, filename.2, ...) when it gets bigger
+    than max_bytes or older than rotate_interval seconds (0 to disable), keeping backup_count old files.
+
+    Requests that cannot be written are kept and written again with the next batch, at least every retry_interval
+    seconds. Requests still not written when the writer is closed are logged.
+    """
+
+    def __init__(self, filename, audit_format=None, fsync_policy=None, fsync_interval=None, max_bytes=None,
+                 rotate_interval=None, backup_count=None, queue_length=None, retry_interval=None):
+
+        self.filename = filename
+        self.audit_format = audit_format if audit_format is not None else config.AUDIT_FORMAT
+        self.fsync_policy = fsync_policy if fsync_policy is not None else config.AUDIT_FSYNC_POLICY
+        self.fsync_interval = fsync_interval if fsync_interval is not None else config.AUDIT_FSYNC_INTERVAL
+        self.max_bytes = max_bytes if max_bytes is not None else config.AUDIT_MAX_BYTES
+        self.rotate_interval = rotate_interval if rotate_interval is not None else config.AUDIT_ROTATE_INTERVAL
+        self.backup_count = backup_count if backup_count is not None else config.AUDIT_BACKUP_COUNT
+        self.retry_interval = retry_interval if retry_interval is not None else config.AUDIT_RETRY_INTERVAL
+        queue_length = queue_length if queue_length is not None else config.AUDIT_QUEUE_LENGTH
+
+        if self.audit_format not in AUDIT_FORMATS:
+            raise ValueError("Invalid audit_format '%s'. Supported: %s." %
+                             (self.audit_format, ", ".join(AUDIT_FORMATS)))
+
+        if self.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("Invalid fsync_policy '%s'. Supported: %s." %
+                             (self.fsync_policy, ", ".join(FSYNC_POLICIES)))
+
+        _logger.info("Starting audit trail writer with filename=%s, audit_format=%s and fsync_policy=%s." %
+                     (self.filename, self.audit_format, self.fsync_policy))
+
+        # Requests are never dropped: when the queue is full, write blocks.
+        self.queue = Queue(maxsize=queue_length)
+
+        self._file = None
+        self._file_open_time = None
+        self._last_fsync_time = 0
+        self._is_synced = True
+        # Requests of the batches that could not be written.
+        self._unwritten_requests = []
+
+        self._flusher = Thread(target=self._write_entries, daemon=True)
+        self._flusher.start()
+
+    def write(self, write_request):
+        current_time = datetime.now().strftime(config.AUDIT_FILE_TIME_FORMAT)
+        self.queue.put((current_time, write_request))
+
+    def flush(self):
+        """
+        Wait until all the queued requests are written (and fsynced, unless the fsync_policy is never), or kept to
+        be written again if the file cannot be written.
+        """
+
+        self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+
+        self.queue.put(_STOP)
+        self._flusher.join()
+
+    def _get_entries(self):
+
+        timeout = None
+
+        # With the interval policy, written requests are fsynced at most fsync_interval seconds later.
+        if self.fsync_policy == "interval" and not self._is_synced:
+            timeout = self.fsync_interval
+
+        if self._unwritten_requests:
+            timeout = min(timeout, self.retry_interval) if timeout is not None else self.retry_interval
+
+        try:
+            entries = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+
+        # Group commit: write everything that was queued in the meantime.
+        while True:
+            try:
+                entries.append(self.queue.get_nowait())
+            except Empty:
+                return entries
+
+    def _write_entries(self):
+
+        while True:
+            entries = self._get_entries()
+
+            requests = self._unwritten_requests + \
+                [entry for entry in entries if entry is not _FLUSH and entry is not _STOP]
+            self._unwritten_requests = []
+
+            try:
+                if requests:
+                    self._write_requests(requests)
+
+            except Exception as e:
+                _logger.error("Error while trying to append %s requests to audit trail file %s. Retrying in %s "
+                              "seconds: %s" % (len(requests), self.filename, self.retry_interval, e))
+
+                self._close_file()
+                self._unwritten_requests = requests
+
+            try:
+                if self._is_fsync_due(entries):
+                    self._fsync()
+
+            except Exception as e:
+                _logger.error("Error while trying to fsync audit trail file %s: %s" % (self.filename, e))
+                self._close_file()
+
+            for _ in entries:
+                self.queue.task_done()
+
+            if _STOP in entries:
+                for current_time, write_request in self._unwritten_requests:
+                    _logger.error("Request not written to audit trail file %s: %s" %
+                                  (self.filename, format_audit_entry(current_time, write_request).strip()))
+
+                self._close_file()
+                return
+
+    def _is_fsync_due(self, entries):
+
+        if self.fsync_policy == "never":
+            return False
+
+        if self.fsync_policy == "always" or not entries or _FLUSH in entries or _STOP in entries:
+            return True
+
+        return time() - self._last_fsync_time >= self.fsync_interval
+
+    def _write_requests(self, requests):
+        self._rotate_if_needed()
+
+        if self._file is None:
+            self._file = open(self.filename, mode="a")
+            self._file_open_time = time()
+
+        self._file.write("".join(format_audit_entry(current_time, write_request, self.audit_format)
+                                 for current_time, write_request in requests))
+        self._file.flush()
+        self._is_synced = False
+
+    def _fsync(self):
+        if self._file is not None and not self._is_synced:
+            os.fsync(self._file.fileno())
+
+        self._last_fsync_time = time()
+        self._is_synced = True
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+
+            self._file = None
+            self._is_synced = True
+
+    def _rotate_if_needed(self):
+
+        if self._file is not None:
+            is_too_old = self.rotate_interval and time() - self._file_open_time >= self.rotate_interval
+            is_too_big = self.max_bytes and self._file.tell() >= self.max_bytes
+
+            if not is_too_old and not is_too_big:
+                return
+
+        # A file left over from a previous run.
+        elif not self.max_bytes or not os.path.exists(self.filename) or \
+                os.path.getsize(self.filename) < self.max_bytes:
+            return
+
+        if self.fsync_policy != "never":
+            self._fsync()
+
+        self._close_file()
+
+        _logger.info("Rotating audit trail file %s." % self.filename)
+
+        for index in range(self.backup_count - 1, 0, -1):
+            backup_filename = "%s.%d" % (self.filename, index)
+
+            if os.path.exists(backup_filename):
+                os.replace(backup_filename, "%s.%d" % (self.filename, index + 1))
+
+        if self.backup_count > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
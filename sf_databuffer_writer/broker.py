@@ -1,17 +1,33 @@
 import argparse
 import logging
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import bottle
 from bsread import PUSH
 
 from sf_databuffer_writer import config
 from sf_databuffer_writer.broker_manager import BrokerManager, StreamRequestSender
-from sf_databuffer_writer.rest_api import register_rest_interface
+from sf_databuffer_writer.rest_api import register_rest_interface, REST_SERVERS
 
 _logger = logging.getLogger(__name__)
 
 
-def start_server(channels_file, output_port, queue_length, rest_port, audit_trail_only=False, epics_writer_url=None):
+def _exit_on_sigterm(signum, frame):
+    _logger.info("Received SIGTERM, stopping broker.")
+    sys.exit(0)
+
+
+def start_server(channels_file, output_port, queue_length, rest_port, audit_trail_only=False, epics_writer_url=None,
+                 rest_server=None):
+
+    if rest_server is None:
+        rest_server = config.DEFAULT_BROKER_REST_SERVER
+
+    if rest_server not in REST_SERVERS:
+        raise ValueError("Unknown rest_server '%s'. Supported: %s." % (rest_server, ", ".join(REST_SERVERS)))
+
     _logger.info("Writing data for channels from file: %s", channels_file)
     _logger.debug("Setting queue length to %s.", queue_length)
 
@@ -27,16 +43,27 @@ def start_server(channels_file, output_port, queue_length, rest_port, audit_trai
                             channels_file=channels_file,
                             audit_trail_only=audit_trail_only)
 
-    register_rest_interface(app, manager)
+    # With the threaded server, the filesystem heavy retrieve requests run in a separate, smaller, pool of threads.
+    retrieve_executor = None
+    if rest_server == "threaded":
+        retrieve_executor = ThreadPoolExecutor(max_workers=config.BROKER_RETRIEVE_N_WORKERS)
+
+    register_rest_interface(app, manager, retrieve_executor=retrieve_executor)
 
     _logger.info("Broker started.")
 
+    # Stop on SIGTERM (systemd) like on Ctrl+C, so the pending audit trail entries and scan_info files are written.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
     try:
-        _logger.info("Starting rest API on port %s." % rest_port)
+        _logger.info("Starting rest API on port %s with rest_server=%s." % (rest_port, rest_server))
         #bottle.run(app=app, host="127.0.0.1", port=rest_port)
-        bottle.run(app=app, host="sf-daq-1", port=rest_port)
+        bottle.run(app=app, host="sf-daq-1", port=rest_port, server=REST_SERVERS[rest_server])
     finally:
-        pass
+        if retrieve_executor is not None:
+            retrieve_executor.shutdown(wait=False)
+
+        manager.close()
 
 
 def run():
@@ -50,6 +77,8 @@ def run():
                         help="Length of the zmq queue.")
 
     parser.add_argument("--rest_port", type=int, help="Port for REST api.", default=config.DEFAULT_BROKER_REST_PORT)
+    parser.add_argument("--rest_server", default=config.DEFAULT_BROKER_REST_SERVER, choices=list(REST_SERVERS),
+                        help="REST api server: wsgiref (single threaded) or threaded (one thread per request).")
 
     parser.add_argument("--log_level", default=config.DEFAULT_LOG_LEVEL,
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
@@ -71,7 +100,8 @@ def run():
                  queue_length=arguments.queue_length,
                  rest_port=arguments.rest_port,
                  audit_trail_only=arguments.audit_trail_only,
-                 epics_writer_url=arguments.epics_writer_url
+                 epics_writer_url=arguments.epics_writer_url,
+                 rest_server=arguments.rest_server
                  )
 
 
@@ -1,18 +1,21 @@
 from datetime import datetime
-from threading import Thread
+from threading import RLock
 
 import logging
 import json
 
-import requests
 from bsread.sender import Sender
 
 from sf_databuffer_writer import config
+from sf_databuffer_writer.audit import AuditTrailWriter
+from sf_databuffer_writer.jobs import DetectorRetrievalJobManager
+from sf_databuffer_writer.notifier import EpicsWriterNotifier
+from sf_databuffer_writer.run_numbers import RunNumberAllocator
+from sf_databuffer_writer.scan_info import ScanInfoStore
 from sf_databuffer_writer.utils import get_writer_request, get_separate_writer_requests
 from sf_databuffer_writer.utils import verify_channels
 
 import os
-from subprocess import Popen
 
 _logger = logging.getLogger(__name__)
 
@@ -57,6 +60,7 @@ class BrokerManager(object):
             audit_filename = config.DEFAULT_AUDIT_FILENAME
         self.audit_filename = audit_filename
         _logger.info("Writing requests audit log to file %s." % self.audit_filename)
+        self.audit_trail = AuditTrailWriter(self.audit_filename)
 
         self.channels_file = channels_file
 
@@ -77,91 +81,107 @@ class BrokerManager(object):
         self.audit_trail_only = audit_trail_only
         _logger.info("Starting broker manager with audit_trail_only=%s." % self.audit_trail_only)
 
+        self.detector_jobs = DetectorRetrievalJobManager()
+
+        self.run_numbers = RunNumberAllocator()
+        self.scan_info = ScanInfoStore()
+
+        # The REST interface can call the manager from multiple threads (threaded rest server).
+        self._lock = RLock()
+
     def set_parameters(self, parameters):
 
-        _logger.debug("Setting parameters %s." % parameters)
+        with self._lock:
+            _logger.debug("Setting parameters %s." % parameters)
 
-        if not all(x in parameters for x in self.REQUIRED_PARAMETERS):
-            raise ValueError("Missing mandatory parameters. Mandatory parameters '%s' but received '%s'." %
-                             (self.REQUIRED_PARAMETERS, list(parameters.keys())))
+            if not all(x in parameters for x in self.REQUIRED_PARAMETERS):
+                raise ValueError("Missing mandatory parameters. Mandatory parameters '%s' but received '%s'." %
+                                 (self.REQUIRED_PARAMETERS, list(parameters.keys())))
 
-        self.current_parameters = parameters
+            self.current_parameters = parameters
 
     def get_parameters(self):
-        return self.current_parameters
+        with self._lock:
+            return self.current_parameters
 
     def get_status(self):
 
-        if self.current_start_pulse_id is not None and self.current_parameters is not None:
-            return "receiving"
+        with self._lock:
+            if self.current_start_pulse_id is not None and self.current_parameters is not None:
+                return "receiving"
 
-        if self.current_parameters is not None:
-            return "configured"
+            if self.current_parameters is not None:
+                return "configured"
 
-        return "stopped"
+            return "stopped"
 
     def stop(self):
-        _logger.info("Stopping bsread broker session.")
+        with self._lock:
+            _logger.info("Stopping bsread broker session.")
 
-        self.current_parameters = None
-        self.current_start_pulse_id = None
+            self.current_parameters = None
+            self.current_start_pulse_id = None
 
     def start_writer(self, start_pulse_id):
 
-        if self.current_start_pulse_id is not None:
+        with self._lock:
+            if self.current_start_pulse_id is not None:
 
-            # You can post the same start pulse id multiple times.
-            if self.current_start_pulse_id == start_pulse_id:
-                return
+                # You can post the same start pulse id multiple times.
+                if self.current_start_pulse_id == start_pulse_id:
+                    return
 
-            _logger.warning("Previous acquisition was still running. The previous run will not be processed.")
+                _logger.warning("Previous acquisition was still running. The previous run will not be processed.")
 
-            _logger.warning({"current_parameters": self.current_parameters,
-                             "current_start_pulse_id": self.current_start_pulse_id,
-                             "new_start_pulse_id": start_pulse_id})
+                _logger.warning({"current_parameters": self.current_parameters,
+                                 "current_start_pulse_id": self.current_start_pulse_id,
+                                 "new_start_pulse_id": start_pulse_id})
 
-        _logger.info("Set start_pulse_id %d." % start_pulse_id)
-        self.current_start_pulse_id = start_pulse_id
+            _logger.info("Set start_pulse_id %d." % start_pulse_id)
+            self.current_start_pulse_id = start_pulse_id
 
     def _process_write_request(self, request, sendto_epics_writer=True):
-        audit_write_request(self.audit_filename, request)
+        with self._lock:
+            self.audit_trail.write(request)
 
-        if not self.audit_trail_only:
-            self.request_sender.send(request, sendto_epics_writer)
-        else:
-            _logger.warning("Writing request to audit trail only (broker running with --audit_trail_only).")
+            if not self.audit_trail_only:
+                self.request_sender.send(request, sendto_epics_writer)
+            else:
+                _logger.warning("Writing request to audit trail only (broker running with --audit_trail_only).")
 
     def stop_writer(self, stop_pulse_id):
 
-        if self.current_start_pulse_id is None:
-            # We allow multiple stop requests with the same pulse id.
-            if self.last_stop_pulse_id == stop_pulse_id:
-                return
-
-            _logger.warning("No acquisition started. Ignoring stop_pulse_id %s request." % stop_pulse_id)
-            return
+        with self._lock:
+            if self.current_start_pulse_id is None:
+                # We allow multiple stop requests with the same pulse id.
+                if self.last_stop_pulse_id == stop_pulse_id:
+                    return
 
-        _logger.info("Set stop_pulse_id=%d" % stop_pulse_id)
-
-        if config.SEPARATE_CAMERA_CHANNELS:
-            first_iteration = True
-            for write_request in get_separate_writer_requests(self.channels, self.current_parameters,
-                                                              self.current_start_pulse_id, stop_pulse_id):
-                # We send to the epics writer only in the first iteration - bsread channels (because of the filename).
-                self._process_write_request(write_request, sendto_epics_writer=first_iteration)
-                first_iteration = False
-        else:
-            write_request = get_writer_request(self.channels, self.current_parameters,
-                                               self.current_start_pulse_id, stop_pulse_id)
-            self._process_write_request(write_request)
-
-        self.current_start_pulse_id = None
-        self.current_parameters = None
-        self.last_stop_pulse_id = stop_pulse_id
+                _logger.warning("No acquisition started. Ignoring stop_pulse_id %s request." % stop_pulse_id)
+                return
 
-        self.statistics["last_sent_write_request"] = write_request
-        self.statistics["last_sent_write_request_time"] = datetime.now().strftime(config.AUDIT_FILE_TIME_FORMAT)
-        self.statistics["n_processed_requests"] += 1
+            _logger.info("Set stop_pulse_id=%d" % stop_pulse_id)
+
+            if config.SEPARATE_CAMERA_CHANNELS:
+                first_iteration = True
+                for write_request in get_separate_writer_requests(self.channels, self.current_parameters,
+                                                                  self.current_start_pulse_id, stop_pulse_id):
+                    # We send to the epics writer only in the first iteration - bsread channels
+                    # (because of the filename).
+                    self._process_write_request(write_request, sendto_epics_writer=first_iteration)
+                    first_iteration = False
+            else:
+                write_request = get_writer_request(self.channels, self.current_parameters,
+                                                   self.current_start_pulse_id, stop_pulse_id)
+                self._process_write_request(write_request)
+
+            self.current_start_pulse_id = None
+            self.current_parameters = None
+            self.last_stop_pulse_id = stop_pulse_id
+
+            self.statistics["last_sent_write_request"] = write_request
+            self.statistics["last_sent_write_request_time"] = datetime.now().strftime(config.AUDIT_FILE_TIME_FORMAT)
+            self.statistics["n_processed_requests"] += 1
 
     def retrieve(self, request=None, remote_ip=None, beamline_force=None):
 
@@ -231,7 +251,7 @@ class BrokerManager(object):
         daq_directory = f'{path_to_pgroup}{DIR_NAME_RUN_INFO}'
         if not os.path.exists(daq_directory):
             try:
-                os.mkdir(daq_directory)
+                os.makedirs(daq_directory, exist_ok=True)
             except:
                 return {"status" : "failed", "message" : "no permission or possibility to make run_info directory in pgroup space"}
 
@@ -252,21 +272,7 @@ class BrokerManager(object):
             request["channels_list"] = list(set(request["channels_list"]))
             request["channels_list"].sort()
  
-        last_run_file = daq_directory + "/LAST_RUN"
-        if not os.path.exists(last_run_file):
-            run_file = open(last_run_file, "w")
-            run_file.write("0")
-            run_file.close()
-
-        run_file = open(last_run_file, "r")
-        last_run = int(run_file.read())
-        run_file.close()
-
-        current_run = last_run + 1
-
-        run_file = open(last_run_file, "w")
-        run_file.write(str(current_run))
-        run_file.close()
+        current_run = self.run_numbers.allocate(daq_directory)
 
         request["beamline"]     = beamline
         request["run_number"]   = current_run
@@ -275,8 +281,9 @@ class BrokerManager(object):
         current_run_thousand = current_run//1000*1000
         run_info_directory = f'{daq_directory}/{current_run_thousand:06}' 
         if not os.path.exists(run_info_directory):
-            # shouldn't fail here, since before was successful in creation of daq_directory
-            os.mkdir(run_info_directory)
+            # shouldn't fail here, since before was successful in creation of daq_directory. Concurrent
+            # retrieve calls can create it at the same time.
+            os.makedirs(run_info_directory, exist_ok=True)
  
         run_file_json = f'{run_info_directory}/run_{current_run:06}.json'
 
@@ -284,6 +291,7 @@ class BrokerManager(object):
             json.dump(request, request_json_file, indent=2)
 
         output_files_list = []
+        epics_error = None
 
         current_parameters = {
                      "general/user": str(pgroup[1:6]),
@@ -294,30 +302,29 @@ class BrokerManager(object):
 
         if not os.path.exists(full_path):
             try:
-                os.makedirs(full_path)
+                os.makedirs(full_path, exist_ok=True)
             except:
                 return {"status" : "failed", "message" : f'no permission or possibility to make directory in pgroup space {full_path}'}
 
         if "pv_list" in request:
             write_request = get_writer_request(request["pv_list"], current_parameters,
-                                               adjuster_start_pulse_id, adjusted_stop_pulse_id)
+                                               adjusted_start_pulse_id, adjusted_stop_pulse_id)
             output_file_epics = f'{full_path}/run_{current_run:06}.PVCHANNELS.h5'
             output_files_list.append(output_file_epics)
-            def send_epics_request():
-                try:
-
-                    epics_writer_request = {
-                                "range": json.loads(write_request["data_api_request"])["range"],
-                                "parameters": json.loads(write_request["parameters"]),
-                                "channels" : request["pv_list"],
-                                "retrieval_url" : "https://data-api.psi.ch/sf"
-                            }
-                    epics_writer_request["parameters"]["output_file"] = output_file_epics
-                    requests.put(url=self.request_sender.epics_writer_url, json=epics_writer_request)
-                except Exception as e:
-                    _logger.error("Error while trying to forward the write request to the epics writer.", e)
-
-            Thread(target=send_epics_request).start()
+            epics_writer_request = {
+                        "range": json.loads(write_request["data_api_request"])["range"],
+                        "parameters": json.loads(write_request["parameters"]),
+                        "channels" : request["pv_list"],
+                        "retrieval_url" : "https://data-api.psi.ch/sf"
+                    }
+            epics_writer_request["parameters"]["output_file"] = output_file_epics
+
+            epics_notifier = getattr(self.request_sender, "epics_notifier", None)
+            if epics_notifier is not None:
+                if not epics_notifier.notify(epics_writer_request):
+                    epics_error = f'epics writer queue is full, pv_list of run {current_run} not requested'
+            else:
+                _logger.error("No epics writer url configured. Cannot request pv_list %s." % request["pv_list"])
 
         if "channels_list" in request:
             output_file_bsread = f'{full_path}/run_{current_run:06}.BSREAD.h5'
@@ -360,11 +367,9 @@ class BrokerManager(object):
                         det_stop_pulse_id = p
                         if det_start_pulse_id == 0:
                             det_start_pulse_id = p
-                retrieve_command=f'/home/dbe/git/sf_daq_buffer/scripts/retrieve_detector_data.sh {detector} {det_start_pulse_id} {det_stop_pulse_id} {output_file_detector} {rate_multiplicator} {det_export} {run_file_json} {raw_file_name}'
-                process_log_file=open(f'{run_info_directory}/run_{current_run:06}.{detector}.log','w')
-                _logger.info("Starting detector retrieve command %s " % retrieve_command)
-                process=Popen(retrieve_command, shell=True, stdout=process_log_file, stderr=process_log_file)
-                process_log_file.close()
+                retrieve_command=f'{config.DETECTOR_RETRIEVE_COMMAND} {detector} {det_start_pulse_id} {det_stop_pulse_id} {output_file_detector} {rate_multiplicator} {det_export} {run_file_json} {raw_file_name}'
+                process_log_filename = f'{run_info_directory}/run_{current_run:06}.{detector}.log'
+                self.detector_jobs.submit(detector, retrieve_command, process_log_filename)
 
         if "scan_info" in request:
             request_scan_info = request["scan_info"]
@@ -372,28 +377,50 @@ class BrokerManager(object):
                 scan_name = request_scan_info["scan_name"]
                 scan_dir = path_to_pgroup+"/scan_info"
                 if not os.path.exists(scan_dir):
-                    os.makedirs(scan_dir)
+                    os.makedirs(scan_dir, exist_ok=True)
                 scan_info_file = scan_dir+"/"+scan_name+".json"
-                if not os.path.exists(scan_info_file):
-                    scan_info = {"scan_files" : [], "scan_parameters" : {"Id" : request_scan_info.get("motors_pv_name"), "name": request_scan_info.get("motors_name"), "offset": request_scan_info.get("motors_offset"), "conversion_factor": request_scan_info.get("motors_coefficient")}, "scan_readbacks": [], "scan_step_info": [], "scan_values": [], "scan_readbacks_raw": [], "pulseIds": []} 
-                else:
-                    with open(scan_info_file) as json_file:
-                        scan_info = json.load(json_file)
-                scan_info["scan_readbacks"].append(request_scan_info.get("motors_readback_value",[]))
-                scan_info["scan_values"].append(request_scan_info.get("motors_value",[]))
-                scan_info["scan_step_info"].append(request_scan_info.get("step_info"))
-                scan_info["scan_readbacks_raw"].append(request_scan_info.get("motors_readback_raw",[]))
-
-                scan_info["scan_files"].append(output_files_list)
-                scan_info["pulseIds"].append([start_pulse_id, stop_pulse_id])
-
-                with open(scan_info_file, 'w') as json_file:
-                    json.dump(scan_info, json_file, indent=4)
+                self.scan_info.add_step(scan_info_file, request_scan_info, output_files_list,
+                                        [start_pulse_id, stop_pulse_id])
+
+        if epics_error is not None:
+            return {"status" : "failed", "message" : epics_error}
 
         return {"status" : "ok", "message" : str(current_run) }
 
     def get_statistics(self):
-        return self.statistics
+        with self._lock:
+            statistics = dict(self.statistics)
+
+        epics_notifier = getattr(self.request_sender, "epics_notifier", None)
+        if epics_notifier is not None:
+            statistics["epics_writer"] = epics_notifier.get_statistics()
+
+        statistics["detector_jobs"] = self.detector_jobs.get_statistics()
+
+        return statistics
+
+    def get_detector_jobs(self, state=None):
+        return self.detector_jobs.get_jobs(state)
+
+    def close(self):
+        """
+        Write the pending scan_info files, epics writer notifications, queued detector retrieval jobs and audit trail
+        entries. Call it when the broker stops.
+        """
+
+        _logger.info("Closing broker manager.")
+
+        try:
+            self.scan_info.flush()
+
+            epics_notifier = getattr(self.request_sender, "epics_notifier", None)
+            if epics_notifier is not None:
+                epics_notifier.stop()
+
+            self.detector_jobs.close()
+
+        finally:
+            self.audit_trail.close()
 
 
 class StreamRequestSender(object):
@@ -415,25 +442,21 @@ class StreamRequestSender(object):
 
         self.output_stream.open()
 
+        self.epics_notifier = EpicsWriterNotifier(self.epics_writer_url) if self.epics_writer_url else None
+
     def send(self, write_request, sendto_epics_writer=True):
 
         _logger.info("Sending write write_request: %s" % write_request)
         self.output_stream.send(data=write_request)
 
-        if self.epics_writer_url and sendto_epics_writer:
-
-            def send_epics_request():
-                try:
-                    epics_writer_request = {
-                        "range": json.loads(write_request["data_api_request"])["range"],
-                        "parameters": json.loads(write_request["parameters"])
-                    }
-
-                    _logger.info("Sending epics writer request %s" % epics_writer_request)
-
-                    requests.put(url=self.epics_writer_url, json=epics_writer_request)
+        if self.epics_notifier is not None and sendto_epics_writer:
+            try:
+                epics_writer_request = {
+                    "range": json.loads(write_request["data_api_request"])["range"],
+                    "parameters": json.loads(write_request["parameters"])
+                }
 
-                except Exception as e:
-                    _logger.error("Error while trying to forward the write request to the epics writer.", e)
+                self.epics_notifier.notify(epics_writer_request)
 
-            Thread(target=send_epics_request).start()
+            except Exception as e:
+                _logger.error("Error while trying to forward the write request to the epics writer: %s" % e)
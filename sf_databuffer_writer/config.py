@@ -1,6 +1,10 @@
 DEFAULT_STREAM_OUTPUT_PORT = 12500
 DEFAULT_QUEUE_LENGTH = 100
 DEFAULT_BROKER_REST_PORT = 10002
+# wsgiref (single threaded) or threaded (one thread per request, /retrieve_from_buffers limited to
+# BROKER_RETRIEVE_N_WORKERS at the same time).
+DEFAULT_BROKER_REST_SERVER = "wsgiref"
+BROKER_RETRIEVE_N_WORKERS = 2
 DEFAULT_EPICS_WRITER_URL = "http://localhost:10200/notify"
 DEFAULT_LOG_LEVEL = "INFO"
 
@@ -8,15 +12,119 @@ DEFAULT_SEND_TIMEOUT = 1000
 DEFAULT_RECEIVE_TIMEOUT = 1000
 DEFAULT_DATA_RETRIEVAL_DELAY = 0
 
+DEFAULT_N_WORKERS = 1
+DEFAULT_WORKER_TYPE = "thread"
+DEFAULT_MAX_PENDING_REQUESTS = 100
+# Retrieved requests waiting to be written. 0 retrieves and writes each request in the same worker.
+DEFAULT_PIPELINE_QUEUE_LENGTH = 0
+# Journal of the accepted requests, replayed when the writer restarts (None to disable).
+DEFAULT_WRITER_JOURNAL_FILE = None
+WRITER_JOURNAL_FSYNC_INTERVAL = 0.1
+# Number of done requests after which the journal is rewritten with only the unfinished requests.
+WRITER_JOURNAL_COMPACT_THRESHOLD = 1000
+# Number of times a request is started before it is not replayed anymore (and written to its .err file).
+WRITER_JOURNAL_MAX_ATTEMPTS = 3
+
 AUDIT_FILE_TIME_FORMAT = "%Y%m%d-%H%M%S"
 
 DEFAULT_AUDIT_FILENAME = "/var/log/sf_databuffer_audit.log"
+# The audit trail is appended by a background thread, in batches, in text ([time] request JSON) or jsonl format.
+# fsync policy: always (after every batch), interval (at most every AUDIT_FSYNC_INTERVAL seconds) or never.
+AUDIT_FORMAT = "text"
+AUDIT_FSYNC_POLICY = "interval"
+AUDIT_FSYNC_INTERVAL = 1
+# Rotate the audit trail (filename.1, filename.2, ...) by size in bytes and/or age in seconds (0 to disable).
+AUDIT_MAX_BYTES = 0
+AUDIT_ROTATE_INTERVAL = 0
+AUDIT_BACKUP_COUNT = 10
+# Requests waiting to be written to the audit trail. The broker blocks when the queue is full.
+AUDIT_QUEUE_LENGTH = 10000
+# Seconds between attempts to write requests that could not be appended to the audit trail.
+AUDIT_RETRY_INTERVAL = 1
 
 DATA_API_QUERY_ADDRESS = "http://sf-data-api-02.psi.ch/query"
 IMAGE_API_QUERY_ADDRESS = "http://172.27.0.14:8080/api/v1/query"
 DATA_BACKEND = "sf-databuffer"
 IMAGE_BACKEND = "sf-imagebuffer"
 
+# Shared keep-alive connection pool for all outbound HTTP calls (data api, mapping, epics writer).
+# HTTP_POOL_SIZE should not be smaller than DATA_API_QUERY_N_WORKERS.
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 600
+
+# Notifications to the epics writer are sent from a fixed pool of threads with a bounded queue.
+EPICS_WRITER_N_WORKERS = 2
+EPICS_WRITER_QUEUE_LENGTH = 100
+# Seconds to wait for a free slot in the full queue, before the notification is rejected.
+EPICS_WRITER_QUEUE_TIMEOUT = 10
+EPICS_WRITER_TIMEOUT = 10
+EPICS_WRITER_RETRIES = 3
+EPICS_WRITER_RETRY_BACKOFF = 1
+
+DETECTOR_RETRIEVE_COMMAND = "/home/dbe/git/sf_daq_buffer/scripts/retrieve_detector_data.sh"
+DETECTOR_RETRIEVAL_MAX_CONCURRENCY = 4
+DETECTOR_RETRIEVAL_MAX_CONCURRENCY_PER_DETECTOR = 1
+# Number of finished detector retrieval jobs to keep for the /detector_jobs endpoint.
+DETECTOR_RETRIEVAL_JOBS_HISTORY = 1000
+# Queued detector retrieval jobs, reloaded when the broker restarts (None to keep them only in memory).
+DETECTOR_RETRIEVAL_PENDING_JOBS_FILE = "/var/log/sf_databuffer_detector_jobs.json"
+
+# Run numbers reserved at once from run_info/LAST_RUN (and then handed out from memory).
+RUN_NUMBER_BATCH_SIZE = 1
+# The scan_info/<scan_name>.json files are written at most every SCAN_INFO_MATERIALIZE_DELAY seconds (0 at every
+# step). The steps are appended immediately to scan_info/<scan_name>.jsonl.
+SCAN_INFO_MATERIALIZE_DELAY = 1
+SCAN_INFO_CACHE_SIZE = 100
+# Seconds before retrying to write a scan_info file that could not be written.
+SCAN_INFO_RETRY_INTERVAL = 1
+
+# Cache of the pulse_id to timestamp mappings (size 0 to disable). With an interpolation max distance (in pulses),
+# ranges that are not cached are computed from cached pulse_ids at most that far away, at 100Hz.
+PULSE_ID_MAPPING_CACHE_SIZE = 1000
+PULSE_ID_MAPPING_CACHE_TTL = 300
+PULSE_ID_MAPPING_INTERPOLATION_MAX_DISTANCE = 0
+
+# Split data api queries by pulse_id range and/or channels (None to disable). Split queries run in parallel.
+DATA_API_QUERY_PULSE_ID_WINDOW = None
+DATA_API_QUERY_CHANNELS_LIMIT = None
+DATA_API_QUERY_N_WORKERS = 4
+
+# Decode the data api response while it is downloaded and write it to disk channel by channel.
+# Streamed queries are not split.
+DATA_API_STREAM_RESPONSE = False
+DATA_API_STREAM_CHUNK_SIZE = 1024 * 1024
+# Events received before the configs of their channel are kept undecoded, in memory up to this size and in a
+# temporary file above it, until the configs arrive.
+DATA_API_STREAM_SPOOL_SIZE = 64 * 1024 * 1024
+# Can be overwritten per request with the "data_api_response_format" (json or binary) and
+# "data_api_response_compression" (none, gzip or lz4) parameters.
+DEFAULT_DATA_API_RESPONSE_FORMAT = "json"
+DEFAULT_DATA_API_RESPONSE_COMPRESSION = "none"
+
+# Retrieve sf-imagebuffer channels from the data api (instead of data_api3) in pulse_id windows, appending the frames
+# to the output file as they arrive.
+IMAGE_RETRIEVAL_NATIVE = False
+IMAGE_DATA_API_QUERY_ADDRESS = DATA_API_QUERY_ADDRESS
+IMAGE_QUERY_PULSE_ID_WINDOW = 100
+
+# Can be overwritten per request with the "output_compression" parameter (gzip, lzf or bitshuffle).
+DEFAULT_OUTPUT_COMPRESSION = None
+DEFAULT_OUTPUT_COMPRESSION_LEVEL = 4
+# Target size of a chunk when "output_chunking" is "auto". Chunks always span the pulse_id axis.
+OUTPUT_CHUNK_SIZE_BYTES = 1024 * 1024
+# Can be overwritten per request with the "output_global_date_format" parameter:
+# string (variable length strings), fixed (fixed width bytes) or int64 (nanoseconds since epoch, UTC).
+DEFAULT_OUTPUT_GLOBAL_DATE_FORMAT = "string"
+# Can be overwritten per request with the "output_layout" parameter. Only used by the dense file format:
+# dense (zero filled arrays built in memory) or sparse (chunked datasets where only the chunks with data are written).
+DEFAULT_OUTPUT_LAYOUT = "dense"
+# Can be overwritten per request with the "output_conversion_processes" parameter. Only used by the compact file
+# format: with more than 1 process, the channels are converted to numpy arrays in parallel worker processes.
+DEFAULT_OUTPUT_CONVERSION_PROCESSES = 1
+
 BROKER_CHANNELS_LIMIT = 100
 BROKER_CHANNELS_LIMIT_PICTURE = 2
 
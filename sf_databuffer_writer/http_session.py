@@ -0,0 +1,95 @@
+import logging
+import os
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_session_lock = Lock()
+
+
+def create_session(pool_size=None, retries=None, retry_backoff=None):
+    """
+    Create a session with a keep-alive connection pool of pool_size connections per host.
+
+    Failed connections and 502/503/504 responses are retried with exponential backoff. Requests that already
+    reached the server and timed out while reading are not retried.
+    """
+
+    if pool_size is None:
+        pool_size = config.HTTP_POOL_SIZE
+
+    if retries is None:
+        retries = config.HTTP_RETRIES
+
+    if retry_backoff is None:
+        retry_backoff = config.HTTP_RETRY_BACKOFF
+
+    retry_parameters = {"total": retries,
+                        "connect": retries,
+                        "read": 0,
+                        "status": retries,
+                        "backoff_factor": retry_backoff,
+                        "status_forcelist": (502, 503, 504),
+                        "raise_on_status": False}
+
+    # All our calls are queries or idempotent notifications, so POST and PUT can be retried as well.
+    try:
+        retry = Retry(allowed_methods=None, **retry_parameters)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=False, **retry_parameters)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def get_session():
+    """
+    Return the session shared by all the outbound calls of this process.
+    Forked processes get their own session, because connections cannot be shared between processes.
+    """
+
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _logger.info("Creating HTTP session with pool_size=%s, retries=%s and timeout=%s." %
+                         (config.HTTP_POOL_SIZE, config.HTTP_RETRIES, get_default_timeout()))
+
+            _session = create_session()
+            _session_pid = os.getpid()
+
+        return _session
+
+
+def get_default_timeout():
+    return config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT
+
+
+def post(url, timeout=None, **kwargs):
+
+    if timeout is None:
+        timeout = get_default_timeout()
+
+    return get_session().post(url=url, timeout=timeout, **kwargs)
+
+
+def put(url, timeout=None, **kwargs):
+
+    if timeout is None:
+        timeout = get_default_timeout()
+
+    return get_session().put(url=url, timeout=timeout, **kwargs)
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+from collections import OrderedDict, Counter
+from datetime import datetime
+from itertools import count
+from subprocess import Popen
+from threading import Condition, Thread
+from time import time
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+
+class DetectorRetrievalJobManager(object):
+    """
+    Run detector retrieval commands with a limited concurrency, globally and per detector.
+
+    Jobs are started in submission order as soon as both limits allow it. Each started process is reaped by its own
+    thread, which records the exit code and runtime of the job. Finished jobs are kept in a bounded history.
+
+    The queued jobs are saved to pending_jobs_file whenever they change, and queued again when the manager is
+    created, so that they are not lost when the broker restarts.
+    """
+
+    def __init__(self, max_concurrency=None, max_concurrency_per_detector=None, history_length=None,
+                 pending_jobs_file=None):
+
+        if max_concurrency is None:
+            max_concurrency = config.DETECTOR_RETRIEVAL_MAX_CONCURRENCY
+
+        if max_concurrency_per_detector is None:
+            max_concurrency_per_detector = config.DETECTOR_RETRIEVAL_MAX_CONCURRENCY_PER_DETECTOR
+
+        if history_length is None:
+            history_length = config.DETECTOR_RETRIEVAL_JOBS_HISTORY
+
+        if pending_jobs_file is None:
+            pending_jobs_file = config.DETECTOR_RETRIEVAL_PENDING_JOBS_FILE
+
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_detector = max_concurrency_per_detector
+        self.history_length = history_length
+        self.pending_jobs_file = pending_jobs_file
+
+        _logger.info("Starting detector retrieval job manager with max_concurrency=%s, "
+                     "max_concurrency_per_detector=%s and pending_jobs_file=%s." %
+                     (self.max_concurrency, self.max_concurrency_per_detector, self.pending_jobs_file))
+
+        self._condition = Condition()
+        self._job_ids = count(1)
+        self._jobs = OrderedDict()
+        self._n_running = 0
+        self._n_running_per_detector = Counter()
+        self._running = True
+
+        self._load_pending_jobs()
+
+        self._dispatcher = Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, detector, command, log_filename):
+        """
+        Queue the command for execution. Its stdout and stderr are written to log_filename. Returns the job_id.
+        """
+
+        with self._condition:
+            job_id = self._queue_job(detector, command, log_filename, str(datetime.now()))
+            self._save_pending_jobs()
+
+            self._condition.notify_all()
+
+        return job_id
+
+    def get_job(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_jobs(self, state=None):
+        with self._condition:
+            return [dict(job) for job in self._jobs.values() if state is None or job["state"] == state]
+
+    def get_statistics(self):
+        with self._condition:
+            return dict(Counter(job["state"] for job in self._jobs.values()))
+
+    def close(self):
+        """
+        Stop starting queued jobs, and save them to be started when the broker restarts. Running jobs continue.
+        """
+
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        self._dispatcher.join()
+
+        with self._condition:
+            self._save_pending_jobs()
+
+            queued_jobs = [job for job in self._jobs.values() if job["state"] == "queued"]
+            if queued_jobs and not self.pending_jobs_file:
+                _logger.error("Losing %s queued detector retrieval jobs: %s" %
+                              (len(queued_jobs), [job["command"] for job in queued_jobs]))
+
+    def _queue_job(self, detector, command, log_filename, submit_time):
+        job_id = next(self._job_ids)
+
+        self._jobs[job_id] = {"job_id": job_id,
+                              "detector": detector,
+                              "command": command,
+                              "log_filename": log_filename,
+                              "state": "queued",
+                              "submit_time": submit_time,
+                              "start_time": None,
+                              "end_time": None,
+                              "runtime": None,
+                              "pid": None,
+                              "exit_code": None}
+
+        _logger.info("Queued detector retrieval job %s for detector %s." % (job_id, detector))
+
+        return job_id
+
+    def _load_pending_jobs(self):
+
+        if not self.pending_jobs_file or not os.path.exists(self.pending_jobs_file):
+            return
+
+        try:
+            with open(self.pending_jobs_file) as input_file:
+                pending_jobs = json.load(input_file)
+
+        except Exception as e:
+            _logger.error("Cannot load pending detector retrieval jobs from %s: %s" % (self.pending_jobs_file, e))
+            return
+
+        _logger.info("Queuing %s pending detector retrieval jobs from %s." %
+                     (len(pending_jobs), self.pending_jobs_file))
+
+        for job in pending_jobs:
+            self._queue_job(job["detector"], job["command"], job["log_filename"], job["submit_time"])
+
+    def _save_pending_jobs(self):
+
+        if not self.pending_jobs_file:
+            return
+
+        pending_jobs = [{"detector": job["detector"],
+                         "command": job["command"],
+                         "log_filename": job["log_filename"],
+                         "submit_time": job["submit_time"]}
+                        for job in self._jobs.values() if job["state"] == "queued"]
+
+        temp_file = self.pending_jobs_file + ".tmp"
+
+        try:
+            with open(temp_file, "w") as output_file:
+                json.dump(pending_jobs, output_file)
+
+            os.replace(temp_file, self.pending_jobs_file)
+
+        except Exception as e:
+            _logger.error("Cannot save pending detector retrieval jobs to %s: %s" % (self.pending_jobs_file, e))
+
+    def _can_start(self, job):
+        return self._n_running < self.max_concurrency and \
+            self._n_running_per_detector[job["detector"]] < self.max_concurrency_per_detector
+
+    def _dispatch(self):
+
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+
+                job = next((job for job in self._jobs.values()
+                            if job["state"] == "queued" and self._can_start(job)), None)
+
+                if job is None:
+                    self._condition.wait()
+                    continue
+
+                # The slots are taken before the process starts, so the limits hold while it is starting.
+                job["state"] = "running"
+                job["start_time"] = str(datetime.now())
+
+                self._n_running += 1
+                self._n_running_per_detector[job["detector"]] += 1
+
+                self._save_pending_jobs()
+
+            # Starting the process does not block the submission of new jobs.
+            self._start(job)
+
+    def _start(self, job):
+
+        _logger.info("Starting detector retrieve command %s " % job["command"])
+
+        try:
+            with open(job["log_filename"], "w") as log_file:
+                process = Popen(job["command"], shell=True, stdout=log_file, stderr=log_file)
+
+        except Exception as e:
+            _logger.error("Cannot start detector retrieval job %s: %s" % (job["job_id"], e))
+
+            with self._condition:
+                job["state"] = "failed"
+                job["end_time"] = str(datetime.now())
+
+                self._n_running -= 1
+                self._n_running_per_detector[job["detector"]] -= 1
+
+                self._trim_history()
+
+            return
+
+        with self._condition:
+            job["pid"] = process.pid
+
+        Thread(target=self._wait, args=(job, process, time()), daemon=True).start()
+
+    def _wait(self, job, process, start_time):
+        exit_code = process.wait()
+        runtime = time() - start_time
+
+        with self._condition:
+            job["state"] = "finished" if exit_code == 0 else "failed"
+            job["exit_code"] = exit_code
+            job["runtime"] = runtime
+            job["end_time"] = str(datetime.now())
+
+            self._n_running -= 1
+            self._n_running_per_detector[job["detector"]] -= 1
+
+            log_function = _logger.info if exit_code == 0 else _logger.error
+            log_function("Detector retrieval job %s for detector %s completed with exit_code=%s in %.1f seconds." %
+                         (job["job_id"], job["detector"], exit_code, runtime))
+
+            self._trim_history()
+            self._condition.notify_all()
+
+    def _trim_history(self):
+        completed_job_ids = [job_id for job_id, job in self._jobs.items() if job["state"] in ("finished", "failed")]
+
+        for job_id in completed_job_ids[:max(0, len(completed_job_ids) - self.history_length)]:
+            del self._jobs[job_id]
@@ -0,0 +1,185 @@
+import logging
+import os
+from threading import Event, Lock, Thread
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import ujson as json
+except:
+    _logger.warning("There is no ujson in this environment. Performance will suffer.")
+    import json
+
+
+class RequestJournal(object):
+    """
+    Append-only journal (JSON lines) of the requests accepted by the writer.
+
+    Every accepted request gets an "accept" record, a "started" record each time its processing starts, and a "done"
+    record when it was processed. The records are
+    flushed immediately and fsynced in batches, every fsync_interval seconds, by a background thread. The requests
+    without a "done" record (the writer stopped while they were pending) are returned by get_unfinished, to be
+    replayed. The journal is compacted (rewritten with only the unfinished requests) when it is opened, and when the
+    number of done records reaches compact_threshold. The number of started records of a request is returned by
+    get_attempts, so that a request that keeps stopping the writer is not replayed forever.
+    """
+
+    def __init__(self, filename, fsync_interval=None, compact_threshold=None):
+        self.filename = filename
+        self.fsync_interval = fsync_interval if fsync_interval is not None else config.WRITER_JOURNAL_FSYNC_INTERVAL
+        self.compact_threshold = compact_threshold if compact_threshold is not None \
+            else config.WRITER_JOURNAL_COMPACT_THRESHOLD
+
+        self._lock = Lock()
+        self._unfinished = self._load()
+        self._next_id = max(self._unfinished, default=0) + 1
+        self._n_done = 0
+        self._dirty = False
+
+        _logger.info("Opened request journal %s with %s unfinished requests." % (self.filename,
+                                                                                len(self._unfinished)))
+
+        self._file = None
+        self._compact()
+
+        self._stopped = Event()
+        self._flusher = Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def accept(self, data_api_request, parameters, request_timestamp):
+        """
+        Record the request as accepted. Returns the journal_id, to be passed to done.
+        """
+
+        with self._lock:
+            journal_id = self._next_id
+            self._next_id += 1
+
+            request = {"data_api_request": data_api_request,
+                       "parameters": parameters,
+                       "timestamp": request_timestamp,
+                       "attempts": 0}
+
+            self._unfinished[journal_id] = request
+            self._append(dict(type="accept", id=journal_id, **request))
+
+        return journal_id
+
+    def started(self, journal_id):
+
+        with self._lock:
+            request = self._unfinished.get(journal_id)
+            if request is None:
+                return
+
+            request["attempts"] += 1
+            self._append({"type": "started", "id": journal_id})
+
+    def get_attempts(self, journal_id):
+        """
+        Return how many times the processing of the unfinished request was started.
+        """
+
+        with self._lock:
+            return self._unfinished[journal_id]["attempts"]
+
+    def done(self, journal_id):
+
+        with self._lock:
+            if self._unfinished.pop(journal_id, None) is None:
+                return
+
+            self._append({"type": "done", "id": journal_id})
+            self._n_done += 1
+
+            if self._n_done >= self.compact_threshold:
+                self._compact()
+
+    def get_unfinished(self):
+        """
+        Return the unfinished requests as a list of (journal_id, data_api_request, parameters, request_timestamp),
+        in the order they were accepted.
+        """
+
+        with self._lock:
+            return [(journal_id, request["data_api_request"], request["parameters"], request["timestamp"])
+                    for journal_id, request in sorted(self._unfinished.items())]
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self._stopped.set()
+        self._flusher.join()
+
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _load(self):
+        unfinished = {}
+
+        if not os.path.exists(self.filename):
+            return unfinished
+
+        with open(self.filename) as input_file:
+            for line in input_file:
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line is incomplete if the writer died while appending it.
+                    _logger.warning("Skipping corrupted record in request journal %s." % self.filename)
+                    continue
+
+                if record["type"] == "accept":
+                    unfinished[record["id"]] = {"data_api_request": record["data_api_request"],
+                                                "parameters": record["parameters"],
+                                                "timestamp": record["timestamp"],
+                                                "attempts": record.get("attempts", 0)}
+
+                elif record["type"] == "started":
+                    if record["id"] in unfinished:
+                        unfinished[record["id"]]["attempts"] += 1
+
+                elif record["type"] == "done":
+                    unfinished.pop(record["id"], None)
+
+        return unfinished
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._dirty = True
+
+    def _sync(self):
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _compact(self):
+        temp_filename = self.filename + ".tmp"
+
+        with open(temp_filename, "w") as temp_file:
+            for journal_id, request in sorted(self._unfinished.items()):
+                temp_file.write(json.dumps(dict(type="accept", id=journal_id, **request)) + "\n")
+
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        if self._file is not None:
+            self._file.close()
+
+        os.replace(temp_filename, self.filename)
+
+        self._file = open(self.filename, "a")
+        self._n_done = 0
+        self._dirty = False
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.fsync_interval):
+            with self._lock:
+                self._sync()
@@ -0,0 +1,145 @@
+import logging
+from collections import OrderedDict
+from decimal import Decimal
+from threading import Lock
+from time import time
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+# Pulse ids advance at a fixed rate of 100Hz.
+PULSE_ID_FREQUENCY = 100
+
+_cache = None
+_cache_lock = Lock()
+
+
+class PulseIdMappingCache(object):
+    """
+    LRU cache, with a time to live, of pulse_id range to timestamp range mappings.
+
+    Each cached mapping also provides 2 anchors (pulse_id -> globalSeconds). If interpolation_max_distance is set,
+    a range that is not cached is computed from the nearest anchors, as long as they are not more than
+    interpolation_max_distance pulses away.
+    """
+
+    def __init__(self, max_size=None, ttl=None, interpolation_max_distance=None):
+
+        self.max_size = max_size if max_size is not None else config.PULSE_ID_MAPPING_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else config.PULSE_ID_MAPPING_CACHE_TTL
+        self.interpolation_max_distance = interpolation_max_distance if interpolation_max_distance is not None \
+            else config.PULSE_ID_MAPPING_INTERPOLATION_MAX_DISTANCE
+
+        self._lock = Lock()
+        self._mappings = OrderedDict()
+        self._anchors = OrderedDict()
+
+        self.statistics = {"n_hits": 0,
+                           "n_misses": 0,
+                           "n_interpolated": 0,
+                           "n_expired": 0}
+
+    def get(self, start_pulse_id, end_pulse_id):
+        """
+        Return the cached (start_seconds, end_seconds) of the range, or None if it is not cached.
+        """
+
+        with self._lock:
+            mapping = self._get_valid(self._mappings, (start_pulse_id, end_pulse_id))
+
+            if mapping is not None:
+                self.statistics["n_hits"] += 1
+                return mapping
+
+            if self.interpolation_max_distance:
+                start_seconds = self._interpolate(start_pulse_id)
+                end_seconds = self._interpolate(end_pulse_id)
+
+                if start_seconds is not None and end_seconds is not None:
+                    self.statistics["n_interpolated"] += 1
+                    return start_seconds, end_seconds
+
+            self.statistics["n_misses"] += 1
+            return None
+
+    def put(self, start_pulse_id, end_pulse_id, start_seconds, end_seconds):
+
+        with self._lock:
+            self._put(self._mappings, (start_pulse_id, end_pulse_id), (start_seconds, end_seconds))
+            self._put(self._anchors, start_pulse_id, start_seconds)
+            self._put(self._anchors, end_pulse_id, end_seconds)
+
+    def get_statistics(self):
+        with self._lock:
+            statistics = dict(self.statistics)
+            statistics["n_cached"] = len(self._mappings)
+
+        return statistics
+
+    def clear(self):
+        with self._lock:
+            self._mappings.clear()
+            self._anchors.clear()
+
+    def _put(self, entries, key, value):
+        entries[key] = (value, time())
+        entries.move_to_end(key)
+
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def _get_valid(self, entries, key):
+        entry = entries.get(key)
+
+        if entry is None:
+            return None
+
+        value, cached_time = entry
+
+        if time() - cached_time > self.ttl:
+            del entries[key]
+            self.statistics["n_expired"] += 1
+            return None
+
+        entries.move_to_end(key)
+        return value
+
+    def _interpolate(self, pulse_id):
+
+        nearest_pulse_id = None
+
+        for anchor_pulse_id in list(self._anchors):
+            distance = abs(anchor_pulse_id - pulse_id)
+
+            if distance <= self.interpolation_max_distance and \
+                    (nearest_pulse_id is None or distance < abs(nearest_pulse_id - pulse_id)):
+
+                if self._get_valid(self._anchors, anchor_pulse_id) is not None:
+                    nearest_pulse_id = anchor_pulse_id
+
+        if nearest_pulse_id is None:
+            return None
+
+        anchor_seconds = self._anchors[nearest_pulse_id][0]
+        seconds = Decimal(str(anchor_seconds)) + Decimal(pulse_id - nearest_pulse_id) / PULSE_ID_FREQUENCY
+
+        # Keep the type of the mapping responses: strings keep the nanoseconds.
+        if isinstance(anchor_seconds, str):
+            return format(seconds, ".9f")
+
+        return float(seconds)
+
+
+def get_mapping_cache():
+    """
+    Return the cache shared by all the requests of this process.
+    """
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = PulseIdMappingCache()
+
+        return _cache
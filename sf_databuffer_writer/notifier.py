@@ -0,0 +1,141 @@
+import logging
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import time, sleep
+
+import requests
+
+from sf_databuffer_writer import config, http_session
+
+_logger = logging.getLogger(__name__)
+
+
+class EpicsWriterNotifier(object):
+    """
+    Forward requests to the epics writer from a fixed number of worker threads.
+
+    Requests are queued in a bounded queue - if the epics writer is too slow and the queue is full, notify waits up
+    to queue_timeout seconds for a free slot, and then rejects (and counts) the request. Requests that cannot connect to the epics writer are
+    retried with exponential backoff. Requests that reached it (timeouts and error responses) are not retried, so the
+    epics writer never gets the same notification twice.
+    """
+
+    def __init__(self, epics_writer_url, n_workers=None, queue_length=None, timeout=None, retries=None,
+                 retry_backoff=None, queue_timeout=None):
+
+        self.epics_writer_url = epics_writer_url
+
+        self.n_workers = n_workers if n_workers is not None else config.EPICS_WRITER_N_WORKERS
+        self.queue_length = queue_length if queue_length is not None else config.EPICS_WRITER_QUEUE_LENGTH
+        self.queue_timeout = queue_timeout if queue_timeout is not None else config.EPICS_WRITER_QUEUE_TIMEOUT
+        self.timeout = timeout if timeout is not None else config.EPICS_WRITER_TIMEOUT
+        self.retries = retries if retries is not None else config.EPICS_WRITER_RETRIES
+        self.retry_backoff = retry_backoff if retry_backoff is not None else config.EPICS_WRITER_RETRY_BACKOFF
+
+        _logger.info("Starting epics writer notifier with epics_writer_url=%s, n_workers=%s, queue_length=%s, "
+                     "timeout=%s and retries=%s" %
+                     (self.epics_writer_url, self.n_workers, self.queue_length, self.timeout, self.retries))
+
+        self.queue = Queue(maxsize=self.queue_length)
+
+        # The retries are done here, with a session that does not retry on its own.
+        self._session = http_session.create_session(pool_size=self.n_workers, retries=0)
+
+        self._statistics_lock = Lock()
+        self.statistics = {"n_in_flight": 0,
+                           "n_sent": 0,
+                           "n_failed": 0,
+                           "n_rejected": 0,
+                           "n_retries": 0,
+                           "last_latency": None,
+                           "max_latency": None,
+                           "total_latency": 0.0}
+
+        self.workers = [Thread(target=self._process_requests, daemon=True) for _ in range(self.n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def notify(self, epics_writer_request):
+        """
+        Queue the request for the epics writer. Returns False if the queue stayed full for queue_timeout seconds and
+        the request was rejected.
+        """
+
+        try:
+            self.queue.put((epics_writer_request, time()), timeout=self.queue_timeout)
+            return True
+
+        except Full:
+            self._update_statistics(n_rejected=1)
+            _logger.error("Epics writer queue is full (queue_length=%s) since %s seconds. Rejecting request %s." %
+                          (self.queue_length, self.queue_timeout, epics_writer_request))
+            return False
+
+    def get_statistics(self):
+        with self._statistics_lock:
+            statistics = dict(self.statistics)
+
+        total_latency = statistics.pop("total_latency")
+        statistics["average_latency"] = total_latency / statistics["n_sent"] if statistics["n_sent"] else None
+        statistics["n_queued"] = self.queue.qsize()
+
+        return statistics
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put((None, None))
+
+        for worker in self.workers:
+            worker.join()
+
+    def _update_statistics(self, **deltas):
+        with self._statistics_lock:
+            for name, delta in deltas.items():
+                self.statistics[name] += delta
+
+    def _send(self, epics_writer_request):
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.put(url=self.epics_writer_url, json=epics_writer_request, timeout=self.timeout)
+                response.raise_for_status()
+                return
+
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries:
+                    raise
+
+                retry_delay = self.retry_backoff * (2 ** attempt)
+                _logger.warning("Epics writer request failed (%s). Retrying in %s seconds." % (e, retry_delay))
+
+                self._update_statistics(n_retries=1)
+                sleep(retry_delay)
+
+    def _process_requests(self):
+
+        while True:
+            epics_writer_request, queued_time = self.queue.get()
+
+            if epics_writer_request is None:
+                return
+
+            self._update_statistics(n_in_flight=1)
+
+            try:
+                _logger.info("Sending epics writer request %s" % epics_writer_request)
+                self._send(epics_writer_request)
+
+                latency = time() - queued_time
+
+                with self._statistics_lock:
+                    self.statistics["n_sent"] += 1
+                    self.statistics["last_latency"] = latency
+                    self.statistics["max_latency"] = max(latency, self.statistics["max_latency"] or 0)
+                    self.statistics["total_latency"] += latency
+
+            except Exception as e:
+                self._update_statistics(n_failed=1)
+                _logger.error("Error while trying to forward the write request to the epics writer: %s" % e)
+
+            finally:
+                self._update_statistics(n_in_flight=-1)
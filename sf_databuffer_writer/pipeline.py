@@ -0,0 +1,118 @@
+import logging
+from queue import Queue
+from threading import Lock, Thread
+from time import time
+
+_logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class RequestPipeline(object):
+    """
+    Two stage (retrieve, write) request pipeline, so the retrieval of a request overlaps with the writing of the
+    previous one.
+
+    process_request runs the retrieve stage in the calling thread (one of the n_retrieve_workers executor threads)
+    and hands its result over to the write stage, a single thread that writes the requests in hand-off order. The
+    hand-off queue holds at most queue_length retrieved requests: when it is full the retrieve stage waits, so the
+    memory taken by retrieved data stays bounded.
+    """
+
+    def __init__(self, retrieve_function, write_function, n_retrieve_workers, queue_length, on_done=None):
+        self.retrieve_function = retrieve_function
+        self.write_function = write_function
+        self.n_retrieve_workers = n_retrieve_workers
+        self.queue_length = queue_length
+        self.on_done = on_done
+
+        _logger.info("Starting request pipeline with n_retrieve_workers=%s and queue_length=%s." %
+                     (self.n_retrieve_workers, self.queue_length))
+
+        self.queue = Queue(maxsize=self.queue_length)
+
+        self._statistics_lock = Lock()
+        self._start_time = time()
+        self.statistics = {"retrieve_busy_time": 0.0,
+                           "retrieve_blocked_time": 0.0,
+                           "write_busy_time": 0.0,
+                           "n_retrieved": 0,
+                           "n_written": 0}
+
+        self._writer = Thread(target=self._write_requests, daemon=True)
+        self._writer.start()
+
+    def process_request(self, *args, on_written=None):
+        """
+        Retrieve the request and queue it for writing. Blocks while the hand-off queue is full.
+        on_written is called (before on_done) when the request was written.
+        """
+
+        start_time = time()
+
+        try:
+            retrieved_request = self.retrieve_function(*args)
+        finally:
+            self._update_statistics(retrieve_busy_time=time() - start_time, n_retrieved=1)
+
+        # Requests with nothing to write go through the queue as well, so on_done is called in order.
+        start_time = time()
+        self.queue.put((retrieved_request, on_written))
+        self._update_statistics(retrieve_blocked_time=time() - start_time)
+
+    def get_statistics(self):
+        """
+        Utilization is the fraction of time a stage was busy. The retrieve stage is busy when all its workers are.
+        """
+
+        elapsed_time = max(time() - self._start_time, 1e-9)
+
+        with self._statistics_lock:
+            statistics = dict(self.statistics)
+
+        statistics["retrieve_utilization"] = \
+            statistics["retrieve_busy_time"] / (elapsed_time * self.n_retrieve_workers)
+        statistics["write_utilization"] = statistics["write_busy_time"] / elapsed_time
+        statistics["n_queued"] = self.queue.qsize()
+
+        return statistics
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self._writer.join()
+
+    def _update_statistics(self, **deltas):
+        with self._statistics_lock:
+            for name, delta in deltas.items():
+                self.statistics[name] += delta
+
+    def _write_requests(self):
+
+        while True:
+            item = self.queue.get()
+
+            if item is _STOP:
+                return
+
+            retrieved_request, on_written = item
+
+            start_time = time()
+
+            try:
+                # Requests that failed or have nothing to write are not tuples.
+                if retrieved_request:
+                    self.write_function(*retrieved_request)
+
+            except Exception as e:
+                _logger.error("Error in the write stage of the request pipeline: %s" % e)
+
+            finally:
+                self._update_statistics(write_busy_time=time() - start_time, n_written=1)
+
+                if on_written is not None:
+                    on_written()
+
+                if self.on_done is not None:
+                    self.on_done()
+
+            _logger.info("Request pipeline statistics: %s" % self.get_statistics())
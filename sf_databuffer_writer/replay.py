@@ -0,0 +1,321 @@
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import as_completed
+from datetime import datetime
+from fnmatch import fnmatch
+
+from sf_databuffer_writer import config
+from sf_databuffer_writer.writer import get_executor, process_request
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import ujson as json
+except:
+    _logger.warning("There is no ujson in this environment. Performance will suffer.")
+    import json
+
+
+def parse_audit_line(line):
+    """
+    Parse a line of the audit trail (text or jsonl format) or of an .err file.
+    Returns (audit_time, data_api_request, parameters, request_timestamp).
+    """
+
+    if line.startswith("{"):
+        write_request = json.loads(line)
+        audit_time = datetime.strptime(write_request["audit_time"], config.AUDIT_FILE_TIME_FORMAT)
+    else:
+        audit_time = datetime.strptime(line[1:16], config.AUDIT_FILE_TIME_FORMAT)
+        write_request = json.loads(line[18:])
+
+    data_api_request = write_request["data_api_request"]
+    if isinstance(data_api_request, str):
+        data_api_request = json.loads(data_api_request)
+
+    parameters = write_request["parameters"]
+    if isinstance(parameters, str):
+        parameters = json.loads(parameters)
+
+    return audit_time, data_api_request, parameters, write_request["timestamp"]
+
+
+def get_request_files(paths):
+    """
+    Files are returned as they are, directories are searched (recursively) for .err files.
+    """
+
+    for path in paths:
+
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for folder, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.endswith(".err"):
+                    yield os.path.join(folder, filename)
+
+
+def read_requests(paths, statistics):
+
+    for filename in get_request_files(paths):
+        statistics["n_files"] += 1
+
+        with open(filename) as input_file:
+            for line_number, line in enumerate(input_file, start=1):
+
+                if not line.strip():
+                    continue
+
+                try:
+                    request = parse_audit_line(line)
+                    # Requests without a known range cannot be replayed.
+                    get_request_range(request[1])
+                except Exception as e:
+                    statistics["n_invalid"] += 1
+                    _logger.warning("Cannot parse line %s of file %s: %s" % (line_number, filename, e))
+                    continue
+
+                yield request
+
+
+def get_request_range(data_api_request):
+    """
+    Return the (start, end) of the request range. Requests can be by pulse_id, or by time when
+    TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY is enabled in the writer.
+    """
+
+    request_range = data_api_request["range"]
+
+    for start_key, end_key in (("startPulseId", "endPulseId"),
+                               ("startSeconds", "endSeconds"),
+                               ("startDate", "endDate")):
+
+        if start_key in request_range and end_key in request_range:
+            return request_range[start_key], request_range[end_key]
+
+    raise ValueError("Unknown request range %s." % request_range)
+
+
+def get_request_key(data_api_request, parameters):
+    return "%s:%s-%s" % ((parameters.get("output_file"),) + get_request_range(data_api_request))
+
+
+def is_request_selected(audit_time, data_api_request, parameters, start_time=None, end_time=None,
+                        start_pulse_id=None, end_pulse_id=None, output_file_pattern=None):
+    """
+    The time range is matched against the audit time. Requests are selected if their pulse_id range overlaps with
+    [start_pulse_id, end_pulse_id] - requests by time are filtered out when a pulse_id range is given.
+    """
+
+    if start_time is not None and audit_time < start_time:
+        return False
+
+    if end_time is not None and audit_time > end_time:
+        return False
+
+    if start_pulse_id is not None or end_pulse_id is not None:
+        request_range = data_api_request["range"]
+
+        # Requests by time cannot be matched against a pulse_id range.
+        if "startPulseId" not in request_range or "endPulseId" not in request_range:
+            return False
+
+        if start_pulse_id is not None and request_range["endPulseId"] < start_pulse_id:
+            return False
+
+        if end_pulse_id is not None and request_range["startPulseId"] > end_pulse_id:
+            return False
+
+    if output_file_pattern is not None and not fnmatch(parameters.get("output_file", ""), output_file_pattern):
+        return False
+
+    return True
+
+
+def get_replay_requests(paths, statistics, **filters):
+    """
+    Return the selected requests as an ordered dict key -> (data_api_request, parameters, request_timestamp).
+    Duplicated requests (same output file and pulse_id range) are replayed once, with the latest audited request.
+    """
+
+    requests = {}
+
+    for audit_time, data_api_request, parameters, request_timestamp in read_requests(paths, statistics):
+        statistics["n_requests"] += 1
+
+        if not is_request_selected(audit_time, data_api_request, parameters, **filters):
+            statistics["n_filtered"] += 1
+            continue
+
+        key = get_request_key(data_api_request, parameters)
+
+        if key in requests:
+            statistics["n_duplicated"] += 1
+
+            if requests[key][0] > audit_time:
+                continue
+
+        requests[key] = (audit_time, data_api_request, parameters, request_timestamp)
+
+    return {key: request[1:] for key, request in sorted(requests.items(), key=lambda item: item[1][0])}
+
+
+def read_state(state_file):
+    """
+    Return the keys of the requests already replayed successfully.
+    """
+
+    replayed_keys = set()
+
+    if not state_file or not os.path.exists(state_file):
+        return replayed_keys
+
+    with open(state_file) as input_file:
+        for line in input_file:
+
+            try:
+                state = json.loads(line)
+            except ValueError:
+                continue
+
+            if state["success"]:
+                replayed_keys.add(state["key"])
+
+    return replayed_keys
+
+
+def replay_requests(paths, n_workers=None, worker_type=None, state_file=None, dry_run=False, **filters):
+    """
+    Replay the requests from the audit trail files and the .err files found in paths.
+    Returns the replay statistics.
+    """
+
+    if n_workers is None:
+        n_workers = config.DEFAULT_N_WORKERS
+
+    if worker_type is None:
+        worker_type = config.DEFAULT_WORKER_TYPE
+
+    statistics = {"n_files": 0,
+                  "n_requests": 0,
+                  "n_invalid": 0,
+                  "n_filtered": 0,
+                  "n_duplicated": 0,
+                  "n_already_replayed": 0,
+                  "n_succeeded": 0,
+                  "n_failed": 0,
+                  "failed_requests": []}
+
+    requests = get_replay_requests(paths, statistics, **filters)
+
+    replayed_keys = read_state(state_file)
+    for key in [key for key in requests if key in replayed_keys]:
+        statistics["n_already_replayed"] += 1
+        del requests[key]
+
+    _logger.info("Replaying %s requests with n_workers=%s and worker_type=%s." %
+                 (len(requests), n_workers, worker_type))
+
+    if dry_run:
+        for key in requests:
+            _logger.info("Request to replay: %s" % key)
+
+        return statistics
+
+    state_output = open(state_file, "a") if state_file else None
+
+    try:
+        with get_executor(n_workers, worker_type) as executor:
+
+            futures = {executor.submit(process_request, data_api_request, parameters, request_timestamp): key
+                       for key, (data_api_request, parameters, request_timestamp) in requests.items()}
+
+            for future in as_completed(futures):
+                key = futures[future]
+
+                try:
+                    success = future.result()
+                except Exception as e:
+                    _logger.error("Worker failed while replaying request %s: %s" % (key, e))
+                    success = False
+
+                if success:
+                    statistics["n_succeeded"] += 1
+                else:
+                    statistics["n_failed"] += 1
+                    statistics["failed_requests"].append(key)
+
+                _logger.info("Replayed request %s (success=%s). %s of %s requests done." %
+                             (key, success, statistics["n_succeeded"] + statistics["n_failed"], len(requests)))
+
+                if state_output is not None:
+                    state_output.write(json.dumps({"key": key, "success": success}) + "\n")
+                    state_output.flush()
+
+    finally:
+        if state_output is not None:
+            state_output.close()
+
+    return statistics
+
+
+def parse_time(value):
+    return datetime.strptime(value, config.AUDIT_FILE_TIME_FORMAT)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Replay requests from the broker audit trail and writer .err files')
+
+    parser.add_argument("paths", nargs="+",
+                        help="Audit trail files, .err files or folders to search (recursively) for .err files.")
+    parser.add_argument("--start_time", type=parse_time,
+                        help="Replay only requests audited after this time (%s)." %
+                             config.AUDIT_FILE_TIME_FORMAT.replace("%", "%%"))
+    parser.add_argument("--end_time", type=parse_time,
+                        help="Replay only requests audited before this time (%s)." %
+                             config.AUDIT_FILE_TIME_FORMAT.replace("%", "%%"))
+    parser.add_argument("--start_pulse_id", type=int, help="Replay only requests with pulse_ids after this one.")
+    parser.add_argument("--end_pulse_id", type=int, help="Replay only requests with pulse_ids before this one.")
+    parser.add_argument("--output_file", dest="output_file_pattern",
+                        help="Replay only requests with an output_file matching this pattern (e.g. '/sf/alvra/*').")
+    parser.add_argument("--n_workers", default=config.DEFAULT_N_WORKERS, type=int,
+                        help="Number of requests to replay in parallel.")
+    parser.add_argument("--worker_type", default=config.DEFAULT_WORKER_TYPE, choices=["thread", "process"],
+                        help="Replay requests in threads (retrieval bound) or processes (conversion bound).")
+    parser.add_argument("--state_file",
+                        help="File where the replayed requests are recorded. Requests replayed successfully in a "
+                             "previous run with the same state_file are skipped.")
+    parser.add_argument("--dry_run", action="store_true", help="List the requests to replay, without replaying them.")
+
+    parser.add_argument("--log_level", default="INFO",
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+
+    arguments = parser.parse_args()
+
+    # Setup the logging level.
+    logging.basicConfig(level=arguments.log_level, format='[%(levelname)s] %(message)s')
+
+    statistics = replay_requests(arguments.paths,
+                                 n_workers=arguments.n_workers,
+                                 worker_type=arguments.worker_type,
+                                 state_file=arguments.state_file,
+                                 dry_run=arguments.dry_run,
+                                 start_time=arguments.start_time,
+                                 end_time=arguments.end_time,
+                                 start_pulse_id=arguments.start_pulse_id,
+                                 end_pulse_id=arguments.end_pulse_id,
+                                 output_file_pattern=arguments.output_file_pattern)
+
+    print(json.dumps(statistics, indent=4))
+
+    if statistics["n_failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
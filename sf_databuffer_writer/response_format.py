@@ -0,0 +1,431 @@
+import logging
+import struct
+import zlib
+from collections.abc import Sequence
+from copy import deepcopy
+
+import numpy
+
+from sf_databuffer_writer import config, utils
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import ujson as json
+except:
+    _logger.warning("There is no ujson in this environment. Performance will suffer.")
+    import json
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+RESPONSE_FORMATS = ("json", "binary")
+RESPONSE_COMPRESSIONS = ("none", "gzip", "lz4")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_LZ4_MAGIC = b"\x04\x22\x4d\x18"
+
+# Binary framed response format.
+#
+# The response is a sequence of frames:
+#   header_length (uint32, little endian) | header (UTF-8 JSON) | payload_length (uint64, little endian) | payload
+#
+# Each channel starts with a channel frame, without payload:
+#   {"channel": {"name": ..., "backend": ...}, "configs": [{"type": ..., "shape": ...}]}
+# followed by any number of event frames, with the events of the channel sorted by pulse_id:
+#   {"pulseIds": [...], "globalDates": [...], "shape": [...]}
+# The payload of an event frame holds the values of all its events, in the channel type (little endian), in numpy
+# order (the reversed bsread shape). String values are in the "values" list of the header instead, without payload.
+_HEADER_LENGTH = struct.Struct("<I")
+_PAYLOAD_LENGTH = struct.Struct("<Q")
+
+BINARY_DTYPES = {
+    "int8": "<i1", "uint8": "<u1",
+    "int16": "<i2", "uint16": "<u2",
+    "int32": "<i4", "uint32": "<u4",
+    "int64": "<i8", "uint64": "<u8",
+    "float32": "<f4", "float64": "<f8",
+    "bool": "<u1"
+}
+
+
+class EventColumns(Sequence):
+    """
+    Events of a channel decoded from a binary response, kept as columns: pulse_ids is an int64 array, global_dates a
+    list, and values a numpy array (in numpy order, one row per event) or the list of strings.
+
+    The writers use the columns directly. Indexing returns the event as a dict, like in a json response.
+    """
+
+    def __init__(self, pulse_ids, global_dates, values, shape):
+        self.pulse_ids = pulse_ids
+        self.global_dates = global_dates
+        self.values = values
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.pulse_ids)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return EventColumns(self.pulse_ids[index], self.global_dates[index], self.values[index], self.shape)
+
+        value = self.values[index]
+
+        # Scalars are numbers in json responses.
+        if isinstance(value, numpy.generic):
+            value = value.item()
+
+        return {"pulseId": int(self.pulse_ids[index]), "globalDate": self.global_dates[index],
+                "shape": self.shape, "value": value}
+
+    def extend(self, events):
+        joined = EventColumns.concatenate([self, events])
+
+        self.pulse_ids, self.global_dates, self.values = joined.pulse_ids, joined.global_dates, joined.values
+
+    @staticmethod
+    def concatenate(parts):
+
+        if len(parts) == 1:
+            return parts[0]
+
+        values = [part.values for part in parts]
+
+        return EventColumns(numpy.concatenate([part.pulse_ids for part in parts]),
+                            [global_date for part in parts for global_date in part.global_dates],
+                            sum(values, []) if isinstance(values[0], list) else numpy.concatenate(values),
+                            parts[0].shape)
+
+
+def get_response_options(parameters):
+    """
+    Return the (format, compression) of the data api response, from the parameters or the config defaults.
+    """
+
+    response_format = parameters.get("data_api_response_format", config.DEFAULT_DATA_API_RESPONSE_FORMAT)
+    compression = parameters.get("data_api_response_compression", config.DEFAULT_DATA_API_RESPONSE_COMPRESSION)
+
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError("Invalid data_api_response_format '%s'. Supported: %s." %
+                         (response_format, ", ".join(RESPONSE_FORMATS)))
+
+    if compression not in RESPONSE_COMPRESSIONS:
+        raise ValueError("Invalid data_api_response_compression '%s'. Supported: %s." %
+                         (compression, ", ".join(RESPONSE_COMPRESSIONS)))
+
+    if compression == "lz4" and lz4 is None:
+        raise ValueError("data_api_response_compression 'lz4' requires the lz4 package.")
+
+    return response_format, compression
+
+
+def set_response_options(data_api_request, parameters):
+    """
+    Return a copy of the data api request, with the response format and compression requested in the parameters.
+    """
+
+    response_format, compression = get_response_options(parameters)
+
+    data_api_request = deepcopy(data_api_request)
+    data_api_request["response"] = {"format": response_format, "compression": compression}
+
+    return data_api_request
+
+
+def get_request_response_options(data_api_request):
+    response = data_api_request.get("response") or {}
+    return response.get("format", "json"), response.get("compression", "none")
+
+
+def iterate_decompressed(chunks, compression):
+    """
+    Decompress an iterable of byte chunks incrementally.
+
+    Responses that are not compressed (for example because the HTTP client already decoded the Content-Encoding)
+    are passed through.
+    """
+
+    chunks = iter(chunks)
+
+    if compression == "none":
+        yield from chunks
+        return
+
+    first_chunk = b""
+    for chunk in chunks:
+        first_chunk += chunk
+
+        if len(first_chunk) >= 4:
+            break
+
+    if compression == "gzip" and first_chunk.startswith(_GZIP_MAGIC):
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+    elif compression == "lz4" and first_chunk.startswith(_LZ4_MAGIC):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    else:
+        _logger.debug("Data api response is not %s compressed." % compression)
+
+        if first_chunk:
+            yield first_chunk
+
+        yield from chunks
+        return
+
+    for chunk in _prepend(first_chunk, chunks):
+        decompressed_chunk = decompressor.decompress(chunk)
+
+        if decompressed_chunk:
+            yield decompressed_chunk
+
+    if compression == "gzip":
+        remaining = decompressor.flush()
+
+        if remaining:
+            yield remaining
+
+
+def _prepend(first_chunk, chunks):
+    yield first_chunk
+    yield from chunks
+
+
+def iterate_binary_channels(chunks):
+    """
+    Decode a binary framed response incrementally from an iterable of byte chunks, yielding one channel at a time
+    (with the same structure as the channels of a json response).
+
+    The data of each channel is an EventColumns: values of numeric channels are numpy views on the received frames
+    (numpy.frombuffer), without text parsing, and no object is created per event.
+    Raises ValueError if the response is truncated or an event frame has no channel.
+    """
+
+    buffer = bytearray()
+    position = 0
+    channel_data = None
+    channel_parts = []
+
+    for chunk in chunks:
+        buffer += chunk
+
+        while True:
+            frame = _read_frame(buffer, position)
+
+            if frame is None:
+                break
+
+            header, payload, position = frame
+
+            if "channel" in header:
+                if channel_data is not None:
+                    yield _join_channel_parts(channel_data, channel_parts)
+
+                channel_data = {"channel": header["channel"], "configs": header["configs"]}
+                channel_parts = []
+                continue
+
+            if channel_data is None:
+                raise ValueError("Binary data api response has events without a channel.")
+
+            channel_parts.append(_decode_events(channel_data["configs"][0]["type"], header, payload))
+
+        # Release the frames already decoded.
+        del buffer[:position]
+        position = 0
+
+    if buffer:
+        raise ValueError("Binary data api response is truncated (%d bytes left)." % len(buffer))
+
+    if channel_data is not None:
+        yield _join_channel_parts(channel_data, channel_parts)
+
+
+def _join_channel_parts(channel_data, channel_parts):
+    return dict(channel_data, data=EventColumns.concatenate(channel_parts) if channel_parts else [])
+
+
+def iterate_binary_channel_parts(chunks):
+    """
+    Decode a binary framed response incrementally, yielding the channels in parts of one event frame.
+
+    Each part has the structure of a channel, and every channel has at least one part (with empty data if it has no
+    events). Only the frame currently being decoded is kept in memory.
+    """
+
+    buffer = bytearray()
+    position = 0
+    channel_data = None
+    n_parts = 0
+
+    for chunk in chunks:
+        buffer += chunk
+
+        while True:
+            frame = _read_frame(buffer, position)
+
+            if frame is None:
+                break
+
+            header, payload, position = frame
+
+            if "channel" in header:
+                if channel_data is not None and n_parts == 0:
+                    yield dict(channel_data, data=[])
+
+                channel_data = {"channel": header["channel"], "configs": header["configs"]}
+                n_parts = 0
+                continue
+
+            if channel_data is None:
+                raise ValueError("Binary data api response has events without a channel.")
+
+            n_parts += 1
+            yield dict(channel_data, data=_decode_events(channel_data["configs"][0]["type"], header, payload))
+
+        del buffer[:position]
+        position = 0
+
+    if buffer:
+        raise ValueError("Binary data api response is truncated (%d bytes left)." % len(buffer))
+
+    if channel_data is not None and n_parts == 0:
+        yield dict(channel_data, data=[])
+
+
+def decode_binary_response(content):
+    return list(iterate_binary_channels([content]))
+
+
+def iterate_response_channels(chunks, data_api_request):
+    """
+    Iterate over the channels of a (possibly compressed) data api response, in the format of the request.
+    """
+
+    response_format, compression = get_request_response_options(data_api_request)
+    chunks = iterate_decompressed(chunks, compression)
+
+    if response_format == "binary":
+        return iterate_binary_channels(chunks)
+
+    return utils.iterate_json_array(chunks)
+
+
+def iterate_response_channel_parts(chunks, data_api_request):
+    """
+    Like iterate_response_channels, but the channels are yielded in parts of one event (json) or one event frame
+    (binary), so a channel never has to be entirely in memory.
+    """
+
+    response_format, compression = get_request_response_options(data_api_request)
+    chunks = iterate_decompressed(chunks, compression)
+
+    if response_format == "binary":
+        return iterate_binary_channel_parts(chunks)
+
+    return utils.iterate_json_channel_parts(chunks)
+
+
+def decode_response(content, data_api_request):
+    """
+    Decode a complete data api response, in the format of the request.
+    """
+
+    response_format, compression = get_request_response_options(data_api_request)
+
+    if compression != "none":
+        content = b"".join(iterate_decompressed([content], compression))
+
+    if response_format == "binary":
+        return decode_binary_response(content)
+
+    return json.loads(content)
+
+
+def encode_binary_response(json_data):
+    """
+    Encode json data api channels in the binary framed format (one event frame per channel).
+    """
+
+    frames = []
+
+    for channel_data in json_data:
+        frames.append(_encode_frame({"channel": channel_data["channel"], "configs": channel_data["configs"]}))
+
+        data = channel_data["data"]
+        if not data:
+            continue
+
+        channel_type = channel_data["configs"][0]["type"]
+        channel_shape = channel_data["configs"][0]["shape"]
+
+        header = {"pulseIds": [data_point["pulseId"] for data_point in data],
+                  "globalDates": [data_point["globalDate"] for data_point in data],
+                  "shape": channel_shape}
+
+        if channel_type == "string":
+            header["values"] = [data_point["value"] for data_point in data]
+            payload = b""
+        else:
+            payload = numpy.asarray([data_point["value"] for data_point in data],
+                                    dtype=BINARY_DTYPES[channel_type]).tobytes()
+
+        frames.append(_encode_frame(header, payload))
+
+    return b"".join(frames)
+
+
+def _encode_frame(header, payload=b""):
+    header = json.dumps(header).encode()
+    return _HEADER_LENGTH.pack(len(header)) + header + _PAYLOAD_LENGTH.pack(len(payload)) + payload
+
+
+def _read_frame(buffer, position):
+    """
+    Return (header, payload, next_position) of the frame at position, or None if the frame is not complete yet.
+    """
+
+    header_start = position + _HEADER_LENGTH.size
+    if len(buffer) < header_start:
+        return None
+
+    header_length, = _HEADER_LENGTH.unpack_from(buffer, position)
+
+    payload_start = header_start + header_length + _PAYLOAD_LENGTH.size
+    if len(buffer) < payload_start:
+        return None
+
+    payload_length, = _PAYLOAD_LENGTH.unpack_from(buffer, header_start + header_length)
+
+    payload_end = payload_start + payload_length
+    if len(buffer) < payload_end:
+        return None
+
+    with memoryview(buffer) as view:
+        header = json.loads(bytes(view[header_start:header_start + header_length]))
+        payload = bytes(view[payload_start:payload_end])
+
+    return header, payload, payload_end
+
+
+def _decode_events(channel_type, header, payload):
+
+    pulse_ids = header["pulseIds"]
+    global_dates = header["globalDates"]
+    shape = header["shape"]
+
+    if channel_type == "string":
+        values = header["values"]
+
+    else:
+        values = numpy.frombuffer(payload, dtype=BINARY_DTYPES[channel_type])
+
+        if shape != [1]:
+            # Bsread is [X, Y] but numpy is [Y, X].
+            values = values.reshape([len(pulse_ids)] + shape[::-1])
+
+    return EventColumns(numpy.asarray(pulse_ids, dtype="<i8"), global_dates, values, shape)
@@ -1,4 +1,6 @@
 import json
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
 
 import bottle
 import logging
@@ -8,7 +10,31 @@ import os
 _logger = logging.getLogger(__name__)
 
 
-def register_rest_interface(app, manager):
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class ThreadedWSGIRefServer(bottle.WSGIRefServer):
+    """
+    WSGIRef server handling each request in its own thread, so a slow request does not block the others.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8080, **options):
+        options.setdefault("server_class", ThreadingWSGIServer)
+        super(ThreadedWSGIRefServer, self).__init__(host, port, **options)
+
+
+# Servers for bottle.run: the default single threaded wsgiref server, or the threaded one.
+REST_SERVERS = {"wsgiref": "wsgiref",
+                "threaded": ThreadedWSGIRefServer}
+
+
+def register_rest_interface(app, manager, retrieve_executor=None):
+    """
+    If retrieve_executor is set, /retrieve_from_buffers requests (filesystem heavy) are executed in it, limiting how
+    many of them run at the same time.
+    """
+
     @app.get("/status")
     def get_status():
         return {"state": "ok",
@@ -53,7 +79,18 @@ def register_rest_interface(app, manager):
 
     @app.post("/retrieve_from_buffers")
     def retrieve_from_buffers():
-        return manager.retrieve(request=bottle.request.json, remote_ip=bottle.request.remote_addr)
+        request, remote_ip = bottle.request.json, bottle.request.remote_addr
+
+        if retrieve_executor is None:
+            return manager.retrieve(request=request, remote_ip=remote_ip)
+
+        return retrieve_executor.submit(manager.retrieve, request=request, remote_ip=remote_ip).result()
+
+    @app.get("/detector_jobs")
+    def get_detector_jobs():
+        return {"state": "ok",
+                "status": manager.get_status(),
+                "jobs": manager.get_detector_jobs(bottle.request.query.get("state"))}
 
     @app.error(500)
     def error_handler_500(error):
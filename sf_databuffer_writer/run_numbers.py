@@ -0,0 +1,84 @@
+import logging
+import os
+from threading import Lock
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: run numbers are then only safe within one process.
+    fcntl = None
+
+LAST_RUN_FILENAME = "LAST_RUN"
+
+
+class RunNumberAllocator(object):
+    """
+    Allocate run numbers from the LAST_RUN file of a run_info directory.
+
+    The file is read and updated under an exclusive file lock (LAST_RUN.lock), and replaced atomically (temp file +
+    rename), so concurrent allocations from different threads, processes or consoles never get the same number.
+
+    With batch_size > 1, batch_size numbers are reserved at once (LAST_RUN is set to the last reserved number) and
+    handed out from memory, so the file is accessed only once per batch. Numbers reserved but not used are lost when
+    the process stops, and concurrent allocators get interleaved batches.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size if batch_size is not None else config.RUN_NUMBER_BATCH_SIZE
+
+        if self.batch_size < 1:
+            raise ValueError("Run number batch_size must be at least 1, but it is %s." % self.batch_size)
+
+        self._lock = Lock()
+        # run_info directory -> [next run number, last reserved run number]
+        self._reserved = {}
+
+    def allocate(self, run_info_directory):
+
+        with self._lock:
+            reserved = self._reserved.get(run_info_directory)
+
+            if reserved is None or reserved[0] > reserved[1]:
+                first_run, last_run = self._reserve(run_info_directory)
+                reserved = self._reserved[run_info_directory] = [first_run, last_run]
+
+            run_number = reserved[0]
+            reserved[0] += 1
+
+        return run_number
+
+    def _reserve(self, run_info_directory):
+        last_run_file = os.path.join(run_info_directory, LAST_RUN_FILENAME)
+
+        with open(last_run_file + ".lock", "a") as lock_file:
+
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                last_run = 0
+                if os.path.exists(last_run_file):
+                    with open(last_run_file) as input_file:
+                        last_run = int(input_file.read().strip() or 0)
+
+                new_last_run = last_run + self.batch_size
+
+                temp_file = "%s.%s.tmp" % (last_run_file, os.getpid())
+                with open(temp_file, "w") as output_file:
+                    output_file.write(str(new_last_run))
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+
+                os.replace(temp_file, last_run_file)
+
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        _logger.debug("Reserved run numbers %s to %s in %s." % (last_run + 1, new_last_run, run_info_directory))
+
+        return last_run + 1, new_last_run
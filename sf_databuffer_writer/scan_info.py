@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+from time import time
+
+from sf_databuffer_writer import config
+
+_logger = logging.getLogger(__name__)
+
+# Lists of the scan_info file with one entry per scan step.
+SCAN_STEP_FIELDS = ("scan_files", "scan_readbacks", "scan_step_info", "scan_values", "scan_readbacks_raw", "pulseIds")
+
+
+def get_journal_filename(scan_info_file):
+    return os.path.splitext(scan_info_file)[0] + ".jsonl"
+
+
+def create_scan_info(request_scan_info):
+    return {"scan_files": [],
+            "scan_parameters": {"Id": request_scan_info.get("motors_pv_name"),
+                                "name": request_scan_info.get("motors_name"),
+                                "offset": request_scan_info.get("motors_offset"),
+                                "conversion_factor": request_scan_info.get("motors_coefficient")},
+            "scan_readbacks": [],
+            "scan_step_info": [],
+            "scan_values": [],
+            "scan_readbacks_raw": [],
+            "pulseIds": []}
+
+
+class ScanInfoStore(object):
+    """
+    Scan info files, with one record appended per scan step.
+
+    Each scan has a journal (<scan_name>.jsonl, JSON lines) next to its scan_info file (<scan_name>.json): a first
+    record with the scan_parameters, and a record per step. Adding a step appends one line to the journal and updates
+    the scan info kept in memory - the scan_info file is not read again.
+
+    The scan_info file, in the legacy format, is materialized from memory at most every materialize_delay seconds
+    (0 to write it at every step) by a background thread, and when flush is called. A scan_info file without a
+    journal (written before the journal existed) is imported when its scan gets a new step.
+
+    As before the journal, deleting the scan_info file of a scan resets it: the next step starts a new scan, and the
+    old journal is kept as <scan_name>.jsonl.old. The journal records when the scan_info file was first
+    materialized, to tell a deleted scan_info file from one that was not yet written.
+    """
+
+    def __init__(self, materialize_delay=None, cache_size=None):
+        self.materialize_delay = materialize_delay if materialize_delay is not None \
+            else config.SCAN_INFO_MATERIALIZE_DELAY
+        self.cache_size = cache_size if cache_size is not None else config.SCAN_INFO_CACHE_SIZE
+
+        self._condition = Condition()
+        self._write_lock = Lock()
+
+        # scan_info_file -> scan_info, of the most recently used scans.
+        self._scans = OrderedDict()
+        # scan_info_file -> time at which it has to be materialized.
+        self._pending = {}
+        # scan_info_files materialized at least once (recorded in their journal).
+        self._materialized = set()
+
+        self._materializer = Thread(target=self._materialize_periodically, daemon=True)
+        self._materializer.start()
+
+    def add_step(self, scan_info_file, request_scan_info, output_files, pulse_ids):
+
+        step = {"scan_files": output_files,
+                "scan_readbacks": request_scan_info.get("motors_readback_value", []),
+                "scan_step_info": request_scan_info.get("step_info"),
+                "scan_values": request_scan_info.get("motors_value", []),
+                "scan_readbacks_raw": request_scan_info.get("motors_readback_raw", []),
+                "pulseIds": pulse_ids}
+
+        with self._condition:
+            scan_info = self._get_scan_info(scan_info_file, request_scan_info)
+
+            self._append_records(get_journal_filename(scan_info_file), [step])
+
+            for field in SCAN_STEP_FIELDS:
+                scan_info[field].append(step[field])
+
+            self._pending.setdefault(scan_info_file, time() + self.materialize_delay)
+            self._condition.notify()
+
+        if not self.materialize_delay:
+            self._materialize(scan_info_file)
+
+    def get_scan_info(self, scan_info_file):
+        """
+        Return the current scan info (including the steps not yet materialized), or None if the scan does not exist.
+        """
+
+        with self._condition:
+            if scan_info_file not in self._scans and \
+                    not os.path.exists(get_journal_filename(scan_info_file)) and not os.path.exists(scan_info_file):
+                return None
+
+            if self._is_deleted(scan_info_file):
+                return None
+
+            return json.loads(json.dumps(self._get_scan_info(scan_info_file, {})))
+
+    def flush(self):
+        """
+        Materialize all the pending scan_info files.
+        """
+
+        with self._condition:
+            scan_info_files = list(self._pending)
+
+        for scan_info_file in scan_info_files:
+            self._materialize(scan_info_file)
+
+    def _get_scan_info(self, scan_info_file, request_scan_info):
+
+        if self._is_deleted(scan_info_file):
+            self._reset(scan_info_file)
+
+        scan_info = self._scans.get(scan_info_file)
+
+        if scan_info is None:
+            self._evict(self.cache_size - 1)
+
+            scan_info = self._load(scan_info_file, request_scan_info)
+            self._scans[scan_info_file] = scan_info
+
+            # Loading a journal can require a materialization.
+            self._condition.notify()
+
+        self._scans.move_to_end(scan_info_file)
+
+        return scan_info
+
+    def _load(self, scan_info_file, request_scan_info):
+        journal_filename = get_journal_filename(scan_info_file)
+
+        if os.path.exists(journal_filename):
+            scan_info = create_scan_info({})
+            is_materialized = False
+
+            with open(journal_filename) as input_file:
+                for line in input_file:
+
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        _logger.warning("Skipping corrupted record in scan info journal %s." % journal_filename)
+                        continue
+
+                    if "scan_parameters" in record:
+                        scan_info["scan_parameters"] = record["scan_parameters"]
+                        continue
+
+                    if "materialized" in record:
+                        is_materialized = True
+                        continue
+
+                    for field in SCAN_STEP_FIELDS:
+                        scan_info[field].append(record.get(field))
+
+            if is_materialized:
+                self._materialized.add(scan_info_file)
+
+            # The broker stopped before the scan_info file was materialized.
+            if not os.path.exists(scan_info_file) or \
+                    os.path.getmtime(scan_info_file) < os.path.getmtime(journal_filename):
+                self._pending.setdefault(scan_info_file, time())
+
+            return scan_info
+
+        if os.path.exists(scan_info_file):
+            _logger.info("Importing scan info file %s into journal %s." % (scan_info_file, journal_filename))
+
+            with open(scan_info_file) as input_file:
+                scan_info = json.load(input_file)
+
+            n_steps = len(scan_info["scan_files"])
+            steps = [{field: scan_info[field][index] if index < len(scan_info[field]) else None
+                      for field in SCAN_STEP_FIELDS} for index in range(n_steps)]
+
+        else:
+            scan_info = create_scan_info(request_scan_info)
+            steps = []
+
+        self._append_records(journal_filename, [{"scan_parameters": scan_info["scan_parameters"]}] + steps)
+
+        return scan_info
+
+    def _is_deleted(self, scan_info_file):
+        # A scan_info file is deleted if it does not exist anymore after having been materialized.
+        if os.path.exists(scan_info_file):
+            return False
+
+        if scan_info_file in self._materialized or scan_info_file in self._scans:
+            return scan_info_file in self._materialized
+
+        journal_filename = get_journal_filename(scan_info_file)
+        if not os.path.exists(journal_filename):
+            return False
+
+        with open(journal_filename) as input_file:
+            return any(line.startswith('{"materialized"') for line in input_file)
+
+    def _reset(self, scan_info_file):
+        journal_filename = get_journal_filename(scan_info_file)
+        _logger.info("Scan info file %s was deleted, starting a new scan." % scan_info_file)
+
+        self._scans.pop(scan_info_file, None)
+        self._pending.pop(scan_info_file, None)
+        self._materialized.discard(scan_info_file)
+
+        if os.path.exists(journal_filename):
+            os.replace(journal_filename, journal_filename + ".old")
+
+    def _evict(self, max_size):
+        # Scans are reloaded from the journal when needed, but pending scans have to be materialized first.
+        evictable_files = [scan_info_file for scan_info_file in self._scans if scan_info_file not in self._pending]
+
+        for scan_info_file in evictable_files[:max(0, len(self._scans) - max_size)]:
+            del self._scans[scan_info_file]
+
+    @staticmethod
+    def _append_records(journal_filename, records):
+        with open(journal_filename, "a") as journal_file:
+            journal_file.write("".join(json.dumps(record) + "\n" for record in records))
+
+    def _materialize(self, scan_info_file):
+
+        # Materializations are serialized, so an older state never overwrites a newer one.
+        with self._write_lock:
+            with self._condition:
+                if self._pending.pop(scan_info_file, None) is None:
+                    return
+
+                scan_info_json = json.dumps(self._scans[scan_info_file], indent=4)
+
+            temp_file = scan_info_file + ".tmp"
+
+            try:
+                with open(temp_file, "w") as output_file:
+                    output_file.write(scan_info_json)
+
+                os.replace(temp_file, scan_info_file)
+
+                with self._condition:
+                    if scan_info_file not in self._materialized:
+                        self._append_records(get_journal_filename(scan_info_file), [{"materialized": time()}])
+                        self._materialized.add(scan_info_file)
+
+            except Exception as e:
+                _logger.error("Cannot write scan info file %s, retrying in %s seconds: %s" %
+                              (scan_info_file, config.SCAN_INFO_RETRY_INTERVAL, e))
+
+                with self._condition:
+                    self._pending.setdefault(scan_info_file, time() + config.SCAN_INFO_RETRY_INTERVAL)
+                    self._condition.notify()
+
+    def _materialize_periodically(self):
+
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                due_time = min(self._pending.values())
+                if due_time > time():
+                    self._condition.wait(due_time - time())
+                    continue
+
+                scan_info_files = [scan_info_file for scan_info_file, scan_due_time in self._pending.items()
+                                   if scan_due_time <= time()]
+
+            for scan_info_file in scan_info_files:
+                self._materialize(scan_info_file)
@@ -0,0 +1,117 @@
+import heapq
+import logging
+from concurrent.futures import Future, BrokenExecutor
+from itertools import count
+from threading import Condition, Thread
+from time import time
+
+_logger = logging.getLogger(__name__)
+
+
+class DelayedScheduler(object):
+    """
+    Submit functions to an executor at a given time, without blocking the caller.
+
+    Scheduled functions are kept in a priority queue ordered by their due time. A single dispatcher thread waits for
+    the first one to become due and submits it to the executor.
+
+    If executor_factory is given, a broken executor (e.g. a process pool with a dead worker) is replaced with a new
+    one from executor_factory. Otherwise the functions submitted to a broken executor fail.
+    """
+
+    def __init__(self, executor, executor_factory=None):
+        self.executor = executor
+        self.executor_factory = executor_factory
+
+        self._queue = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._running = True
+
+        self._dispatcher = Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def schedule(self, due_time, function, *args, on_submit=None):
+        """
+        Run function(*args) in the executor when time() reaches due_time. on_submit, if given, is called just before.
+        Returns a Future that completes when the function finished executing.
+        """
+
+        future = Future()
+
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Cannot schedule new functions after stop.")
+
+            # The sequence number keeps the order of functions with the same due time.
+            heapq.heappush(self._queue, (due_time, next(self._sequence), future, function, args, on_submit))
+            self._condition.notify()
+
+        return future
+
+    def get_n_scheduled(self):
+        with self._condition:
+            return len(self._queue)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self._dispatcher.join()
+
+    def _dispatch(self):
+
+        with self._condition:
+            while self._running:
+
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                delay = self._queue[0][0] - time()
+
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                _, _, future, function, args, on_submit = heapq.heappop(self._queue)
+                self._submit(future, function, args, on_submit)
+
+    def _submit(self, future, function, args, on_submit):
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        if on_submit is not None:
+            try:
+                on_submit()
+            except Exception as e:
+                _logger.error("Error in the on_submit callback of a scheduled function: %s" % e)
+
+        def copy_result(executor_future):
+            if executor_future.exception() is not None:
+                future.set_exception(executor_future.exception())
+            else:
+                future.set_result(executor_future.result())
+
+        try:
+            try:
+                executor_future = self.executor.submit(function, *args)
+
+            except BrokenExecutor as e:
+                if self.executor_factory is None:
+                    raise
+
+                _logger.error("Executor is broken (%s). Replacing it with a new one." % e)
+
+                self.executor.shutdown(wait=False)
+                self.executor = self.executor_factory()
+
+                executor_future = self.executor.submit(function, *args)
+
+            executor_future.add_done_callback(copy_result)
+
+        except Exception as e:
+            _logger.error("Cannot submit scheduled function to the executor: %s" % e)
+            future.set_exception(e)
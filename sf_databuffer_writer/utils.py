@@ -1,13 +1,17 @@
+import codecs
 import copy
 import json
+import re
+import tempfile
 from copy import deepcopy
 from logging import getLogger
 from time import time
 
 from datetime import datetime
-import requests
 
-from sf_databuffer_writer import config
+import numpy
+
+from sf_databuffer_writer import config, http_session, mapping
 
 _logger = getLogger(__name__)
 
@@ -62,6 +66,81 @@ def get_separate_writer_requests(channels, parameters, start_pulse_id, stop_puls
                 new_parameters["output_file"] = new_parameters["output_file"][:-3] + ".IMAGES.h5"
         yield get_writer_request(camera_channels, new_parameters, start_pulse_id, stop_pulse_id)
 
+def split_data_api_request(data_api_request, pulse_id_window=None, channels_per_query=None):
+    """
+    Split a data api request into sub-requests covering at most pulse_id_window pulses and channels_per_query channels.
+
+    The sub-requests are ordered by channel group and then by pulse_id, so appending their responses in order keeps
+    the data of each channel sorted by pulse_id. Only pulse_id ranges can be split by window.
+    """
+
+    channels = data_api_request["channels"]
+    if channels_per_query:
+        channel_groups = [channels[i:i + channels_per_query] for i in range(0, len(channels), channels_per_query)]
+    else:
+        channel_groups = [channels]
+
+    data_range = data_api_request["range"]
+    if pulse_id_window and "startPulseId" in data_range and "endPulseId" in data_range:
+        # Pulse_id ranges are inclusive on both ends.
+        ranges = [{"startPulseId": start_pulse_id,
+                   "endPulseId": min(start_pulse_id + pulse_id_window - 1, data_range["endPulseId"])}
+                  for start_pulse_id in range(data_range["startPulseId"], data_range["endPulseId"] + 1,
+                                              pulse_id_window)]
+    else:
+        ranges = [data_range]
+
+    sub_requests = []
+    for channel_group in channel_groups:
+        for sub_range in ranges:
+            sub_request = deepcopy(data_api_request)
+            sub_request["channels"] = deepcopy(channel_group)
+            sub_request["range"] = deepcopy(sub_range)
+
+            sub_requests.append(sub_request)
+
+    return sub_requests
+
+
+def merge_data_api_responses(responses):
+    """
+    Merge the responses of sub-requests (in the order returned by split_data_api_request) into one response.
+    """
+
+    merged_channels = {}
+
+    for response in responses:
+        for channel_data in response:
+            name = channel_data["channel"]["name"]
+
+            if name not in merged_channels:
+                merged_channels[name] = channel_data
+                continue
+
+            merged_channel = merged_channels[name]
+            if not merged_channel.get("configs"):
+                merged_channel["configs"] = channel_data.get("configs")
+
+            merged_data = merged_channel["data"]
+            new_data = channel_data["data"]
+
+            if not merged_data:
+                merged_channel["data"] = new_data
+                continue
+
+            # Drop events repeated at the border of the sub-ranges (the events are sorted by pulse_id).
+            last_pulse_id = merged_data[-1]["pulseId"]
+            n_repeated = 0
+
+            while n_repeated < len(new_data) and new_data[n_repeated]["pulseId"] <= last_pulse_id:
+                n_repeated += 1
+
+            if n_repeated < len(new_data):
+                merged_data.extend(new_data[n_repeated:])
+
+    return list(merged_channels.values())
+
+
 def verify_channels(input_channels):
     _logger.info("Verifying limit of max %d bsread channels." % config.BROKER_CHANNELS_LIMIT)
 
@@ -86,18 +165,38 @@ def transform_range_from_pulse_id_to_timestamp(data_api_request):
 
     try:
 
-        mapping_request = {'range': {'startPulseId': data_api_request["range"]["startPulseId"],
-                                     'endPulseId': data_api_request["range"]["endPulseId"]+1}}
+        start_pulse_id = data_api_request["range"]["startPulseId"]
+        end_pulse_id = data_api_request["range"]["endPulseId"] + 1
 
-        mapping_response = requests.post(url=config.DATA_API_QUERY_ADDRESS + "/mapping", json=mapping_request).json()
+        mapping_cache = mapping.get_mapping_cache() if config.PULSE_ID_MAPPING_CACHE_SIZE else None
+        cached_mapping = mapping_cache.get(start_pulse_id, end_pulse_id) if mapping_cache else None
 
-        _logger.info("Response to mapping request: %s", mapping_response)
+        if cached_mapping is not None:
+            start_seconds, end_seconds = cached_mapping
+
+            _logger.info("Mapping of pulse_ids %s-%s taken from cache. Cache statistics: %s" %
+                         (start_pulse_id, end_pulse_id, mapping_cache.get_statistics()))
+
+        else:
+            mapping_request = {'range': {'startPulseId': start_pulse_id,
+                                         'endPulseId': end_pulse_id}}
+
+            mapping_response = http_session.post(url=config.DATA_API_QUERY_ADDRESS + "/mapping",
+                                                 json=mapping_request).json()
+
+            _logger.info("Response to mapping request: %s", mapping_response)
+
+            start_seconds = mapping_response[0]["start"]["globalSeconds"]
+            end_seconds = mapping_response[0]["end"]["globalSeconds"]
+
+            if mapping_cache:
+                mapping_cache.put(start_pulse_id, end_pulse_id, start_seconds, end_seconds)
 
         del new_data_api_request["range"]["startPulseId"]
-        new_data_api_request["range"]["startSeconds"] = mapping_response[0]["start"]["globalSeconds"]
+        new_data_api_request["range"]["startSeconds"] = start_seconds
 
         del new_data_api_request["range"]["endPulseId"]
-        new_data_api_request["range"]["endSeconds"] = mapping_response[0]["end"]["globalSeconds"]
+        new_data_api_request["range"]["endSeconds"] = end_seconds
 
         _logger.info("Transformed request to startSeconds and endSeconds. %s" % new_data_api_request)
 
@@ -130,30 +229,324 @@ def get_timestamp_range_from_api_request(data_api_request, request_timestamp):
     return start_date, end_date
 
 
-def filter_unwanted_pulse_ids(json_data, start_pulse_id, stop_pulse_id):
-    def get_index_from_pulse_id(name, data, target_pulse_id, direction=1):
-        for index, pulse_id in ((i, d["pulseId"]) for i, d in enumerate(data[::direction])):
-            if direction == 1 and pulse_id >= target_pulse_id:
-                return index
+def get_pulse_id_range_indexes(name, pulse_ids, start_pulse_id, stop_pulse_id):
+    """
+    Return the [start_index, stop_index) slice of the sorted pulse_ids array with pulse ids in the
+    [start_pulse_id, stop_pulse_id] range.
+    """
+
+    start_index = int(numpy.searchsorted(pulse_ids, start_pulse_id, side="left"))
+    if start_index == len(pulse_ids):
+        raise ValueError("Pulse id %s not found in channel %s." % (start_pulse_id, name))
 
-            elif direction == -1 and pulse_id <= target_pulse_id:
-                return len(data) - index - 1
+    stop_index = int(numpy.searchsorted(pulse_ids, stop_pulse_id, side="right"))
+    if stop_index == 0:
+        raise ValueError("Pulse id %s not found in channel %s." % (stop_pulse_id, name))
 
-        raise ValueError("Pulse id %s not found in channel %s." % (target_pulse_id, name))
+    return start_index, stop_index
+
+
+def filter_unwanted_pulse_ids(json_data, start_pulse_id, stop_pulse_id):
 
     start_time = time()
+    n_removed_data_points = 0
+
     for channel_data in json_data:
         try:
 
             channel_name = channel_data["channel"]["name"]
             data = channel_data["data"]
 
-            start_index = get_index_from_pulse_id(channel_name, data, start_pulse_id)
-            stop_index = get_index_from_pulse_id(channel_name, data, stop_pulse_id, direction=-1)
+            pulse_ids = numpy.fromiter((data_point["pulseId"] for data_point in data), dtype="<i8", count=len(data))
 
-            data[:] = data[start_index:stop_index + 1]
+            start_index, stop_index = get_pulse_id_range_indexes(channel_name, pulse_ids,
+                                                                 start_pulse_id, stop_pulse_id)
+
+            if start_index > 0 or stop_index < len(data):
+                n_removed_data_points += len(data) - (stop_index - start_index)
+                channel_data["data"] = data[start_index:stop_index]
 
         except Exception as e:
-            _logger.error("Data filtering could not be done. Exception: ", e)
+            _logger.error("Data filtering could not be done. Exception: %s" % e)
+
+    _logger.info("Filtering pulse_ids of %d channels (%d data points removed) took %s seconds." %
+                 (len(json_data), n_removed_data_points, time() - start_time))
+
+
+_JSON_WHITESPACE = " \t\n\r"
+_JSON_STRUCTURE = re.compile(r'[\[\]{}"]')
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class _JSONStreamReader(object):
+    """
+    Read JSON tokens and values incrementally from an iterable of byte chunks.
+
+    Only the data not yet consumed is kept in the buffer. Decoding a value is retried only when the buffer doubles,
+    otherwise big values would be re-parsed for every chunk.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+        self.buffer = ""
+        self.position = 0
+        self.end_of_stream = False
+
+    def _read(self, required_length):
+        """
+        Read chunks until at least required_length characters are not consumed (or until the end of stream).
+        Returns False if nothing more could be read.
+        """
+
+        pending_chunks = []
+        initial_length = pending_length = len(self.buffer) - self.position
+
+        while pending_length < required_length and not self.end_of_stream:
+            chunk = next(self.chunks, None)
+
+            if chunk is None:
+                self.end_of_stream = True
+                chunk = self.text_decoder.decode(b"", final=True)
+            else:
+                chunk = self.text_decoder.decode(chunk)
+
+            pending_chunks.append(chunk)
+            pending_length += len(chunk)
+
+        self.buffer = self.buffer[self.position:] + "".join(pending_chunks)
+        self.position = 0
+
+        return len(self.buffer) > initial_length
+
+    def peek(self):
+        """
+        Return the next character that is not whitespace (without consuming it), or None at the end of stream.
+        """
+
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _JSON_WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self._read(1):
+                return None
+
+    def expect(self, character, error_message):
+        if self.peek() != character:
+            raise ValueError(error_message % self.buffer[self.position:self.position + 100])
+
+        self.position += 1
+
+    def read_value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+
+            except ValueError:
+                if not self._read(2 * (len(self.buffer) - self.position)):
+                    raise
+
+                continue
+
+            # A number or literal is complete only when it is followed by a delimiter: a number split between
+            # chunks (at the decimal point or the exponent for example) would otherwise be decoded too early.
+            if not isinstance(value, (dict, list, str)):
+                next_position = end
+                while next_position < len(self.buffer) and self.buffer[next_position] in _JSON_WHITESPACE:
+                    next_position += 1
+
+                if next_position == len(self.buffer) or self.buffer[next_position] not in ",]}":
+                    if not self._read(len(self.buffer) - self.position + 1):
+                        raise ValueError("Invalid JSON value: %s" % self.buffer[self.position:next_position + 1])
+
+                    continue
+
+            self.position = end
+
+            return value
+
+    def read_raw_value(self):
+        """
+        Return the text of the next object or array, without decoding it.
+        """
+
+        if self.peek() not in ("{", "["):
+            return json.dumps(self.read_value())
+
+        depth = 0
+        in_string = False
+        scan_position = self.position
+
+        while True:
+            match = (_JSON_STRING_SPECIAL if in_string else _JSON_STRUCTURE).search(self.buffer, scan_position)
+
+            # An escape sequence split between chunks is scanned again when the rest has been read.
+            if match is None or (match.group() == "\\" and match.end() == len(self.buffer)):
+                scan_offset = (match.start() if match else len(self.buffer)) - self.position
+
+                if not self._read(2 * (len(self.buffer) - self.position) + 1):
+                    raise ValueError("Truncated JSON value received.")
+
+                scan_position = self.position + scan_offset
+                continue
+
+            character = match.group()
+            scan_position = match.end()
+
+            if character == "\\":
+                scan_position += 1
+            elif character == '"':
+                in_string = not in_string
+            elif character in "[{":
+                depth += 1
+            else:
+                depth -= 1
+
+                if depth == 0:
+                    value = self.buffer[self.position:scan_position]
+                    self.position = scan_position
+
+                    return value
+
+    def iterate_array(self, error_message, raw=False):
+        """
+        Iterate over the values of the array starting at the current position. With raw, the values are returned
+        as text, without decoding them.
+        """
+
+        self.expect("[", error_message)
+
+        while True:
+            character = self.peek()
+
+            if character is None:
+                raise ValueError("Truncated JSON array received.")
+
+            if character == "]":
+                self.position += 1
+                return
+
+            if character == ",":
+                self.position += 1
+                continue
+
+            yield self.read_raw_value() if raw else self.read_value()
+
+
+def iterate_json_array(chunks):
+    """
+    Decode a JSON array incrementally from an iterable of byte chunks, yielding one element at a time.
+
+    Only the element currently being decoded is kept in memory, so big responses can be processed while they are
+    still being downloaded. Raises ValueError if the document is not a JSON array or if it is truncated.
+    """
+
+    return _JSONStreamReader(chunks).iterate_array("Expected a JSON array, but received: %s")
+
+
+def iterate_json_channel_parts(chunks):
+    """
+    Decode a json data api response incrementally, yielding the channels in parts of one event.
+
+    Each part has the structure of a channel ({"channel": ..., "configs": ..., "data": [event]}), and every channel
+    has at least one part (with empty data if it has no events). Only the event currently being decoded is kept in
+    memory. If the data of a channel comes before its configs, its events are spooled undecoded and yielded once the
+    configs have been received.
+    """
+
+    reader = _JSONStreamReader(chunks)
+    reader.expect("[", "Expected a JSON array, but received: %s")
+
+    while True:
+        character = reader.peek()
+
+        if character is None:
+            raise ValueError("Truncated JSON array received.")
+
+        if character == "]":
+            return
+
+        if character == ",":
+            reader.position += 1
+            continue
+
+        reader.expect("{", "Expected a channel object, but received: %s")
+
+        channel_data = {}
+        spooled_events = None
+        n_parts = 0
+
+        while True:
+            character = reader.peek()
+
+            if character is None:
+                raise ValueError("Truncated JSON array received.")
+
+            if character == "}":
+                reader.position += 1
+                break
+
+            if character == ",":
+                reader.position += 1
+                continue
+
+            key = reader.read_value()
+            reader.expect(":", "Expected ':' after a channel key, but received: %s")
+
+            if key != "data":
+                channel_data[key] = reader.read_value()
+
+            elif "channel" in channel_data and "configs" in channel_data:
+                for event in reader.iterate_array("Expected a data array, but received: %s"):
+                    n_parts += 1
+                    yield dict(channel_data, data=[event])
+
+            else:
+                _logger.debug("Channel data received before its configs, spooling the events.")
+                spooled_events = _spool_json_array(reader)
+
+        if spooled_events is not None:
+            for event in _iterate_spooled_json_array(*spooled_events):
+                n_parts += 1
+                yield dict(channel_data, data=[event])
+
+        if n_parts == 0:
+            yield dict(channel_data, data=[])
+
+
+def _spool_json_array(reader):
+    """
+    Copy the text of the values of the array at the current position of the reader to a spooled temporary file.
+    Returns the file and the lengths of the values.
+    """
+
+    spool_file = tempfile.SpooledTemporaryFile(max_size=config.DATA_API_STREAM_SPOOL_SIZE, mode="w+",
+                                               encoding="utf-8")
+    value_lengths = []
+
+    try:
+        for value in reader.iterate_array("Expected a data array, but received: %s", raw=True):
+            spool_file.write(value)
+            value_lengths.append(len(value))
+
+    except:
+        spool_file.close()
+        raise
+
+    return spool_file, value_lengths
+
+
+def _iterate_spooled_json_array(spool_file, value_lengths):
+
+    with spool_file:
+        spool_file.seek(0)
 
-    _logger.info("Filtering pulse_ids took %s seconds." % (time() - start_time))
+        for value_length in value_lengths:
+            yield json.loads(spool_file.read(value_length))
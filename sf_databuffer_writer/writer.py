@@ -2,14 +2,19 @@ import argparse
 import logging
 import os
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
+from threading import BoundedSemaphore
 from time import time, sleep
 
-import requests
 from bsread import source, PULL
 
-from sf_databuffer_writer import config, utils
-from sf_databuffer_writer.writer_format import DataBufferH5Writer, CompactDataBufferH5Writer
+from sf_databuffer_writer import config, utils, http_session, response_format
+from sf_databuffer_writer.journal import RequestJournal
+from sf_databuffer_writer.pipeline import RequestPipeline
+from sf_databuffer_writer.scheduler import DelayedScheduler
+from sf_databuffer_writer.writer_format import DataBufferH5Writer, CompactDataBufferH5Writer, ImageDataBufferH5Writer
 
 _logger = logging.getLogger(__name__)
 
@@ -54,7 +59,7 @@ def audit_failed_write_request(data_api_request, parameters, timestamp):
         _logger.error("Error while trying to write request %s to file %s." % (write_request, filename), e)
 
 
-def write_data_to_file(parameters, json_data):
+def write_data_to_file(parameters, json_data, release_input=False):
     
     if not parameters:
         raise ValueError("Received parameters from broker are empty. parameters=%s" % parameters)
@@ -69,19 +74,55 @@ def write_data_to_file(parameters, json_data):
     else:
         writer = DataBufferH5Writer(output_file, parameters)
 
-    writer.write_data(json_data)
-    writer.close()
+    # The file is closed also if the data (possibly still being streamed) cannot be written entirely.
+    try:
+        writer.write_data(json_data, release_input=release_input)
+    finally:
+        writer.close()
+
+
+def get_data_from_buffer(data_api_request, pulse_id_window=None, channels_per_query=None):
+    """
+    Get the data from the data api.
+
+    If pulse_id_window or channels_per_query are set (defaults in config), the request is split in smaller queries
+    by pulse_id range and channel group. The queries are executed in parallel and merged in pulse_id order.
+    """
+
+    if pulse_id_window is None:
+        pulse_id_window = config.DATA_API_QUERY_PULSE_ID_WINDOW
+
+    if channels_per_query is None:
+        channels_per_query = config.DATA_API_QUERY_CHANNELS_LIMIT
+
+    sub_requests = utils.split_data_api_request(data_api_request, pulse_id_window, channels_per_query)
+
+    if len(sub_requests) == 1:
+        return query_data_api(data_api_request)
 
+    _logger.info("Loading data for range %s in %d queries (pulse_id_window=%s, channels_per_query=%s)." %
+                 (data_api_request["range"], len(sub_requests), pulse_id_window, channels_per_query))
 
-def get_data_from_buffer(data_api_request):
+    n_workers = min(config.DATA_API_QUERY_N_WORKERS, len(sub_requests))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        responses = list(executor.map(query_data_api, sub_requests))
+
+    data = utils.merge_data_api_responses(data for data, _ in responses)
+    data_len = sum(data_len for _, data_len in responses)
+
+    return data, data_len
+
+
+def query_data_api(data_api_request):
 
     _logger.info("Loading data for range: %s" % data_api_request["range"])
 
     _logger.debug("Data API request: %s", data_api_request)
 
-    response = requests.post(url=config.DATA_API_QUERY_ADDRESS, json=data_api_request)
+    response = http_session.post(url=config.DATA_API_QUERY_ADDRESS, json=data_api_request)
 
-    data, data_len = json.loads(response.content), len(response.content)
+    data, data_len = response_format.decode_response(response.content, data_api_request), len(response.content)
 
     if not data:
         raise ValueError("Received data from data_api is empty. data=%s" % data)
@@ -95,6 +136,93 @@ def get_data_from_buffer(data_api_request):
     
     return data, data_len
 
+
+def stream_data_from_buffer(data_api_request, url=None, channel_parts=False):
+    """
+    Iterate over the channels of the data api response while it is still being downloaded.
+
+    The response is decoded incrementally, so at most one channel is kept in memory and the channels can be written
+    to disk while the rest of the response is still arriving. With channel_parts, the channels are yielded in parts
+    of one event (see response_format.iterate_response_channel_parts), so at most one event is kept in memory.
+    """
+
+    if url is None:
+        url = config.DATA_API_QUERY_ADDRESS
+
+    _logger.info("Streaming data for range: %s" % data_api_request["range"])
+
+    _logger.debug("Data API request: %s", data_api_request)
+
+    response = http_session.post(url=url, json=data_api_request, stream=True)
+
+    iterate_channels = response_format.iterate_response_channel_parts if channel_parts \
+        else response_format.iterate_response_channels
+
+    n_channels = 0
+    data_len = 0
+
+    def iterate_content():
+        nonlocal data_len
+
+        for chunk in response.iter_content(chunk_size=config.DATA_API_STREAM_CHUNK_SIZE):
+            data_len += len(chunk)
+            yield chunk
+
+    try:
+        for channel_data in iterate_channels(iterate_content(), data_api_request):
+            n_channels += 1
+            yield channel_data
+    finally:
+        response.close()
+
+    if n_channels == 0:
+        raise ValueError("Received data from data_api is empty. data=[]")
+
+    _logger.info("Streamed %d channels%s (%d bytes) from the data api." %
+                 (n_channels, " parts" if channel_parts else "", data_len))
+
+
+def write_images_to_file(data_api_request, parameters):
+    """
+    Retrieve image channels from the data api in pulse_id windows and append the frames to the output file as they
+    arrive. The responses are decoded frame by frame, so at most one frame is kept in memory.
+
+    data_api_request must have a pulse_id range. If TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY is set, each window is
+    transformed to a timestamp range before it is queried.
+    """
+
+    output_file = parameters["output_file"]
+    data_range = data_api_request["range"]
+
+    sub_requests = utils.split_data_api_request(data_api_request, config.IMAGE_QUERY_PULSE_ID_WINDOW)
+    n_expected_frames = data_range["endPulseId"] - data_range["startPulseId"] + 1
+
+    _logger.info("Retrieving images for range %s in %d windows to file %s." %
+                 (data_range, len(sub_requests), output_file))
+
+    writer = ImageDataBufferH5Writer(output_file, parameters, n_expected_frames)
+    start_time = time()
+
+    try:
+        for window_index, sub_request in enumerate(sub_requests):
+
+            if config.TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY:
+                sub_request = utils.transform_range_from_pulse_id_to_timestamp(sub_request)
+
+            writer.write_data(stream_data_from_buffer(sub_request, url=config.IMAGE_DATA_API_QUERY_ADDRESS,
+                                                      channel_parts=True))
+
+            n_frames, n_bytes = writer.get_n_frames(), writer.get_n_bytes()
+            elapsed_time = time() - start_time
+
+            _logger.info("Image retrieval progress: %d/%d windows, %d frames (%.1f MB) in %.1f seconds (%.1f MB/s)." %
+                         (window_index + 1, len(sub_requests), n_frames, n_bytes / 2**20, elapsed_time,
+                          n_bytes / 2**20 / elapsed_time if elapsed_time else 0))
+
+    finally:
+        writer.close()
+
+
 def get_and_write_data_by_api3(data_api_request_pulseid, parameters):
     import data_api3.h5 as h5
     import pytz
@@ -121,64 +249,152 @@ def get_and_write_data_by_api3(data_api_request_pulseid, parameters):
 
     h5.request(query, filename, url=config.IMAGE_API_QUERY_ADDRESS)
 
-def process_message(message, data_retrieval_delay):
-    data_api_request = None
-    parameters = None
-    request_timestamp = None
+def parse_message(message):
+    data_api_request = json.loads(message.data.data["data_api_request"].value)
+    parameters = json.loads(message.data.data["parameters"].value)
+    request_timestamp = message.data.data["timestamp"].value
 
-    try:
-        data_api_request = json.loads(message.data.data["data_api_request"].value)
-        parameters = json.loads(message.data.data["parameters"].value)
+    return data_api_request, parameters, request_timestamp
 
+
+def retrieve_request(data_api_request, parameters, request_timestamp):
+    """
+    Retrieval stage of a request.
+
+    Returns the arguments of write_request (the function that writes the retrieved data, and the request to audit
+    if it fails), None if there is nothing to write, or False if the retrieval failed. Streamed, image and data_api3 requests retrieve the data
+    while writing it, so they are retrieved entirely in the write stage.
+    """
+
+    try:
         output_file = parameters["output_file"]
-        _logger.info("Received request to write file %s from startPulseId=%s to endPulseId=%s" % (
-            output_file,
-            data_api_request["range"]["startPulseId"],
-            data_api_request["range"]["endPulseId"]))
+        _logger.info("Received request to write file %s for range %s" % (output_file, data_api_request["range"]))
 
-        if config.TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY:
+        channels = data_api_request.get("channels") or []
+        is_image_request = bool(channels) and channels[0]["backend"] == 'sf-imagebuffer'
+
+        # The native image retrieval splits the request in pulse_id windows, and transforms each window. Requests
+        # replayed from .err files can already have a time range.
+        if config.TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY and "startPulseId" in data_api_request["range"] and \
+                not (is_image_request and config.IMAGE_RETRIEVAL_NATIVE):
             data_api_request = utils.transform_range_from_pulse_id_to_timestamp(data_api_request)
 
+        data_api_request = response_format.set_response_options(data_api_request, parameters)
+
         if output_file == "/dev/null":
             _logger.info("Output file set to /dev/null. Skipping request.")
-            return
-
-        request_timestamp = message.data.data["timestamp"].value
-        current_timestamp = time()
-        # sleep time = target sleep time - time that has already passed.
-        adjusted_retrieval_delay = data_retrieval_delay - (current_timestamp - request_timestamp)
-
-        if adjusted_retrieval_delay < 0:
-            adjusted_retrieval_delay = 0
+            return None
 
-        _logger.info("Request timestamp=%s, current_timestamp=%s, adjusted_retrieval_delay=%s." %
-                     (request_timestamp, current_timestamp, adjusted_retrieval_delay))
-
-        _logger.info("Sleeping for %s seconds before calling the data api." % adjusted_retrieval_delay)
-        sleep(adjusted_retrieval_delay)
-        _logger.info("Sleeping finished. Retrieving data.")
+        write_function = None
 
         start_time = time()
         if 'channels' in data_api_request and len(data_api_request['channels']) > 0:
-            if data_api_request['channels'][0]['backend'] != 'sf-imagebuffer':
+            if data_api_request['channels'][0]['backend'] != 'sf-imagebuffer' and config.DATA_API_STREAM_RESPONSE:
+                write_function = partial(write_data_to_file, parameters, stream_data_from_buffer(data_api_request))
+
+            elif data_api_request['channels'][0]['backend'] != 'sf-imagebuffer':
                 data, data_len = get_data_from_buffer(data_api_request)
                 _logger.info("Data retrieval (%d bytes) took %s seconds." % (data_len, time() - start_time))
 
-                start_time = time()
-                write_data_to_file(parameters, data)
-                _logger.info("Data writing took %s seconds." % (time() - start_time))
+                # Channels are removed from data while they are written, to release their memory.
+                write_function = partial(write_data_to_file, parameters, data, release_input=True)
+
+            elif config.IMAGE_RETRIEVAL_NATIVE:
+                write_function = partial(write_images_to_file, data_api_request, parameters)
+
             else:
-                get_and_write_data_by_api3(data_api_request, parameters)
-                _logger.info("Data writing took %s seconds. (DATA_API3)" % (time() - start_time))
+                write_function = partial(get_and_write_data_by_api3, data_api_request, parameters)
                 #_logger.info("No Image retrieval currently")
 
+        if write_function is None:
+            return None
+
+        return write_function, data_api_request, parameters, request_timestamp
+
+    except:
+        audit_failed_write_request(data_api_request, parameters, request_timestamp)
+
+        _logger.exception("Error while trying to write a requested data range.")
+
+        return False
+
+
+def write_request(write_function, data_api_request, parameters, request_timestamp):
+    """
+    Write stage of a request. Returns True if the data was written.
+    """
+
+    try:
+        start_time = time()
+        write_function()
+        _logger.info("Data writing took %s seconds." % (time() - start_time))
+
+        return True
+
     except:
         audit_failed_write_request(data_api_request, parameters, request_timestamp)
 
         _logger.exception("Error while trying to write a requested data range.")
 
+        return False
+
+
+def process_request(data_api_request, parameters, request_timestamp):
+    """
+    Returns False if the request failed (and was audited in the .err file).
+    """
+
+    retrieved_request = retrieve_request(data_api_request, parameters, request_timestamp)
+
+    if not retrieved_request:
+        return retrieved_request is None
+
+    return write_request(*retrieved_request)
+
+
+def process_message(message, data_retrieval_delay):
+    """
+    Process a write request message in the calling thread. process_requests schedules the requests at the end of
+    their data retrieval delay instead, so only here the delay is waited before the retrieval.
+    """
+
+    try:
+        data_api_request, parameters, request_timestamp = parse_message(message)
+    except:
+        _logger.exception("Cannot parse the write request message.")
+        return
+
+    current_timestamp = time()
+    # sleep time = target sleep time - time that has already passed.
+    adjusted_retrieval_delay = data_retrieval_delay - (current_timestamp - request_timestamp)
+
+    if adjusted_retrieval_delay < 0:
+        adjusted_retrieval_delay = 0
+
+    _logger.info("Request timestamp=%s, current_timestamp=%s, adjusted_retrieval_delay=%s." %
+                 (request_timestamp, current_timestamp, adjusted_retrieval_delay))
+
+    _logger.info("Sleeping for %s seconds before calling the data api." % adjusted_retrieval_delay)
+    sleep(adjusted_retrieval_delay)
+    _logger.info("Sleeping finished. Retrieving data.")
+
+    process_request(data_api_request, parameters, request_timestamp)
+
+
+def get_executor(n_workers, worker_type):
+
+    if worker_type == "thread":
+        return ThreadPoolExecutor(max_workers=n_workers)
+
+    if worker_type == "process":
+        return ProcessPoolExecutor(max_workers=n_workers)
+
+    raise ValueError("Unknown worker_type '%s'. Supported: thread, process." % worker_type)
+
 
-def process_requests(stream_address, receive_timeout=None, mode=PULL, data_retrieval_delay=None):
+def process_requests(stream_address, receive_timeout=None, mode=PULL, data_retrieval_delay=None,
+                     n_workers=None, worker_type=None, max_pending_requests=None, pipeline_queue_length=None,
+                     journal_file=None):
 
     if receive_timeout is None:
         receive_timeout = config.DEFAULT_RECEIVE_TIMEOUT
@@ -186,6 +402,25 @@ def process_requests(stream_address, receive_timeout=None, mode=PULL, data_retri
     if data_retrieval_delay is None:
         data_retrieval_delay = config.DEFAULT_DATA_RETRIEVAL_DELAY
 
+    if n_workers is None:
+        n_workers = config.DEFAULT_N_WORKERS
+
+    if worker_type is None:
+        worker_type = config.DEFAULT_WORKER_TYPE
+
+    if max_pending_requests is None:
+        max_pending_requests = config.DEFAULT_MAX_PENDING_REQUESTS
+
+    if pipeline_queue_length is None:
+        pipeline_queue_length = config.DEFAULT_PIPELINE_QUEUE_LENGTH
+
+    if journal_file is None:
+        journal_file = config.DEFAULT_WRITER_JOURNAL_FILE
+
+    if pipeline_queue_length > 0 and worker_type != "thread":
+        raise ValueError("The request pipeline (pipeline_queue_length=%s) requires worker_type 'thread'." %
+                         pipeline_queue_length)
+
     source_host, source_port = stream_address.rsplit(":", maxsplit=1)
 
     source_host = source_host.split("//")[1]
@@ -193,19 +428,113 @@ def process_requests(stream_address, receive_timeout=None, mode=PULL, data_retri
 
     _logger.info("Connecting to broker host %s:%s." % (source_host, source_port))
     _logger.info("Using data_retrieval_delay=%s seconds." % data_retrieval_delay)
+    _logger.info("Using n_workers=%s, worker_type=%s, max_pending_requests=%s and pipeline_queue_length=%s." %
+                 (n_workers, worker_type, max_pending_requests, pipeline_queue_length))
+    _logger.info("Using journal_file=%s." % journal_file)
+
+    # Accepted requests are journaled until they are processed, to replay them if the writer stops before.
+    journal = RequestJournal(journal_file) if journal_file else None
+
+    # Requests received from the broker, but not yet processed (waiting for the retrieval delay or being processed).
+    pending_requests = BoundedSemaphore(max_pending_requests)
+
+    # The workers retrieve the requests, and a single pipeline thread writes them while the next ones are retrieved.
+    pipeline = None
+    if pipeline_queue_length > 0:
+        pipeline = RequestPipeline(retrieve_request, write_request, n_workers, pipeline_queue_length,
+                                   on_done=pending_requests.release)
+
+    def request_done(journal_id, future):
+
+        # Pipelined requests are done only when the pipeline writes them.
+        if pipeline is None or future.exception() is not None:
+            pending_requests.release()
+
+        # process_request handles its own errors, this happens only if a worker process dies.
+        if future.exception() is not None:
+            _logger.error("Worker failed while processing a request: %s" % future.exception())
+
+        # Requests of dead workers stay in the journal, to be replayed on restart.
+        elif pipeline is None and journal_id is not None:
+            journal.done(journal_id)
+
+    def schedule_request(scheduler, data_api_request, parameters, request_timestamp, journal_id):
+
+        due_time = request_timestamp + data_retrieval_delay
+        _logger.info("Scheduling request for output_file %s at %s (%d requests scheduled)." %
+                     (parameters.get("output_file"), datetime.fromtimestamp(due_time),
+                      scheduler.get_n_scheduled() + 1))
+
+        process_function = process_request
 
-    with source(host=source_host, port=source_port, mode=mode, receive_timeout=receive_timeout) as input_stream:
+        if pipeline is not None:
+            on_written = partial(journal.done, journal_id) if journal_id is not None else None
+            process_function = partial(pipeline.process_request, on_written=on_written)
+
+        # Each start is journaled, to stop replaying requests that keep stopping the writer.
+        on_submit = partial(journal.started, journal_id) if journal_id is not None else None
+
+        future = scheduler.schedule(due_time, process_function, data_api_request, parameters, request_timestamp,
+                                    on_submit=on_submit)
+        future.add_done_callback(partial(request_done, journal_id))
+
+    executor_factory = partial(get_executor, n_workers, worker_type)
+
+    # Requests are dispatched to the workers when their retrieval delay expires, so the receiving never waits.
+    # If a worker process dies, its requests fail (and stay in the journal) and the process pool is recreated.
+    scheduler = DelayedScheduler(executor_factory(), executor_factory=executor_factory)
+
+    try:
+        with source(host=source_host, port=source_port, mode=mode, receive_timeout=receive_timeout) as input_stream:
+
+            if journal is not None:
+                unfinished_requests = journal.get_unfinished()
+                _logger.info("Replaying %s unfinished requests from the journal." % len(unfinished_requests))
+
+                for journal_id, data_api_request, parameters, request_timestamp in unfinished_requests:
+
+                    n_attempts = journal.get_attempts(journal_id)
+                    if n_attempts >= config.WRITER_JOURNAL_MAX_ATTEMPTS:
+                        _logger.error("Request for output_file %s was started %s times without completing. "
+                                      "Not replaying it." % (parameters.get("output_file"), n_attempts))
+
+                        audit_failed_write_request(data_api_request, parameters, request_timestamp)
+                        journal.done(journal_id)
+                        continue
+
+                    pending_requests.acquire()
+                    schedule_request(scheduler, data_api_request, parameters, request_timestamp, journal_id)
+
+            while True:
+                # When all the slots are taken, the requests stay in the zmq queue (back-pressure to the broker).
+                pending_requests.acquire()
 
-        while True:
                 message = input_stream.receive()
 
                 if message is None:
+                    pending_requests.release()
                     continue
 
-                process_message(message, data_retrieval_delay)
+                try:
+                    data_api_request, parameters, request_timestamp = parse_message(message)
+                except:
+                    _logger.exception("Cannot parse the write request message.")
+                    pending_requests.release()
+                    continue
+
+                journal_id = None
+                if journal is not None:
+                    journal_id = journal.accept(data_api_request, parameters, request_timestamp)
+
+                schedule_request(scheduler, data_api_request, parameters, request_timestamp, journal_id)
+
+    finally:
+        scheduler.stop()
+        scheduler.executor.shutdown()
 
 
-def start_server(stream_address, user_id=-1, data_retrieval_delay=None):
+def start_server(stream_address, user_id=-1, data_retrieval_delay=None, n_workers=None, worker_type=None,
+                 max_pending_requests=None, pipeline_queue_length=None, journal_file=None):
 
     if user_id != -1:
         _logger.info("Setting bsread writer uid and gid to %s.", user_id)
@@ -215,7 +544,9 @@ def start_server(stream_address, user_id=-1, data_retrieval_delay=None):
     else:
         _logger.info("Not changing process uid and gid.")
 
-    process_requests(stream_address, data_retrieval_delay=data_retrieval_delay)
+    process_requests(stream_address, data_retrieval_delay=data_retrieval_delay, n_workers=n_workers,
+                     worker_type=worker_type, max_pending_requests=max_pending_requests,
+                     pipeline_queue_length=pipeline_queue_length, journal_file=journal_file)
 
 
 def run():
@@ -226,6 +557,17 @@ def run():
                                                   "Use -1 for current user.")
     parser.add_argument("--data_retrieval_delay", default=config.DEFAULT_DATA_RETRIEVAL_DELAY, type=int,
                         help="Time to wait before asking the data-api for the data.")
+    parser.add_argument("--n_workers", default=config.DEFAULT_N_WORKERS, type=int,
+                        help="Number of requests to process in parallel.")
+    parser.add_argument("--worker_type", default=config.DEFAULT_WORKER_TYPE, choices=["thread", "process"],
+                        help="Process requests in threads (retrieval bound) or processes (conversion bound).")
+    parser.add_argument("--max_pending_requests", default=config.DEFAULT_MAX_PENDING_REQUESTS, type=int,
+                        help="Max number of received requests waiting to be processed.")
+    parser.add_argument("--pipeline_queue_length", default=config.DEFAULT_PIPELINE_QUEUE_LENGTH, type=int,
+                        help="Max number of retrieved requests waiting to be written, while the next requests are "
+                             "retrieved. 0 disables the pipeline.")
+    parser.add_argument("--journal_file", default=config.DEFAULT_WRITER_JOURNAL_FILE,
+                        help="Journal of the accepted requests. Unfinished requests are replayed on startup.")
 
     parser.add_argument("--log_level", default="INFO",
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
@@ -238,7 +580,12 @@ def run():
 
     start_server(stream_address=arguments.stream_address,
                  user_id=arguments.user_id,
-                 data_retrieval_delay=arguments.data_retrieval_delay)
+                 data_retrieval_delay=arguments.data_retrieval_delay,
+                 n_workers=arguments.n_workers,
+                 worker_type=arguments.worker_type,
+                 max_pending_requests=arguments.max_pending_requests,
+                 pipeline_queue_length=arguments.pipeline_queue_length,
+                 journal_file=arguments.journal_file)
 
 
 if __name__ == "__main__":
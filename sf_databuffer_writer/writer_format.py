@@ -1,4 +1,8 @@
+import itertools
 import logging
+import multiprocessing
+from collections import namedtuple
+from threading import Lock
 
 import h5py
 import numpy
@@ -7,9 +11,155 @@ from bsread.data.serialization import channel_type_deserializer_mapping
 import os
 
 from sf_databuffer_writer import config
+from sf_databuffer_writer.response_format import EventColumns
 
 _logger = logging.getLogger(__name__)
 
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python < 3.8 or Windows.
+    shared_memory = None
+
+GLOBAL_DATE_FORMATS = ("string", "fixed", "int64")
+
+OUTPUT_LAYOUTS = ("dense", "sparse")
+
+GLOBAL_DATE_ATTRIBUTES = {
+    "string": {},
+    "fixed": {"format": "ISO 8601 with nanoseconds and UTC offset, ASCII encoded."},
+    "int64": {"format": "Nanoseconds since 1970-01-01T00:00:00 UTC.",
+              "source_format": "ISO 8601 with nanoseconds and UTC offset, e.g. 2018-06-08T14:04:51.551143344+02:00"}
+}
+
+
+# Numeric array passed from a conversion process to the writer through a shared memory block.
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype"])
+
+# Datasets of a compact format channel, each passed in its own shared memory block.
+COMPACT_DATASET_NAMES = ("data", "is_data_present", "pulse_id", "global_date")
+
+# Writer, channels and shared memory block prefix of a conversion process, set by its pool initializer.
+_conversion_input = None
+
+# Held while forking a pool and while this process attaches or unlinks shared memory blocks: the forked workers would
+# otherwise inherit the locks of a pool creation or of the resource tracker held by another writer thread.
+_fork_lock = Lock()
+_conversion_ids = itertools.count()
+
+
+def _init_conversion_process(writer, json_data, block_prefix):
+    global _conversion_input
+    _conversion_input = (writer, json_data, block_prefix)
+
+
+def _get_block_name(block_prefix, channel_index, dataset_index):
+    return "%s_%d_%d" % (block_prefix, channel_index, dataset_index)
+
+
+def _convert_channel_to_shared_memory(channel_index):
+    writer, json_data, block_prefix = _conversion_input
+
+    name, data = writer._build_channel_data(json_data[channel_index])
+
+    if data is None:
+        return name, None
+
+    return name, {dataset_name: _to_shared_memory(values, _get_block_name(block_prefix, channel_index, dataset_index))
+                  for dataset_index, (dataset_name, values) in enumerate(data.items())}
+
+
+def _unlink_shared_memory(block_name):
+
+    with _fork_lock:
+        try:
+            block = shared_memory.SharedMemory(name=block_name)
+        except FileNotFoundError:
+            return
+
+        block.close()
+        block.unlink()
+
+
+def _to_shared_memory(values, block_name):
+    """
+    Copy a numeric array into a new shared memory block and return its SharedArray descriptor.
+    Arrays of Python objects (variable length strings) are returned as they are, to be pickled.
+    """
+
+    if values.dtype.hasobject or values.nbytes == 0:
+        return values
+
+    block = shared_memory.SharedMemory(name=block_name, create=True, size=values.nbytes)
+
+    shared_values = numpy.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    shared_values[...] = values
+    del shared_values
+
+    # The block is unlinked by the writer, after the data has been written.
+    block.close()
+
+    return SharedArray(block.name, values.shape, values.dtype.str)
+
+
+def consume_channels(json_data):
+    """
+    Iterate over the json_data list, removing each channel from it before it is returned.
+    """
+
+    json_data.reverse()
+
+    while json_data:
+        yield json_data.pop()
+
+
+def parse_utc_offset_to_ns(utc_offset):
+    sign = 1 if utc_offset[0] == "+" else -1
+    return sign * (int(utc_offset[1:3]) * 60 + int(utc_offset[4:6])) * 60 * 10**9
+
+
+def convert_global_dates_to_ns(global_dates):
+    """
+    Convert data api global dates (ISO 8601 with nanoseconds and UTC offset) to nanoseconds since epoch, UTC.
+    """
+
+    dates = numpy.array(global_dates, dtype="S")
+    n_dates, date_length = len(dates), dates.dtype.itemsize
+
+    if n_dates and date_length > 6:
+        characters = dates.view("u1").reshape(n_dates, date_length)
+        utc_offsets = characters[:, -6:]
+
+        # Usually all the dates of a request have the same length and UTC offset: parse them without Python loops.
+        if characters[:, -1].all() and chr(utc_offsets[0, 0]) in "+-" and (utc_offsets == utc_offsets[0]).all():
+            local_dates = numpy.ascontiguousarray(characters[:, :-6]).view("S%d" % (date_length - 6)).ravel()
+
+            return local_dates.astype("datetime64[ns]").astype("<i8") - \
+                parse_utc_offset_to_ns(utc_offsets[0].tobytes().decode())
+
+    local_dates = []
+    utc_offsets = []
+
+    for global_date in global_dates:
+        if global_date.endswith("Z"):
+            local_dates.append(global_date[:-1])
+            utc_offsets.append("+00:00")
+        else:
+            local_dates.append(global_date[:-6])
+            utc_offsets.append(global_date[-6:])
+
+    offsets_ns = {utc_offset: parse_utc_offset_to_ns(utc_offset) for utc_offset in set(utc_offsets)}
+
+    timestamps = numpy.array(local_dates, dtype="datetime64[ns]").astype("<i8")
+    timestamps -= numpy.fromiter((offsets_ns[utc_offset] for utc_offset in utc_offsets), dtype="<i8", count=n_dates)
+
+    return timestamps
+
 
 class DataBufferH5Writer(object):
     def __init__(self, output_file, parameters):
@@ -17,10 +167,96 @@ class DataBufferH5Writer(object):
         self.parameters = parameters
 
         path_to_file = os.path.dirname(self.output_file)
-        os.makedirs(path_to_file, exist_ok=True)        
+        if path_to_file:
+            os.makedirs(path_to_file, exist_ok=True)
+
+        self.compression_options = self._get_compression_options()
+        self.chunking = self.parameters.get("output_chunking")
+
+        if self.chunking is not None and self.chunking != "auto" and \
+                (not isinstance(self.chunking, int) or isinstance(self.chunking, bool) or self.chunking <= 0):
+            raise ValueError("Invalid output_chunking '%s'. Supported: 'auto' or a positive number of rows." %
+                             (self.chunking,))
+
+        # Compressed datasets have to be chunked.
+        if self.chunking is None and self.compression_options:
+            self.chunking = "auto"
+
+        self.global_date_format = self.parameters.get("output_global_date_format",
+                                                      config.DEFAULT_OUTPUT_GLOBAL_DATE_FORMAT)
+
+        if self.global_date_format not in GLOBAL_DATE_FORMATS:
+            raise ValueError("Unknown output_global_date_format '%s'. Supported: %s." %
+                             (self.global_date_format, ", ".join(GLOBAL_DATE_FORMATS)))
+
+        self.layout = self.parameters.get("output_layout", config.DEFAULT_OUTPUT_LAYOUT)
+
+        if self.layout not in OUTPUT_LAYOUTS:
+            raise ValueError("Unknown output_layout '%s'. Supported: %s." % (self.layout, ", ".join(OUTPUT_LAYOUTS)))
+
+        # Only the written chunks take space in the file.
+        if self.layout == "sparse" and not self.chunking:
+            self.chunking = "auto"
+
+        _logger.info("Using output_compression=%s, output_chunking=%s, output_global_date_format=%s and "
+                     "output_layout=%s.", self.parameters.get("output_compression", config.DEFAULT_OUTPUT_COMPRESSION),
+                     self.chunking, self.global_date_format, self.layout)
 
         self.file = h5py.File(self.output_file, "w")
 
+    def _get_compression_options(self):
+        compression = self.parameters.get("output_compression", config.DEFAULT_OUTPUT_COMPRESSION)
+
+        if not compression or compression == "none":
+            return {}
+
+        if compression == "gzip":
+            return {"compression": "gzip",
+                    "compression_opts": self.parameters.get("output_compression_level",
+                                                            config.DEFAULT_OUTPUT_COMPRESSION_LEVEL)}
+
+        if compression == "lzf":
+            return {"compression": "lzf"}
+
+        if compression == "bitshuffle":
+            if hdf5plugin is None:
+                _logger.error("Compression bitshuffle requires hdf5plugin, which is not installed. "
+                              "Writing uncompressed datasets.")
+                return {}
+
+            return dict(hdf5plugin.Bitshuffle())
+
+        raise ValueError("Unknown output_compression '%s'. Supported: gzip, lzf, bitshuffle." % compression)
+
+    def _get_dataset_layout(self, data):
+        return self._get_layout(data.shape, data.dtype)
+
+    def _get_layout(self, shape, dtype):
+        shape = tuple(shape)
+
+        if not self.chunking or int(numpy.prod(shape)) == 0:
+            return {}
+
+        if self.chunking == "auto":
+            # Chunk along the pulse_id axis, each chunk holding around OUTPUT_CHUNK_SIZE_BYTES of data.
+            row_bytes = numpy.dtype(dtype).itemsize * int(numpy.prod(shape[1:]))
+            chunk_rows = max(1, config.OUTPUT_CHUNK_SIZE_BYTES // row_bytes)
+        else:
+            chunk_rows = self.chunking
+
+        layout = {"chunks": (min(chunk_rows, shape[0]),) + shape[1:]}
+
+        # Only the heap references of variable length strings would be compressed.
+        if not h5py.check_string_dtype(numpy.dtype(dtype)):
+            layout.update(self.compression_options)
+
+        return layout
+
+    def _create_dataset(self, path, data):
+        data = numpy.asarray(data)
+
+        return self.file.create_dataset(path, data=data, **self._get_dataset_layout(data))
+
     def _prepare_format_datasets(self):
 
         _logger.info("Initializing format datasets.")
@@ -37,7 +273,10 @@ class DataBufferH5Writer(object):
         self.file.create_dataset("/general/user",
                                  data=numpy.string_(self.parameters["general/user"]))
 
-    def _build_datasets_data(self, json_data):
+    def _get_pulse_ids(self, json_data):
+        """
+        Sorted union of the pulse_ids of all channels.
+        """
 
         if not isinstance(json_data, list):
             raise ValueError("json_data should be a list, but its %s." % type(json_data))
@@ -53,17 +292,38 @@ class DataBufferH5Writer(object):
             if not data:
                 continue
 
+            if isinstance(data, EventColumns):
+                pulse_ids.update(data.pulse_ids.tolist())
+                continue
+
             for data_point in data:
                 pulse_ids.add(data_point["pulseId"])
 
         pulse_ids = sorted(pulse_ids)
-        pulse_id_to_data_index = {data: index for index, data in enumerate(pulse_ids)}
-        n_data_points = len(pulse_id_to_data_index)
 
-        _logger.info("Built array of pulse_ids. n_data_points=%d" % n_data_points)
+        _logger.info("Built array of pulse_ids. n_data_points=%d" % len(pulse_ids))
+
+        return pulse_ids
+
+    def _build_datasets_data(self, json_data):
+
+        pulse_ids = self._get_pulse_ids(json_data)
+        pulse_id_to_data_index = {data: index for index, data in enumerate(pulse_ids)}
 
         datasets_data = {}
-        
+
+        for channel_data in json_data:
+            name, data = self._build_dense_channel_data(channel_data, pulse_id_to_data_index)
+
+            if data is not None:
+                datasets_data[name] = data
+
+        return pulse_ids, datasets_data
+
+    def _build_dense_channel_data(self, channel_data, pulse_id_to_data_index):
+
+        n_data_points = len(pulse_id_to_data_index)
+
         # Channel data format example
         # channel_data = {
         #     "data": [],
@@ -71,10 +331,186 @@ class DataBufferH5Writer(object):
         #     "channel": {"name": "ARRAY_NO_DATA", "backend": "sf-databuffer"}
         # }
 
+        try:
+            name = channel_data["channel"]["name"]
+            _logger.debug("Formatting data for channel %s." % name)
+
+            data = channel_data["data"]
+
+            if not data:
+                if config.ERROR_IF_NO_DATA:
+                    raise ValueError("There is no data for channel %s." % name)
+                else:
+                    _logger.error("There is no data for channel %s." % name)
+            
+            channel_type = channel_data["configs"][0]["type"]
+            channel_shape = channel_data["configs"][0]["shape"]
+
+            dataset_type, dataset_shape = self._get_dataset_definition(channel_type, channel_shape, n_data_points)
+
+            if channel_type == "string":
+                dataset_values = numpy.full(fill_value="", dtype=dataset_type, shape=dataset_shape)
+            else:
+                dataset_values = numpy.zeros(dtype=dataset_type, shape=dataset_shape)
+
+            dataset_value_present = numpy.zeros(shape=(n_data_points,), dtype="bool")
+
+            if data:
+                channel_pulse_ids, channel_values, channel_global_time = \
+                    self._get_channel_columns(data, dataset_type, channel_shape)
+
+                dataset_global_time = self._get_empty_global_dates(n_data_points, channel_global_time.dtype)
+
+                data_indexes = numpy.fromiter((pulse_id_to_data_index[pulse_id] for pulse_id in channel_pulse_ids),
+                                              dtype="<i8", count=len(channel_pulse_ids))
+
+                dataset_values[data_indexes] = channel_values
+                dataset_value_present[data_indexes] = 1
+                dataset_global_time[data_indexes] = channel_global_time
+            else:
+                dataset_global_time = self._get_empty_global_dates(n_data_points)
+
+            return name, {
+                "data": dataset_values,
+                "is_data_present": dataset_value_present,
+                "global_date": dataset_global_time
+            }
+
+        except Exception as e:
+            _logger.error("Cannot convert channel_name %s." % name)
+
+            if config.ERROR_IF_NO_DATA:
+                raise
+
+        return name, None
+
+    def _get_channel_columns(self, data, dataset_type, channel_shape):
+        """
+        Convert the channel events into pulse_id, value and global_date arrays.
+
+        Each column is built with a single numpy call, and the columns of binary responses are used as they are. If
+        the values cannot be converted in bulk (ragged or missing values) the events are converted one by one.
+        """
+
+        n_data_points = len(data)
+        value_shape = [n_data_points] + channel_shape[::-1]
+
+        if isinstance(data, EventColumns):
+            return data.pulse_ids, numpy.asarray(data.values, dtype=dataset_type).reshape(value_shape), \
+                self._convert_global_dates(data.global_dates)
+
+        pulse_ids = numpy.fromiter((data_point["pulseId"] for data_point in data), dtype="<i8", count=n_data_points)
+
+        global_time = self._convert_global_dates([data_point["globalDate"] for data_point in data])
+
+        try:
+            # Bsread is [X, Y] but numpy is [Y, X].
+            values = numpy.asarray([data_point["value"] for data_point in data], dtype=dataset_type).\
+                reshape(value_shape)
+
+        except (ValueError, TypeError):
+            _logger.debug("Cannot convert values in bulk, converting them one by one.")
+
+            values = numpy.zeros(dtype=dataset_type, shape=value_shape)
+
+            for data_index, data_point in enumerate(data):
+
+                if len(channel_shape) > 1:
+                    # Bsread is [X, Y] but numpy is [Y, X].
+                    data_point["value"] = numpy.array(data_point["value"], dtype=dataset_type).\
+                        reshape(channel_shape[::-1])
+
+                values[data_index] = data_point["value"]
+
+        return pulse_ids, values, global_time
+
+    def _convert_global_dates(self, global_dates):
+
+        if self.global_date_format == "int64":
+            return convert_global_dates_to_ns(global_dates)
+
+        if self.global_date_format == "fixed":
+            return numpy.array(global_dates, dtype="S")
+
+        global_time = numpy.zeros(shape=(len(global_dates),), dtype=h5py.special_dtype(vlen=str))
+        global_time[:] = global_dates
+
+        return global_time
+
+    def _get_empty_global_dates(self, n_data_points, dtype=None):
+        """
+        Global dates of pulse_ids without data: empty strings or 0.
+        """
+
+        if dtype is None:
+            dtype = self._convert_global_dates([]).dtype
+
+        if h5py.check_string_dtype(dtype) and dtype.kind == "O":
+            return numpy.full(shape=(n_data_points,), fill_value="", dtype=dtype)
+
+        return numpy.zeros(shape=(n_data_points,), dtype=dtype)
+
+    def _get_dataset_definition(self, channel_dtype, channel_shape, n_data_points):
+
+        dataset_type = channel_type_deserializer_mapping[channel_dtype][0]
+        dataset_shape = [n_data_points] + channel_shape[::-1]
+
+        if channel_dtype == "string":
+            dataset_type = h5py.special_dtype(vlen=str)
+            dataset_shape = [n_data_points] + channel_shape[::-1]
+
+        return dataset_type, dataset_shape
+
+    def write_data(self, json_data, release_input=False):
+        """
+        Convert the channels and write them to disk one by one, so only one converted channel is kept in memory.
+
+        The pulse_id axis is shared by all channels, so the whole response is needed before writing. If release_input
+        is True, each channel is removed from the json_data list when it is converted, so its memory can be
+        reclaimed as soon as it has been written.
+        """
+
+        self._prepare_format_datasets()
+
+        if not isinstance(json_data, list):
+            json_data = list(json_data)
+
+        pulse_ids = self._get_pulse_ids(json_data)
+        channels = consume_channels(json_data) if release_input else json_data
+
+        if self.layout == "sparse":
+            self._write_sparse_data(pulse_ids, channels)
+            return
+
+        pulse_id_to_data_index = {data: index for index, data in enumerate(pulse_ids)}
+        pulse_ids = numpy.array(pulse_ids, dtype="<i8")
+
+        _logger.info("Building numpy arrays and writing data to disk channel by channel.")
+
+        for channel_data in channels:
+            name, data = self._build_dense_channel_data(channel_data, pulse_id_to_data_index)
+
+            if data is not None:
+                data["pulse_id"] = pulse_ids
+                self._write_channel_datasets(name, data)
+
+    def _write_sparse_data(self, pulse_ids, json_data):
+        """
+        Write the same datasets as the dense layout, without building the zero filled arrays in memory.
+
+        The data and global_date datasets are chunked and filled with zeros (empty strings) by HDF5. Only the chunks
+        that contain data are written, so slow channels next to fast ones do not take space for the missing pulse_ids.
+        """
+
+        pulse_ids = numpy.array(pulse_ids, dtype="<i8")
+        n_data_points = len(pulse_ids)
+
+        _logger.info("Writing sparse data to disk channel by channel.")
+
         for channel_data in json_data:
             try:
                 name = channel_data["channel"]["name"]
-                _logger.debug("Formatting data for channel %s." % name)
+                _logger.debug("Writing sparse data for channel %s." % name)
 
                 data = channel_data["data"]
 
@@ -83,69 +519,97 @@ class DataBufferH5Writer(object):
                         raise ValueError("There is no data for channel %s." % name)
                     else:
                         _logger.error("There is no data for channel %s." % name)
-                
+
                 channel_type = channel_data["configs"][0]["type"]
                 channel_shape = channel_data["configs"][0]["shape"]
 
                 dataset_type, dataset_shape = self._get_dataset_definition(channel_type, channel_shape, n_data_points)
 
-                dataset_values = numpy.zeros(dtype=dataset_type, shape=dataset_shape)
+                if data:
+                    channel_pulse_ids, channel_values, channel_global_time = \
+                        self._get_channel_columns(data, dataset_type, channel_shape)
+                else:
+                    channel_pulse_ids, channel_values, channel_global_time = None, None, self._convert_global_dates([])
+
+                self._create_dataset("/data/" + name + "/pulse_id", pulse_ids)
+
+                dataset_values = self._create_sparse_dataset("/data/" + name + "/data", dataset_shape, dataset_type)
+                dataset_global_time = self._create_sparse_dataset("/data/" + name + "/global_date",
+                                                                  (n_data_points,), channel_global_time.dtype)
+                dataset_global_time.attrs.update(GLOBAL_DATE_ATTRIBUTES[self.global_date_format])
+
                 dataset_value_present = numpy.zeros(shape=(n_data_points,), dtype="bool")
-                dataset_global_time = numpy.zeros(shape=(n_data_points,), dtype=h5py.special_dtype(vlen=str))
 
                 if data:
-                    for data_point in data:
-                        data_index = pulse_id_to_data_index[data_point["pulseId"]]
-
-                        if len(channel_shape) > 1:
-                            # Bsread is [X, Y] but numpy is [Y, X].
-                            data_point["value"] = numpy.array(data_point["value"], dtype=dataset_type).\
-                                reshape(channel_shape[::-1])
+                    data_indexes = numpy.searchsorted(pulse_ids, channel_pulse_ids)
 
-                        dataset_values[data_index] = data_point["value"]
-                        dataset_value_present[data_index] = 1
-                        dataset_global_time[data_index] = data_point["globalDate"]
+                    self._write_sparse_rows(dataset_values, data_indexes, channel_values)
+                    self._write_sparse_rows(dataset_global_time, data_indexes, channel_global_time)
+                    dataset_value_present[data_indexes] = 1
 
-                datasets_data[name] = {
-                    "data": dataset_values,
-                    "is_data_present": dataset_value_present,
-                    "global_date": dataset_global_time
-                }
+                self._create_dataset("/data/" + name + "/is_data_present", dataset_value_present)
 
             except Exception as e:
-                _logger.error("Cannot convert channel_name %s." % name)
+                _logger.error("Cannot write channel_name %s: %s" % (name, e))
 
                 if config.ERROR_IF_NO_DATA:
                     raise
 
-        return pulse_ids, datasets_data
+    def _create_sparse_dataset(self, path, shape, dtype):
+        return self.file.create_dataset(path, shape=tuple(shape), dtype=dtype, **self._get_layout(shape, dtype))
 
-    def _get_dataset_definition(self, channel_dtype, channel_shape, n_data_points):
+    def _write_sparse_rows(self, dataset, data_indexes, values):
+        """
+        Write values at the data_indexes of the dataset, one chunk at a time. Chunks without data are skipped.
+        """
 
-        dataset_type = channel_type_deserializer_mapping[channel_dtype][0]
-        dataset_shape = [n_data_points] + channel_shape[::-1]
+        # The chunks are written from sorted, unique data_indexes. For duplicated pulse_ids the last value is kept,
+        # like in the dense layout.
+        if len(data_indexes) > 1 and not numpy.all(numpy.diff(data_indexes) > 0):
+            order = numpy.argsort(data_indexes, kind="stable")
+            data_indexes = data_indexes[order]
 
-        if channel_dtype == "string":
-            dataset_type = h5py.special_dtype(vlen=str)
-            dataset_shape = [n_data_points] + channel_shape[::-1]
+            is_last = numpy.append(data_indexes[1:] != data_indexes[:-1], True)
+            data_indexes, values = data_indexes[is_last], values[order[is_last]]
 
-        return dataset_type, dataset_shape
+        if dataset.chunks is None:
+            buffer = self._get_fill_buffer(dataset.shape, dataset.dtype)
+            buffer[data_indexes] = values
+            dataset[:] = buffer
+            return
 
-    def write_data(self, json_data):
+        chunk_rows = dataset.chunks[0]
+        chunk_boundaries = numpy.flatnonzero(numpy.diff(data_indexes // chunk_rows)) + 1
 
-        self._prepare_format_datasets()
+        for start, stop in zip(numpy.concatenate(([0], chunk_boundaries)),
+                               numpy.concatenate((chunk_boundaries, [len(data_indexes)]))):
 
-        _logger.info("Building numpy arrays with received data.")
+            chunk_start = (data_indexes[start] // chunk_rows) * chunk_rows
+            chunk_stop = min(chunk_start + chunk_rows, dataset.shape[0])
+
+            # The chunk is filled completely by consecutive data.
+            if stop - start == chunk_stop - chunk_start:
+                dataset[chunk_start:chunk_stop] = values[start:stop]
+                continue
 
-        pulse_ids, datasets_data = self._build_datasets_data(json_data)
+            buffer = self._get_fill_buffer((chunk_stop - chunk_start,) + dataset.shape[1:], dataset.dtype)
+            buffer[data_indexes[start:stop] - chunk_start] = values[start:stop]
+            dataset[chunk_start:chunk_stop] = buffer
 
-        _logger.info("Writing data to disk.")
+    @staticmethod
+    def _get_fill_buffer(shape, dtype):
 
-        for name, data in datasets_data.items():
-            self.file["/data/" + name + "/pulse_id"] = pulse_ids
-            self.file["/data/" + name + "/global_date"] = data["global_date"]
-            self.file["/data/" + name + "/data"] = data["data"]
-            self.file["/data/" + name + "/is_data_present"] = data["is_data_present"]
+        if h5py.check_string_dtype(dtype) and dtype.kind == "O":
+            return numpy.full(shape=shape, fill_value="", dtype=dtype)
+
+        return numpy.zeros(shape=shape, dtype=dtype)
+
+    def _write_channel_datasets(self, name, data):
+        self._create_dataset("/data/" + name + "/pulse_id", data["pulse_id"])
+        global_date = self._create_dataset("/data/" + name + "/global_date", data["global_date"])
+        global_date.attrs.update(GLOBAL_DATE_ATTRIBUTES[self.global_date_format])
+        self._create_dataset("/data/" + name + "/data", data["data"])
+        self._create_dataset("/data/" + name + "/is_data_present", data["is_data_present"])
 
     def close(self):
         self.file.close()
@@ -153,6 +617,47 @@ class DataBufferH5Writer(object):
 
 class CompactDataBufferH5Writer(DataBufferH5Writer):
 
+    def _build_channel_data(self, channel_data):
+
+        if not isinstance(channel_data, dict):
+            raise ValueError("channel_data should be a dict, but its %s." % type(channel_data))
+
+        try:
+            name = channel_data["channel"]["name"]
+            _logger.debug("Formatting data for channel %s." % name)
+
+            data = channel_data["data"]
+            if not data:
+                if config.ERROR_IF_NO_DATA:
+                    raise ValueError("There is no data for channel %s." % name)
+                else:
+                    _logger.error("There is no data for channel %s." % name)
+
+            channel_type = channel_data["configs"][0]["type"]
+            channel_shape = channel_data["configs"][0]["shape"]
+
+            n_data_points = len(data)
+            dataset_type, _ = self._get_dataset_definition(channel_type, channel_shape, n_data_points)
+
+            dataset_pulse_ids, dataset_values, dataset_global_time = \
+                self._get_channel_columns(data, dataset_type, channel_shape)
+            dataset_value_present = numpy.ones(shape=(n_data_points,), dtype="bool")
+
+            return name, {
+                "data": dataset_values,
+                "is_data_present": dataset_value_present,
+                "pulse_id": dataset_pulse_ids,
+                "global_date": dataset_global_time
+            }
+
+        except Exception as e:
+            _logger.error("Cannot convert channel_name %s." % name)
+
+            if config.ERROR_IF_NO_DATA:
+                raise
+
+        return name, None
+
     def _build_datasets_data(self, json_data):
 
         datasets_data = {}
@@ -161,72 +666,296 @@ class CompactDataBufferH5Writer(DataBufferH5Writer):
             raise ValueError("json_data should be a list, but its %s." % type(json_data))
 
         for channel_data in json_data:
-            
-            if not isinstance(channel_data, dict):
-                raise ValueError("channel_data should be a dict, but its %s." % type(channel_data))
+            name, data = self._build_channel_data(channel_data)
+
+            if data is not None:
+                datasets_data[name] = data
+
+        return datasets_data
+
+    def write_data(self, json_data, release_input=False):
+        """
+        Write the channels to disk one by one, as they are converted.
+
+        json_data can be any iterable of channels (for example a streamed data api response). Each channel is
+        released after it has been written, so only one converted channel is kept in memory at a time. If
+        release_input is True and json_data is a list, the channels are also removed from it.
+        """
+
+        self._prepare_format_datasets()
+
+        n_processes = self._get_conversion_processes(json_data)
+
+        if n_processes > 1:
+            self._write_data_in_processes(json_data, n_processes)
+
+            if release_input:
+                json_data.clear()
+
+            return
+
+        _logger.info("Building numpy arrays and writing data to disk channel by channel.")
+
+        if release_input and isinstance(json_data, list):
+            json_data = consume_channels(json_data)
+
+        for channel_data in json_data:
+            name, data = self._build_channel_data(channel_data)
+
+            if data is not None:
+                self._write_channel_datasets(name, data)
+
+    def _get_conversion_processes(self, json_data):
+
+        n_processes = int(self.parameters.get("output_conversion_processes",
+                                              config.DEFAULT_OUTPUT_CONVERSION_PROCESSES))
+
+        if n_processes <= 1:
+            return 1
+
+        # Streamed responses are converted while they are received.
+        if not isinstance(json_data, list):
+            return 1
 
+        if shared_memory is None or "fork" not in multiprocessing.get_all_start_methods():
+            _logger.warning("Conversion processes need shared memory and fork. Converting channels serially.")
+            return 1
+
+        return min(n_processes, len(json_data))
+
+    def _write_data_in_processes(self, json_data, n_processes):
+        """
+        Convert the channels in n_processes worker processes, and write them in this process, in order.
+
+        The workers are forked, so they inherit the channels (passed to the pool initializer) without copying them.
+        The converted numeric arrays are passed back in shared memory blocks, only the strings are pickled. The blocks
+        are named after the channel they belong to, so the blocks not yet written can be removed if the call fails.
+        """
+
+        _logger.info("Building numpy arrays in %d processes and writing data to disk channel by channel." %
+                     n_processes)
+
+        block_prefix = "sfdb%x_%x" % (os.getpid(), next(_conversion_ids))
+        n_written_channels = 0
+
+        try:
+            with _fork_lock:
+                # The workers have to share the tracker of this process, otherwise they remove the blocks they created
+                # when they exit, before they are written.
+                resource_tracker.ensure_running()
+
+                pool = multiprocessing.get_context("fork").Pool(n_processes, initializer=_init_conversion_process,
+                                                                initargs=(self, json_data, block_prefix))
+
+            # The pool is not terminated on errors: killing workers that hold the locks of its queues can hang the
+            # termination. The workers convert the remaining channels, and their blocks are removed below.
             try:
-                name = channel_data["channel"]["name"]
-                _logger.debug("Formatting data for channel %s." % name)
+                for name, data in pool.imap(_convert_channel_to_shared_memory, range(len(json_data))):
 
-                data = channel_data["data"]
-                if not data:
-                    if config.ERROR_IF_NO_DATA:
-                        raise ValueError("There is no data for channel %s." % name)
-                    else:
-                        _logger.error("There is no data for channel %s." % name)
+                    if data is not None:
+                        self._write_shared_channel_datasets(name, data)
 
-                channel_type = channel_data["configs"][0]["type"]
-                channel_shape = channel_data["configs"][0]["shape"]
+                    n_written_channels += 1
 
-                n_data_points = len(data)
-                dataset_type, dataset_shape = self._get_dataset_definition(channel_type, channel_shape, n_data_points)
+            finally:
+                pool.close()
+                pool.join()
 
-                dataset_values = numpy.zeros(dtype=dataset_type, shape=dataset_shape)
-                dataset_value_present = numpy.zeros(shape=(n_data_points,), dtype="bool")
-                dataset_pulse_ids = numpy.zeros(shape=(n_data_points,), dtype="<i8")
-                dataset_global_time = numpy.zeros(shape=(n_data_points,), dtype=h5py.special_dtype(vlen=str))
+        except Exception:
+            # The pool has exited, so no more blocks are created.
+            for channel_index in range(n_written_channels, len(json_data)):
+                for dataset_index in range(len(COMPACT_DATASET_NAMES)):
+                    _unlink_shared_memory(_get_block_name(block_prefix, channel_index, dataset_index))
 
-                if data:
-                    for data_index, data_point in enumerate(data):
+            raise
+
+    def _write_shared_channel_datasets(self, name, data):
+
+        blocks = []
+
+        try:
+            datasets_data = {}
+
+            for dataset_name, values in data.items():
+                if isinstance(values, SharedArray):
+                    with _fork_lock:
+                        block = shared_memory.SharedMemory(name=values.name)
+                    blocks.append(block)
+
+                    values = numpy.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+
+                datasets_data[dataset_name] = values
+
+            self._write_channel_datasets(name, datasets_data)
+
+        finally:
+            # The arrays have to be released before their blocks can be closed.
+            datasets_data = values = None
+
+            with _fork_lock:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+
+
+class ImageDataBufferH5Writer(DataBufferH5Writer):
+    """
+    Append camera frames to resizable datasets one frame at a time, as they are received.
+
+    write_data can be called once for each part of the response (for example each pulse_id window). The datasets are
+    preallocated for n_expected_frames frames per channel and trimmed to the number of received frames on close.
+    Like in the compact format, only the received frames are written.
+    """
+
+    def __init__(self, output_file, parameters, n_expected_frames=None):
+        super(ImageDataBufferH5Writer, self).__init__(output_file, parameters)
+
+        # Resizable datasets have to be chunked.
+        if not self.chunking:
+            self.chunking = "auto"
+
+        self.n_expected_frames = max(1, n_expected_frames or 1)
+        self.channels = {}
 
-                        if len(channel_shape) > 1:
-                            # Bsread is [X, Y] but numpy is [Y, X].
-                            data_point["value"] = numpy.array(data_point["value"], dtype=dataset_type).\
-                                reshape(channel_shape[::-1])
+        self._prepare_format_datasets()
 
-                        dataset_values[data_index] = data_point["value"]
-                        dataset_value_present[data_index] = 1
-                        dataset_pulse_ids[data_index] = data_point["pulseId"]
-                        dataset_global_time[data_index] = data_point["globalDate"]
+    def write_data(self, json_data, release_input=False):
 
-                datasets_data[name] = {
-                    "data": dataset_values,
-                    "is_data_present": dataset_value_present,
-                    "pulse_id": dataset_pulse_ids,
-                    "global_date": dataset_global_time
-                }
+        for channel_data in json_data:
+            try:
+                self._append_channel_data(channel_data)
 
             except Exception as e:
-                _logger.error("Cannot convert channel_name %s." % name)
+                _logger.error("Cannot append data of channel_name %s: %s" % (channel_data["channel"]["name"], e))
 
                 if config.ERROR_IF_NO_DATA:
                     raise
 
-        return datasets_data
+    def get_n_frames(self):
+        return sum(channel["n_frames"] for channel in self.channels.values())
 
-    def write_data(self, json_data):
+    def get_n_bytes(self):
+        return sum(channel["n_bytes"] for channel in self.channels.values())
 
-        self._prepare_format_datasets()
+    def _append_channel_data(self, channel_data):
+
+        name = channel_data["channel"]["name"]
+        channel_type = channel_data["configs"][0]["type"]
+        channel_shape = channel_data["configs"][0]["shape"]
+
+        if name not in self.channels:
+            dataset_type, _ = self._get_dataset_definition(channel_type, channel_shape, 0)
+
+            self.channels[name] = {"dataset_type": dataset_type,
+                                   # Bsread is [X, Y] but numpy is [Y, X].
+                                   "frame_shape": tuple(channel_shape[::-1]),
+                                   "datasets": None,
+                                   "capacity": 0,
+                                   "n_frames": 0,
+                                   "n_bytes": 0,
+                                   "last_pulse_id": None}
+
+        channel = self.channels[name]
+        data = channel_data["data"]
+
+        # Frames at the border of the windows could be received twice.
+        if channel["last_pulse_id"] is not None:
+            if isinstance(data, EventColumns):
+                data = data[numpy.searchsorted(data.pulse_ids, channel["last_pulse_id"], side="right"):]
+            else:
+                data = [data_point for data_point in data if data_point["pulseId"] > channel["last_pulse_id"]]
+
+        if not data:
+            return
+
+        if isinstance(data, EventColumns):
+            pulse_ids = data.pulse_ids
+            global_time = self._convert_global_dates(data.global_dates)
+        else:
+            pulse_ids = numpy.fromiter((data_point["pulseId"] for data_point in data), dtype="<i8", count=len(data))
+            global_time = self._convert_global_dates([data_point["globalDate"] for data_point in data])
+
+        if channel["datasets"] is None:
+            channel["datasets"] = self._create_channel_datasets(name, channel, global_time.dtype)
+
+        start_index = channel["n_frames"]
+        stop_index = start_index + len(data)
+        self._reserve_frames(channel, stop_index)
+
+        datasets = channel["datasets"]
+        datasets["pulse_id"][start_index:stop_index] = pulse_ids
+        datasets["global_date"][start_index:stop_index] = global_time
+        datasets["is_data_present"][start_index:stop_index] = True
+
+        if isinstance(data, EventColumns):
+            frames = numpy.asarray(data.values, dtype=channel["dataset_type"]).\
+                reshape((len(data),) + channel["frame_shape"])
+            datasets["data"][start_index:stop_index] = frames
+            channel["n_bytes"] += frames.nbytes
+
+        else:
+            for frame_index, data_point in enumerate(data, start=start_index):
+                frame = numpy.asarray(data_point["value"], dtype=channel["dataset_type"]).\
+                    reshape(channel["frame_shape"])
+                datasets["data"][frame_index] = frame
+
+                # Release the frame as soon as it is on disk.
+                data_point["value"] = None
+                channel["n_bytes"] += frame.nbytes
+
+        channel["n_frames"] = stop_index
+        channel["last_pulse_id"] = int(pulse_ids[-1])
+
+    def _create_channel_datasets(self, name, channel, global_date_dtype):
+        datasets = {}
+
+        for dataset_name, frame_shape, dtype in (("pulse_id", (), "<i8"),
+                                                 ("global_date", (), global_date_dtype),
+                                                 ("data", channel["frame_shape"], channel["dataset_type"]),
+                                                 ("is_data_present", (), "bool")):
+
+            shape = (self.n_expected_frames,) + frame_shape
+
+            datasets[dataset_name] = self.file.create_dataset("/data/" + name + "/" + dataset_name,
+                                                              shape=shape, maxshape=(None,) + frame_shape,
+                                                              dtype=dtype, **self._get_layout(shape, dtype))
+
+        datasets["global_date"].attrs.update(GLOBAL_DATE_ATTRIBUTES[self.global_date_format])
+        channel["capacity"] = self.n_expected_frames
+
+        return datasets
+
+    def _reserve_frames(self, channel, n_frames):
+
+        if n_frames <= channel["capacity"]:
+            return
+
+        capacity = max(n_frames, 2 * channel["capacity"])
+        _logger.debug("Resizing image datasets from %d to %d frames." % (channel["capacity"], capacity))
+
+        for dataset in channel["datasets"].values():
+            dataset.resize(capacity, axis=0)
+
+        channel["capacity"] = capacity
+
+    def close(self):
+
+        try:
+            for name, channel in self.channels.items():
+
+                if channel["datasets"] is None:
+                    if config.ERROR_IF_NO_DATA:
+                        raise ValueError("There is no data for channel %s." % name)
 
-        _logger.info("Building numpy arrays with received data.")
+                    _logger.error("There is no data for channel %s." % name)
+                    channel["datasets"] = self._create_channel_datasets(name, channel,
+                                                                        self._convert_global_dates([]).dtype)
 
-        datasets_data = self._build_datasets_data(json_data)
+                # Trim the preallocated frames that were not received.
+                for dataset in channel["datasets"].values():
+                    dataset.resize(channel["n_frames"], axis=0)
 
-        _logger.info("Writing data to disk.")
+                _logger.info("Written %d frames of channel %s." % (channel["n_frames"], name))
 
-        for name, data in datasets_data.items():
-            self.file["/data/" + name + "/pulse_id"] = data["pulse_id"]
-            self.file["/data/" + name + "/global_date"] = data["global_date"]
-            self.file["/data/" + name + "/data"] = data["data"]
-            self.file["/data/" + name + "/is_data_present"] = data["is_data_present"]
+        finally:
+            self.file.close()
@@ -1,25 +1,376 @@
+import argparse
 import json
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from time import time
 
-from line_profiler import LineProfiler
+import numpy
 
-from sf_databuffer_writer.writer_format import DataBufferH5Writer
+from sf_databuffer_writer.writer_format import DataBufferH5Writer, CompactDataBufferH5Writer
 
-data_file = "/Users/babic_a/tmp/perf_data.json"
-json_data = json.load(open(data_file))
+_logger = logging.getLogger(__name__)
 
-output_file = "ignore_output_new.h5"
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
 
-parameters = {"general/created": "test",
-              "general/user": "tester",
-              "general/process": "test_process",
-              "general/instrument": "mac",
-              "output_file": "test.h5"}
+WRITERS = {"dense": DataBufferH5Writer,
+           "compact": CompactDataBufferH5Writer}
 
-writer = DataBufferH5Writer(output_file, parameters)
-profiler = LineProfiler()
-profiled_write = profiler(writer.write_data)
+STAGES = ("parse", "build", "write", "total")
 
-profiled_write(json_data)
+# SwissFEL runs at 100Hz.
+PULSE_ID_PERIOD = timedelta(milliseconds=10)
 
-writer.close()
-profiler.print_stats()
+
+def load_sample_channel(sample_file, channel_index=0):
+    with open(os.path.join(DATA_FOLDER, sample_file)) as input_file:
+        return json.load(input_file)[channel_index]
+
+
+def get_sample_shapes():
+    """
+    Take the channel definitions of the synthesized data from the samples in tests/data.
+    """
+
+    waveform = load_sample_channel("dispatching_layer_sample.json", 0)
+    scalar = load_sample_channel("dispatching_layer_sample.json", 1)
+    camera = load_sample_channel("camera_image_sample.json", 0)
+
+    first_data_point = waveform["data"][0]
+
+    return {"start_pulse_id": first_data_point["pulseId"],
+            "start_global_date": first_data_point["globalDate"],
+            "scalar": scalar["configs"][0],
+            "waveform": waveform["configs"][0],
+            "image": camera["configs"][0],
+            "string": {"type": "string", "shape": [1]}}
+
+
+def format_global_date(start_date, timezone, pulse_offset):
+    # The data api uses nanosecond resolution, datetime only microseconds.
+    date = start_date + pulse_offset * PULSE_ID_PERIOD
+    return date.strftime("%Y-%m-%dT%H:%M:%S.%f") + "000" + timezone
+
+
+def generate_values(random, channel_type, channel_shape, n_values):
+
+    if channel_type == "string":
+        return ["value_%d" % value for value in random.randint(0, 1000000, size=n_values)]
+
+    dtype = numpy.dtype(channel_type)
+    # Bsread is [X, Y] but numpy is [Y, X].
+    values_shape = [n_values] + [size for size in channel_shape[::-1] if channel_shape != [1]]
+
+    if dtype.kind == "f":
+        values = random.standard_normal(size=values_shape).astype(dtype)
+    else:
+        values = random.randint(0, min(numpy.iinfo(dtype).max, 4096), size=values_shape).astype(dtype)
+
+    return [value.tolist() for value in values]
+
+
+def generate_channel(random, name, channel_config, pulse_ids, global_dates, gap_ratio):
+    """
+    Generate a channel in the data api format, with gap_ratio of the pulse_ids missing.
+    """
+
+    present = random.random_sample(len(pulse_ids)) >= gap_ratio
+    channel_pulse_ids = pulse_ids[present]
+    channel_global_dates = [global_date for global_date, is_present in zip(global_dates, present) if is_present]
+
+    values = generate_values(random, channel_config["type"], channel_config["shape"], len(channel_pulse_ids))
+
+    data = [{"pulseId": int(pulse_id), "globalDate": global_date, "shape": channel_config["shape"], "value": value}
+            for pulse_id, global_date, value in zip(channel_pulse_ids, channel_global_dates, values)]
+
+    return {"channel": {"name": name, "backend": "sf-databuffer"},
+            "configs": [dict(channel_config)],
+            "data": data}
+
+
+def generate_payload(n_events, n_channels, gap_ratio, image_shape=None, seed=0):
+    """
+    Generate a data api response, serialized to JSON.
+    n_channels is a dict with the number of channels for each channel kind (scalar, waveform, image, string).
+    """
+
+    random = numpy.random.RandomState(seed)
+    shapes = get_sample_shapes()
+
+    if image_shape is not None:
+        shapes["image"] = dict(shapes["image"], shape=image_shape)
+
+    start_global_date = shapes["start_global_date"]
+    start_date = datetime.strptime(start_global_date[:26], "%Y-%m-%dT%H:%M:%S.%f")
+    timezone = start_global_date[-6:]
+
+    pulse_ids = numpy.arange(shapes["start_pulse_id"], shapes["start_pulse_id"] + n_events, dtype="<i8")
+    global_dates = [format_global_date(start_date, timezone, pulse_offset) for pulse_offset in range(n_events)]
+
+    json_data = []
+
+    for kind in ("scalar", "waveform", "image", "string"):
+        for channel_index in range(n_channels.get(kind, 0)):
+            json_data.append(generate_channel(random, "%s_%d" % (kind.upper(), channel_index), shapes[kind],
+                                              pulse_ids, global_dates, gap_ratio))
+
+    return json.dumps(json_data)
+
+
+def get_writer_parameters(extra_parameters=None):
+
+    parameters = {"general/created": "test",
+                  "general/user": "tester",
+                  "general/process": "perf_writer_format",
+                  "general/instrument": "benchmark"}
+
+    if extra_parameters:
+        parameters.update(extra_parameters)
+
+    return parameters
+
+
+def run_stages(writer_class, payload, output_file, parameters):
+    """
+    Run parse, build and write once. Returns the duration of each stage.
+
+    build and write are measured separately on the same parsed data. total is the end to end write_data call on a
+    freshly parsed copy, as the writer process does it.
+    """
+
+    timings = {}
+
+    start_time = time()
+    json_data = json.loads(payload)
+    timings["parse"] = time() - start_time
+
+    writer = writer_class(output_file, parameters)
+
+    try:
+        start_time = time()
+        datasets_data = writer._build_datasets_data(json_data)
+        timings["build"] = time() - start_time
+
+        if writer_class is DataBufferH5Writer:
+            pulse_ids, datasets_data = datasets_data
+            for data in datasets_data.values():
+                data["pulse_id"] = pulse_ids
+
+        start_time = time()
+        writer._prepare_format_datasets()
+        for name, data in datasets_data.items():
+            writer._write_channel_datasets(name, data)
+
+    finally:
+        writer.close()
+
+    timings["write"] = time() - start_time
+
+    del json_data, datasets_data
+
+    json_data = json.loads(payload)
+    writer = writer_class(output_file, parameters)
+
+    try:
+        start_time = time()
+        writer.write_data(json_data, release_input=True)
+
+    finally:
+        writer.close()
+
+    timings["total"] = time() - start_time
+
+    return timings
+
+
+def measure_peak_memory(writer_class, payload, output_file, parameters):
+    """
+    Peak memory allocated while parsing the payload and writing it with write_data, in bytes.
+    """
+
+    tracemalloc.start()
+
+    try:
+        json_data = json.loads(payload)
+        writer = writer_class(output_file, parameters)
+
+        try:
+            writer.write_data(json_data, release_input=True)
+        finally:
+            writer.close()
+
+        return tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(writers, payload, output_folder, parameters, n_repetitions=3, measure_memory=True):
+    """
+    Returns, for each writer, the best time of each stage over n_repetitions and the peak memory.
+    """
+
+    results = {}
+
+    for writer_name in writers:
+        writer_class = WRITERS[writer_name]
+        output_file = os.path.join(output_folder, "perf_%s.h5" % writer_name)
+
+        _logger.info("Benchmarking writer %s." % writer_name)
+
+        try:
+            repetitions = [run_stages(writer_class, payload, output_file, parameters) for _ in range(n_repetitions)]
+
+        except Exception as e:
+            _logger.error("Writer %s failed: %s" % (writer_name, e))
+            results[writer_name] = {"error": str(e)}
+            continue
+
+        result = {stage: min(timings[stage] for timings in repetitions) for stage in STAGES}
+
+        if measure_memory:
+            result["peak_memory"] = measure_peak_memory(writer_class, payload, output_file, parameters)
+
+        result["file_size"] = os.path.getsize(output_file)
+
+        results[writer_name] = result
+
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Return the list of stages that are more than tolerance (relative) slower than in the baseline.
+    """
+
+    regressions = []
+
+    for writer_name, result in results.items():
+        if "error" in result:
+            regressions.append("%s failed: %s" % (writer_name, result["error"]))
+            continue
+
+        for name, value in result.items():
+            baseline_value = baseline.get(writer_name, {}).get(name)
+
+            if not baseline_value or name == "file_size":
+                continue
+
+            if value > baseline_value * (1 + tolerance):
+                regressions.append("%s %s: %.3f (baseline %.3f)" % (writer_name, name, value, baseline_value))
+
+    return regressions
+
+
+def print_results(results):
+
+    print("%-10s" % "writer" + "".join("%12s" % ("%s [s]" % stage) for stage in STAGES) +
+          "%16s%16s" % ("peak_mem [MB]", "file [MB]"))
+
+    for writer_name, result in results.items():
+        if "error" in result:
+            print("%-10s failed: %s" % (writer_name, result["error"]))
+            continue
+
+        peak_memory = result.get("peak_memory")
+
+        print("%-10s" % writer_name + "".join("%12.3f" % result[stage] for stage in STAGES) +
+              "%16s%16.1f" % ("%.1f" % (peak_memory / 2**20) if peak_memory is not None else "-",
+                              result["file_size"] / 2**20))
+
+
+def print_speedup(results, writer_name, parallel_writer_name):
+    """
+    Only the total (write_data) uses the conversion processes, the other stages are measured serially.
+    """
+
+    if "error" in results[writer_name] or "error" in results[parallel_writer_name]:
+        return
+
+    print("Speedup of %s over %s (total): %.2fx" % (parallel_writer_name, writer_name,
+                                                     results[writer_name]["total"] /
+                                                     results[parallel_writer_name]["total"]))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Writer format benchmark')
+    parser.add_argument("--n_events", type=int, default=1000, help="Number of pulse_ids in the request.")
+    parser.add_argument("--scalar_channels", type=int, default=100, help="Number of scalar channels.")
+    parser.add_argument("--waveform_channels", type=int, default=10, help="Number of 1D waveform channels.")
+    parser.add_argument("--image_channels", type=int, default=1, help="Number of 2D camera channels.")
+    parser.add_argument("--string_channels", type=int, default=5, help="Number of string channels.")
+    parser.add_argument("--image_shape", type=int, nargs=2, default=[64, 64],
+                        help="Shape [X, Y] of camera images. Use 0 0 for the shape of the camera sample.")
+    parser.add_argument("--gap_ratio", type=float, default=0.1, help="Ratio of missing pulse_ids in each channel.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data generator.")
+    parser.add_argument("--writer", default="all", choices=["all"] + list(WRITERS), help="Writer to benchmark.")
+    parser.add_argument("--repetitions", type=int, default=3, help="Number of runs. The best time is reported.")
+    parser.add_argument("--parameters", type=json.loads, default=None,
+                        help="JSON with additional writer parameters, for example output_compression.")
+    parser.add_argument("--conversion_processes", type=int, default=0,
+                        help="Also run the compact writer with this number of conversion processes and report the "
+                             "speedup of write_data.")
+    parser.add_argument("--no_memory", action="store_true", help="Do not measure the peak memory.")
+    parser.add_argument("--output_folder", default=None, help="Where to write the output files. Default: temp folder.")
+    parser.add_argument("--json_output", default=None, help="Save the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="Compare the results against this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown against the baseline reported as regression.")
+    parser.add_argument("--log_level", default="WARNING",
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], help="Log level to use.")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='[%(levelname)s] %(message)s')
+
+    n_channels = {"scalar": args.scalar_channels,
+                  "waveform": args.waveform_channels,
+                  "image": args.image_channels,
+                  "string": args.string_channels}
+
+    image_shape = args.image_shape if all(args.image_shape) else None
+
+    start_time = time()
+    payload = generate_payload(args.n_events, n_channels, args.gap_ratio, image_shape, args.seed)
+    print("Generated %.1f MB payload with n_events=%d, channels=%s and gap_ratio=%s in %.1f seconds." %
+          (len(payload) / 2**20, args.n_events, n_channels, args.gap_ratio, time() - start_time))
+
+    writers = list(WRITERS) if args.writer == "all" else [args.writer]
+    parameters = get_writer_parameters(args.parameters)
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        results = run_benchmark(writers, payload, args.output_folder or temp_folder, parameters,
+                                args.repetitions, not args.no_memory)
+
+        if args.conversion_processes > 1:
+            parallel_parameters = dict(parameters, output_conversion_processes=args.conversion_processes)
+            parallel_results = run_benchmark(["compact"], payload, args.output_folder or temp_folder,
+                                             parallel_parameters, args.repetitions, not args.no_memory)
+
+            results["compact_x%d" % args.conversion_processes] = parallel_results["compact"]
+
+    print_results(results)
+
+    if args.conversion_processes > 1:
+        print_speedup(results, "compact", "compact_x%d" % args.conversion_processes)
+
+    if args.json_output:
+        with open(args.json_output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as input_file:
+            regressions = compare_results(results, json.load(input_file), args.tolerance)
+
+        if regressions:
+            print("Performance regressions:\n%s" % "\n".join(regressions))
+            sys.exit(1)
+
+        print("No performance regressions against %s." % args.baseline)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import unittest
+from time import sleep
+
+from sf_databuffer_writer.audit import AuditTrailWriter
+from sf_databuffer_writer.utils import get_writer_request
+
+
+class TestAuditTrailWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.audit_file = os.path.join(self.temp_folder.name, "audit.log")
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def read_lines(self, filename=None):
+        with open(filename or self.audit_file) as input_file:
+            return input_file.readlines()
+
+    def get_write_request(self, index):
+        return get_writer_request(["test_1"], {"output_file": "run_%s.h5" % index}, index * 100, index * 100 + 99)
+
+    def test_text_format(self):
+        audit_trail = AuditTrailWriter(self.audit_file, fsync_policy="always")
+
+        write_requests = [self.get_write_request(index) for index in range(100)]
+        for write_request in write_requests:
+            audit_trail.write(write_request)
+
+        audit_trail.flush()
+
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 100)
+        self.assertListEqual([json.loads(line[18:]) for line in lines], write_requests)
+
+        audit_trail.write(self.get_write_request(100))
+        audit_trail.close()
+
+        self.assertEqual(len(self.read_lines()), 101)
+
+    def test_jsonl_format(self):
+        audit_trail = AuditTrailWriter(self.audit_file, audit_format="jsonl", fsync_policy="never")
+
+        write_request = self.get_write_request(1)
+        audit_trail.write(write_request)
+        audit_trail.close()
+
+        record = json.loads(self.read_lines()[0])
+
+        self.assertEqual(len(record["audit_time"]), 15)
+        self.assertDictEqual(record["data_api_request"], json.loads(write_request["data_api_request"]))
+        self.assertDictEqual(record["parameters"], json.loads(write_request["parameters"]))
+        self.assertEqual(record["timestamp"], write_request["timestamp"])
+
+        with self.assertRaises(ValueError):
+            AuditTrailWriter(self.audit_file, audit_format="xml")
+
+        with self.assertRaises(ValueError):
+            AuditTrailWriter(self.audit_file, fsync_policy="sometimes")
+
+    def test_rotation(self):
+        write_requests = [self.get_write_request(index) for index in range(5)]
+        audit_trail = AuditTrailWriter(self.audit_file, max_bytes=1, backup_count=2)
+
+        # Every flushed batch goes to a new file, and only 2 old files are kept.
+        for index in range(4):
+            audit_trail.write(write_requests[index])
+            audit_trail.flush()
+
+        audit_trail.close()
+
+        self.assertEqual(json.loads(self.read_lines()[0][18:]), write_requests[3])
+        self.assertEqual(json.loads(self.read_lines(self.audit_file + ".1")[0][18:]), write_requests[2])
+        self.assertEqual(json.loads(self.read_lines(self.audit_file + ".2")[0][18:]), write_requests[1])
+        self.assertFalse(os.path.exists(self.audit_file + ".3"))
+
+        # A file left over from a previous run is rotated as well.
+        audit_trail = AuditTrailWriter(self.audit_file, max_bytes=1, backup_count=2)
+        audit_trail.write(write_requests[4])
+        audit_trail.close()
+
+        self.assertEqual(len(self.read_lines()), 1)
+        self.assertEqual(json.loads(self.read_lines(self.audit_file + ".1")[0][18:]), write_requests[3])
+
+    def test_retry_failed_writes(self):
+        audit_file = os.path.join(self.temp_folder.name, "missing", "audit.log")
+        audit_trail = AuditTrailWriter(audit_file, retry_interval=0.05)
+
+        write_requests = [self.get_write_request(index) for index in range(3)]
+
+        audit_trail.write(write_requests[0])
+        audit_trail.flush()
+
+        # The folder does not exist yet, so the request is kept and written again every retry_interval.
+        os.mkdir(os.path.dirname(audit_file))
+
+        for _ in range(100):
+            if os.path.exists(audit_file):
+                break
+            sleep(0.05)
+
+        self.assertEqual(len(self.read_lines(audit_file)), 1)
+
+        for write_request in write_requests[1:]:
+            audit_trail.write(write_request)
+
+        audit_trail.close()
+
+        self.assertListEqual([json.loads(line[18:]) for line in self.read_lines(audit_file)], write_requests)
@@ -105,6 +105,8 @@ class TestBrokerManager(unittest.TestCase):
         data_api_request = json.loads(request_sender.write_request["data_api_request"])
         request_parameters = json.loads(request_sender.write_request["parameters"])
 
+        manager.close()
+
         with open(TestBrokerManager.TEST_AUDIT_FILE) as input_file:
             lines = input_file.readlines()
 
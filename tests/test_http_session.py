@@ -0,0 +1,32 @@
+import unittest
+from unittest.mock import patch
+
+from sf_databuffer_writer import config, http_session
+
+
+class TestHttpSession(unittest.TestCase):
+
+    def test_shared_session(self):
+
+        # The session shared by the other tests is restored at the end.
+        with patch.object(http_session, "_session", None), patch.object(http_session, "_session_pid", None):
+            session = http_session.get_session()
+            self.assertIs(http_session.get_session(), session)
+
+            # Simulate a forked process.
+            http_session._session_pid = -1
+            self.assertIsNot(http_session.get_session(), session)
+
+    def test_create_session(self):
+        session = http_session.create_session(pool_size=3, retries=2)
+
+        adapter = session.get_adapter("http://localhost")
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        self.assertEqual(adapter.max_retries.read, 0)
+
+        self.assertIs(session.get_adapter("https://localhost"), adapter)
+
+    def test_default_timeout(self):
+        self.assertEqual(http_session.get_default_timeout(),
+                         (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT))
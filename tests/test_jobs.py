@@ -0,0 +1,126 @@
+import unittest
+
+import os
+import tempfile
+from threading import Event
+from time import sleep, time
+from unittest.mock import patch
+
+from sf_databuffer_writer import config
+from sf_databuffer_writer.jobs import DetectorRetrievalJobManager
+
+
+class TestDetectorRetrievalJobManager(unittest.TestCase):
+
+    def setUp(self):
+        self.log_folder = tempfile.TemporaryDirectory()
+
+        self.pending_jobs_file = os.path.join(self.log_folder.name, "detector_jobs.json")
+        self.config_patch = patch.object(config, "DETECTOR_RETRIEVAL_PENDING_JOBS_FILE", self.pending_jobs_file)
+        self.config_patch.start()
+
+    def tearDown(self):
+        self.config_patch.stop()
+        self.log_folder.cleanup()
+
+    def wait_for_jobs(self, manager, timeout=5):
+        start_time = time()
+
+        while manager.get_jobs("queued") or manager.get_jobs("running"):
+            if time() - start_time > timeout:
+                raise TimeoutError("Jobs did not complete in time.")
+            sleep(0.05)
+
+    def test_exit_code_and_log(self):
+        manager = DetectorRetrievalJobManager(max_concurrency=2, max_concurrency_per_detector=1)
+
+        log_filename = os.path.join(self.log_folder.name, "ok.log")
+        ok_job_id = manager.submit("JF01", "echo retrieved", log_filename)
+        failed_job_id = manager.submit("JF02", "exit 3", os.path.join(self.log_folder.name, "failed.log"))
+
+        self.wait_for_jobs(manager)
+
+        ok_job = manager.get_job(ok_job_id)
+        self.assertEqual(ok_job["state"], "finished")
+        self.assertEqual(ok_job["exit_code"], 0)
+        self.assertIsNotNone(ok_job["runtime"])
+
+        with open(log_filename) as log_file:
+            self.assertEqual(log_file.read(), "retrieved\n")
+
+        failed_job = manager.get_job(failed_job_id)
+        self.assertEqual(failed_job["state"], "failed")
+        self.assertEqual(failed_job["exit_code"], 3)
+
+        self.assertDictEqual(manager.get_statistics(), {"finished": 1, "failed": 1})
+
+    def test_concurrency_limits(self):
+        manager = DetectorRetrievalJobManager(max_concurrency=2, max_concurrency_per_detector=1)
+
+        for detector in ("JF01", "JF01", "JF02", "JF03"):
+            manager.submit(detector, "sleep 0.3", os.path.join(self.log_folder.name, detector + ".log"))
+
+        sleep(0.1)
+
+        # The second JF01 job waits for the first one, JF03 waits for a global slot.
+        running_detectors = sorted(job["detector"] for job in manager.get_jobs("running"))
+        self.assertListEqual(running_detectors, ["JF01", "JF02"])
+        self.assertEqual(len(manager.get_jobs("queued")), 2)
+
+        self.wait_for_jobs(manager)
+        self.assertEqual(len(manager.get_jobs("finished")), 4)
+
+    def test_submit_while_starting(self):
+        manager = DetectorRetrievalJobManager(max_concurrency=2, max_concurrency_per_detector=1)
+        release_start = Event()
+
+        def slow_popen(*args, **kwargs):
+            release_start.wait(timeout=5)
+            raise OSError("Cannot start.")
+
+        with patch("sf_databuffer_writer.jobs.Popen", slow_popen):
+            manager.submit("JF01", "echo retrieved", os.path.join(self.log_folder.name, "JF01.log"))
+            sleep(0.1)
+
+            # A starting process does not block the submission of new jobs.
+            start_time = time()
+            manager.submit("JF02", "echo retrieved", os.path.join(self.log_folder.name, "JF02.log"))
+            self.assertLess(time() - start_time, 0.5)
+
+            release_start.set()
+            self.wait_for_jobs(manager)
+
+        self.assertDictEqual(manager.get_statistics(), {"failed": 2})
+
+    def test_history_length(self):
+        manager = DetectorRetrievalJobManager(max_concurrency=4, max_concurrency_per_detector=4, history_length=2)
+
+        for index in range(4):
+            manager.submit("JF01", "true", os.path.join(self.log_folder.name, "%d.log" % index))
+
+        self.wait_for_jobs(manager)
+
+        self.assertListEqual([job["job_id"] for job in manager.get_jobs()], [3, 4])
+
+    def test_reload_pending_jobs(self):
+        manager = DetectorRetrievalJobManager(max_concurrency=1)
+
+        for index in range(3):
+            manager.submit("JF01", "sleep 0.3", os.path.join(self.log_folder.name, "JF01_%d.log" % index))
+
+        sleep(0.1)
+        manager.close()
+
+        # The running job continues, the queued ones are started by the next manager.
+        self.assertEqual(len(manager.get_jobs("running")), 1)
+        self.assertEqual(len(manager.get_jobs("queued")), 2)
+
+        manager = DetectorRetrievalJobManager(max_concurrency=1)
+        self.assertListEqual([job["log_filename"] for job in manager.get_jobs()],
+                             [os.path.join(self.log_folder.name, "JF01_%d.log" % index) for index in (1, 2)])
+
+        self.wait_for_jobs(manager)
+        self.assertEqual(len(manager.get_jobs("finished")), 2)
+
+        manager.close()
+        self.assertListEqual(DetectorRetrievalJobManager().get_jobs(), [])
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+from sf_databuffer_writer.journal import RequestJournal
+
+
+class TestRequestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.temp_folder.name, "writer_journal.jsonl")
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def get_n_records(self):
+        with open(self.journal_file) as input_file:
+            return len(input_file.readlines())
+
+    def test_replay_unfinished(self):
+        journal = RequestJournal(self.journal_file, fsync_interval=0.01)
+
+        ids = [journal.accept({"range": {"startPulseId": index}}, {"output_file": "/tmp/%s.h5" % index}, index)
+               for index in range(3)]
+
+        journal.done(ids[1])
+        # Simulate a crash: the journal is not closed.
+        journal.sync()
+
+        journal = RequestJournal(self.journal_file)
+        unfinished = journal.get_unfinished()
+
+        self.assertListEqual([request[0] for request in unfinished], [ids[0], ids[2]])
+        self.assertDictEqual(unfinished[1][1], {"range": {"startPulseId": 2}})
+        self.assertDictEqual(unfinished[1][2], {"output_file": "/tmp/2.h5"})
+        self.assertEqual(unfinished[1][3], 2)
+
+        # Compacted on open.
+        self.assertEqual(self.get_n_records(), 2)
+
+        # New ids do not collide with the replayed ones.
+        new_id = journal.accept({}, {}, 3)
+        self.assertGreater(new_id, ids[2])
+
+        for journal_id in (ids[0], ids[2], new_id):
+            journal.done(journal_id)
+
+        journal.close()
+
+        self.assertListEqual(RequestJournal(self.journal_file).get_unfinished(), [])
+
+    def test_compact_threshold(self):
+        journal = RequestJournal(self.journal_file, compact_threshold=2)
+
+        first_id = journal.accept({}, {}, 0)
+        for index in range(3):
+            journal.done(journal.accept({}, {}, index))
+
+        journal.close()
+
+        # The compaction after the second done record leaves only the first request.
+        self.assertLessEqual(self.get_n_records(), 3)
+        self.assertListEqual([request[0] for request in RequestJournal(self.journal_file).get_unfinished()],
+                             [first_id])
+
+    def test_corrupted_record(self):
+        journal = RequestJournal(self.journal_file)
+        journal_id = journal.accept({}, {"output_file": "/tmp/test.h5"}, 0)
+        journal.close()
+
+        # The writer died while appending a record.
+        with open(self.journal_file, "a") as output_file:
+            output_file.write('{"type": "acc')
+
+        unfinished = RequestJournal(self.journal_file).get_unfinished()
+        self.assertListEqual([request[0] for request in unfinished], [journal_id])
+
+    def test_attempts(self):
+        journal = RequestJournal(self.journal_file)
+        journal_id = journal.accept({}, {"output_file": "/tmp/test.h5"}, 0)
+
+        journal.started(journal_id)
+        journal.started(journal_id)
+        self.assertEqual(journal.get_attempts(journal_id), 2)
+        journal.close()
+
+        # The attempts are kept when the journal is reloaded and compacted.
+        journal = RequestJournal(self.journal_file)
+        self.assertEqual(journal.get_attempts(journal_id), 2)
+        self.assertEqual(self.get_n_records(), 1)
+
+        journal.started(journal_id)
+        journal.close()
+
+        self.assertEqual(RequestJournal(self.journal_file).get_attempts(journal_id), 3)
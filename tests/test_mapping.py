@@ -0,0 +1,54 @@
+import unittest
+from time import sleep
+
+from sf_databuffer_writer.mapping import PulseIdMappingCache
+
+
+class TestPulseIdMappingCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = PulseIdMappingCache(max_size=10, ttl=10, interpolation_max_distance=0)
+
+        self.assertIsNone(cache.get(100, 201))
+        cache.put(100, 201, "1528459491.000000000", "1528459492.010000000")
+
+        self.assertTupleEqual(cache.get(100, 201), ("1528459491.000000000", "1528459492.010000000"))
+        self.assertIsNone(cache.get(100, 202))
+
+        statistics = cache.get_statistics()
+        self.assertEqual(statistics["n_hits"], 1)
+        self.assertEqual(statistics["n_misses"], 2)
+        self.assertEqual(statistics["n_cached"], 1)
+
+    def test_lru_and_ttl(self):
+        cache = PulseIdMappingCache(max_size=2, ttl=0.2, interpolation_max_distance=0)
+
+        cache.put(0, 1, 0.0, 0.01)
+        cache.put(10, 11, 0.1, 0.11)
+        # Use the first mapping, so the second is the least recently used.
+        self.assertIsNotNone(cache.get(0, 1))
+        cache.put(20, 21, 0.2, 0.21)
+
+        self.assertIsNotNone(cache.get(0, 1))
+        self.assertIsNone(cache.get(10, 11))
+        self.assertIsNotNone(cache.get(20, 21))
+
+        sleep(0.3)
+
+        self.assertIsNone(cache.get(0, 1))
+        self.assertEqual(cache.get_statistics()["n_expired"], 1)
+
+    def test_interpolation(self):
+        cache = PulseIdMappingCache(max_size=10, ttl=10, interpolation_max_distance=1000)
+
+        cache.put(1000, 1101, "1528459491.551143344", "1528459492.561143344")
+
+        # 100Hz: 1 pulse every 10ms.
+        self.assertTupleEqual(cache.get(1050, 1201), ("1528459492.051143344", "1528459493.561143344"))
+        self.assertEqual(cache.get_statistics()["n_interpolated"], 1)
+
+        # Too far from any anchor.
+        self.assertIsNone(cache.get(1050, 2500))
+
+        cache.put(5000, 5101, 100.0, 101.01)
+        self.assertTupleEqual(cache.get(4900, 5000), (99.0, 100.0))
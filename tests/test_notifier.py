@@ -0,0 +1,110 @@
+import unittest
+from threading import Thread, Event, Timer
+from time import sleep, time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import bottle
+
+from sf_databuffer_writer.notifier import EpicsWriterNotifier
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class TestEpicsWriterNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.received_requests = []
+        self.release_requests = Event()
+        self.release_requests.set()
+
+        app = bottle.Bottle()
+
+        @app.put("/notify")
+        def notify():
+            self.release_requests.wait()
+            self.received_requests.append(bottle.request.json)
+
+        @app.put("/fail")
+        def fail():
+            bottle.abort(500, "Epics writer failed.")
+
+        self.server = make_server("localhost", 10201, app, handler_class=QuietHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.release_requests.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_notify(self):
+        notifier = EpicsWriterNotifier("http://localhost:10201/notify", n_workers=1, queue_length=10)
+
+        for index in range(3):
+            self.assertTrue(notifier.notify({"index": index}))
+
+        notifier.stop()
+
+        self.assertListEqual(self.received_requests, [{"index": 0}, {"index": 1}, {"index": 2}])
+
+        statistics = notifier.get_statistics()
+        self.assertEqual(statistics["n_sent"], 3)
+        self.assertEqual(statistics["n_failed"], 0)
+        self.assertEqual(statistics["n_in_flight"], 0)
+        self.assertEqual(statistics["n_queued"], 0)
+        self.assertIsNotNone(statistics["average_latency"])
+
+    def test_retry_and_fail(self):
+        # Nothing listens on this port.
+        notifier = EpicsWriterNotifier("http://localhost:10209/notify", n_workers=1, queue_length=10,
+                                       retries=2, retry_backoff=0.01)
+
+        notifier.notify({"index": 0})
+        notifier.stop()
+
+        statistics = notifier.get_statistics()
+        self.assertEqual(statistics["n_sent"], 0)
+        self.assertEqual(statistics["n_failed"], 1)
+        self.assertEqual(statistics["n_retries"], 2)
+
+    def test_no_retry_after_response(self):
+        notifier = EpicsWriterNotifier("http://localhost:10201/fail", n_workers=1, queue_length=10,
+                                       retries=2, retry_backoff=0.01)
+
+        notifier.notify({"index": 0})
+        notifier.stop()
+
+        statistics = notifier.get_statistics()
+        self.assertEqual(statistics["n_failed"], 1)
+        self.assertEqual(statistics["n_retries"], 0)
+
+    def test_queue_full(self):
+        self.release_requests.clear()
+
+        notifier = EpicsWriterNotifier("http://localhost:10201/notify", n_workers=1, queue_length=2, queue_timeout=0.2)
+
+        # The first request blocks the only worker, the next 2 fill the queue.
+        self.assertTrue(notifier.notify({"index": 0}))
+        sleep(0.2)
+        self.assertTrue(notifier.notify({"index": 1}))
+        self.assertTrue(notifier.notify({"index": 2}))
+
+        # The request is rejected only after waiting queue_timeout seconds for a free slot.
+        start_time = time()
+        self.assertFalse(notifier.notify({"index": 3}))
+        self.assertGreaterEqual(time() - start_time, 0.2)
+
+        statistics = notifier.get_statistics()
+        self.assertEqual(statistics["n_in_flight"], 1)
+        self.assertEqual(statistics["n_queued"], 2)
+        self.assertEqual(statistics["n_rejected"], 1)
+
+        # A slot freed while waiting is taken.
+        Timer(0.1, self.release_requests.set).start()
+        self.assertTrue(notifier.notify({"index": 4}))
+
+        notifier.stop()
+
+        self.assertEqual(notifier.get_statistics()["n_sent"], 4)
@@ -0,0 +1,91 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from time import sleep
+
+from sf_databuffer_writer.pipeline import RequestPipeline
+
+
+class TestRequestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.events_lock = Lock()
+        self.n_done = 0
+
+    def log_event(self, event):
+        with self.events_lock:
+            self.events.append(event)
+
+    def retrieve(self, index):
+        self.log_event(("retrieve_start", index))
+        sleep(0.05)
+        self.log_event(("retrieve_end", index))
+
+        # Nothing to write for odd requests.
+        if index % 2:
+            return None
+
+        return (index,)
+
+    def write(self, index):
+        self.log_event(("write_start", index))
+        sleep(0.1)
+        self.log_event(("write_end", index))
+
+    def done(self):
+        self.n_done += 1
+
+    def test_overlap(self):
+        pipeline = RequestPipeline(self.retrieve, self.write, n_retrieve_workers=1, queue_length=1,
+                                   on_done=self.done)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for index in range(0, 8, 2):
+                executor.submit(pipeline.process_request, index)
+
+        pipeline.stop()
+
+        written = [event[1] for event in self.events if event[0] == "write_end"]
+        self.assertListEqual(written, [0, 2, 4, 6])
+
+        # The second request was retrieved while the first one was being written.
+        self.assertLess(self.events.index(("retrieve_start", 2)), self.events.index(("write_end", 0)))
+
+        statistics = pipeline.get_statistics()
+        self.assertEqual(statistics["n_retrieved"], 4)
+        self.assertEqual(statistics["n_written"], 4)
+        self.assertEqual(statistics["n_queued"], 0)
+        self.assertGreater(statistics["retrieve_blocked_time"], 0)
+        self.assertGreater(statistics["write_utilization"], 0)
+        self.assertLessEqual(statistics["write_utilization"], 1)
+        self.assertEqual(self.n_done, 4)
+
+    def test_nothing_to_write(self):
+        pipeline = RequestPipeline(self.retrieve, self.write, n_retrieve_workers=2, queue_length=2,
+                                   on_done=self.done)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for index in range(4):
+                executor.submit(pipeline.process_request, index)
+
+        pipeline.stop()
+
+        written = sorted(event[1] for event in self.events if event[0] == "write_end")
+        self.assertListEqual(written, [0, 2])
+        self.assertEqual(self.n_done, 4)
+
+    def test_write_error(self):
+        write_done = Event()
+
+        def write(index):
+            write_done.set()
+            raise RuntimeError("Cannot write.")
+
+        pipeline = RequestPipeline(self.retrieve, write, n_retrieve_workers=1, queue_length=1, on_done=self.done)
+        pipeline.process_request(0)
+        pipeline.stop()
+
+        self.assertTrue(write_done.is_set())
+        self.assertEqual(pipeline.get_statistics()["n_written"], 1)
+        self.assertEqual(self.n_done, 1)
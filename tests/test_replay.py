@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sf_databuffer_writer.audit import AuditTrailWriter
+from sf_databuffer_writer.broker_manager import audit_write_request
+from sf_databuffer_writer.replay import replay_requests
+from sf_databuffer_writer.utils import get_writer_request
+from sf_databuffer_writer.writer import audit_failed_write_request
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.audit_file = os.path.join(self.temp_folder.name, "audit.log")
+        self.state_file = os.path.join(self.temp_folder.name, "replay_state.jsonl")
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def get_output_file(self, name):
+        return os.path.join(self.temp_folder.name, "run", name)
+
+    def audit(self, parameters, start_pulse_id, stop_pulse_id):
+        # Requests without channels have nothing to retrieve, so they succeed without the data api.
+        parameters = dict(parameters, channels=[])
+        audit_write_request(self.audit_file, get_writer_request([], parameters, start_pulse_id, stop_pulse_id))
+
+    def test_replay_audit_trail(self):
+        self.audit({"output_file": self.get_output_file("run_1.h5")}, 100, 200)
+        self.audit({"output_file": self.get_output_file("run_1.h5")}, 100, 200)
+        # Requests without an output_file fail.
+        self.audit({}, 200, 300)
+
+        with open(self.audit_file, "a") as audit_file:
+            audit_file.write("[20180101-000000] {not a request\n")
+
+        statistics = replay_requests([self.audit_file], state_file=self.state_file)
+
+        self.assertEqual(statistics["n_files"], 1)
+        self.assertEqual(statistics["n_requests"], 3)
+        self.assertEqual(statistics["n_invalid"], 1)
+        self.assertEqual(statistics["n_duplicated"], 1)
+        self.assertEqual(statistics["n_succeeded"], 1)
+        self.assertEqual(statistics["n_failed"], 1)
+        self.assertListEqual(statistics["failed_requests"], ["None:200-300"])
+
+        # The successful request is not replayed again.
+        statistics = replay_requests([self.audit_file], state_file=self.state_file)
+
+        self.assertEqual(statistics["n_already_replayed"], 1)
+        self.assertEqual(statistics["n_succeeded"], 0)
+        self.assertEqual(statistics["n_failed"], 1)
+
+    def test_filters(self):
+        for index in range(4):
+            self.audit({"output_file": self.get_output_file("run_%s.h5" % index)}, index * 100, index * 100 + 99)
+
+        statistics = replay_requests([self.audit_file], dry_run=True, start_pulse_id=150, end_pulse_id=250)
+        self.assertEqual(statistics["n_filtered"], 2)
+
+        statistics = replay_requests([self.audit_file], output_file_pattern="*/run_3.h5")
+        self.assertEqual(statistics["n_filtered"], 3)
+        self.assertEqual(statistics["n_succeeded"], 1)
+
+    def test_replay_jsonl_audit_trail(self):
+        audit_trail = AuditTrailWriter(self.audit_file, audit_format="jsonl")
+
+        for index in range(2):
+            parameters = {"output_file": self.get_output_file("run_%s.h5" % index), "channels": []}
+            audit_trail.write(get_writer_request([], parameters, index * 100, index * 100 + 99))
+
+        audit_trail.close()
+
+        statistics = replay_requests([self.audit_file], start_pulse_id=150)
+        self.assertEqual(statistics["n_filtered"], 1)
+        self.assertEqual(statistics["n_succeeded"], 1)
+
+    def test_replay_err_files(self):
+        for index in range(2):
+            output_file = self.get_output_file("run_%s.h5" % index)
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+            audit_failed_write_request({"range": {"startPulseId": index, "endPulseId": index + 1}, "channels": []},
+                                       {"output_file": output_file}, 0)
+
+        statistics = replay_requests([self.temp_folder.name], n_workers=2, state_file=self.state_file)
+
+        self.assertEqual(statistics["n_files"], 2)
+        self.assertEqual(statistics["n_succeeded"], 2)
+
+        with open(self.state_file) as input_file:
+            states = [json.loads(line) for line in input_file]
+
+        self.assertTrue(all(state["success"] for state in states))
+
+    def test_replay_time_range_requests(self):
+        output_file = self.get_output_file("run_time.h5")
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        # The writer transforms pulse_id requests to time requests with TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY.
+        audit_failed_write_request({"range": {"startSeconds": "1.0", "endSeconds": "2.0"}, "channels": []},
+                                   {"output_file": output_file}, 0)
+
+        with open(self.audit_file, "w") as audit_file:
+            audit_file.write('[20180101-000000] {"data_api_request": {"range": {}}, "parameters": {}, '
+                             '"timestamp": 0}\n')
+
+        statistics = replay_requests([self.audit_file, output_file + ".err"], dry_run=True, start_pulse_id=0)
+        self.assertEqual(statistics["n_invalid"], 1)
+        self.assertEqual(statistics["n_filtered"], 1)
+
+        statistics = replay_requests([self.audit_file, output_file + ".err"])
+        self.assertEqual(statistics["n_invalid"], 1)
+        self.assertEqual(statistics["n_succeeded"], 1)
@@ -0,0 +1,266 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from threading import Thread
+from unittest.mock import patch
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import bottle
+import h5py
+import numpy
+
+from sf_databuffer_writer import config, response_format, utils
+from sf_databuffer_writer.writer import get_data_from_buffer, retrieve_request, stream_data_from_buffer, \
+    write_data_to_file
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def create_data_api_app(json_data):
+    """
+    Stand-in for the data api query endpoint, answering in the format and compression of the request.
+    """
+
+    app = bottle.Bottle()
+
+    @app.post("/query")
+    def query():
+        response = bottle.request.json.get("response", {})
+
+        if response.get("format") == "binary":
+            content = response_format.encode_binary_response(json_data)
+        else:
+            content = json.dumps(json_data).encode()
+
+        if response.get("compression") == "gzip":
+            content = gzip.compress(content)
+        elif response.get("compression") == "lz4":
+            content = response_format.lz4.frame.compress(content)
+
+        bottle.response.content_type = "application/octet-stream"
+        return content
+
+    return app
+
+
+class TestResponseFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
+
+        with open(os.path.join(self.data_folder, "dispatching_layer_sample.json")) as input_file:
+            self.json_data = json.load(input_file)
+
+        self.server = make_server("localhost", 10202, create_data_api_app(self.json_data), handler_class=QuietHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.data_api_query_address = config.DATA_API_QUERY_ADDRESS
+        config.DATA_API_QUERY_ADDRESS = "http://localhost:10202/query"
+
+        self.temp_folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        config.DATA_API_QUERY_ADDRESS = self.data_api_query_address
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_folder.cleanup()
+
+    def get_request(self, parameters):
+        data_api_request = {"channels": [channel_data["channel"] for channel_data in self.json_data],
+                            "range": {"startPulseId": 5721143344, "endPulseId": 5721143362}}
+
+        return response_format.set_response_options(data_api_request, parameters)
+
+    def assert_data_equal(self, data):
+        self.assertEqual(len(data), len(self.json_data))
+
+        for channel_data, expected_channel_data in zip(data, self.json_data):
+            self.assertDictEqual(channel_data["channel"], expected_channel_data["channel"])
+            self.assertListEqual(channel_data["configs"], expected_channel_data["configs"])
+            self.assertEqual(len(channel_data["data"]), len(expected_channel_data["data"]))
+
+            dtype = response_format.BINARY_DTYPES[expected_channel_data["configs"][0]["type"]]
+
+            for data_point, expected_data_point in zip(channel_data["data"], expected_channel_data["data"]):
+                self.assertEqual(data_point["pulseId"], expected_data_point["pulseId"])
+                self.assertEqual(data_point["globalDate"], expected_data_point["globalDate"])
+                numpy.testing.assert_array_equal(numpy.asarray(data_point["value"], dtype=dtype),
+                                                 numpy.asarray(expected_data_point["value"], dtype=dtype))
+
+    def test_binary_response(self):
+        content = response_format.encode_binary_response(self.json_data)
+        self.assert_data_equal(response_format.decode_binary_response(content))
+
+        # Frames split across chunks.
+        chunks = [content[index:index + 100] for index in range(0, len(content), 100)]
+        self.assert_data_equal(list(response_format.iterate_binary_channels(chunks)))
+
+    def test_binary_response_columns(self):
+        content = response_format.encode_binary_response(self.json_data)
+
+        for channel_data in response_format.decode_binary_response(content):
+            data = channel_data["data"]
+
+            if not data:
+                continue
+
+            # No object is created per event, the values stay in the numpy arrays of the frames.
+            self.assertIsInstance(data, response_format.EventColumns)
+            self.assertEqual(data.pulse_ids.dtype, numpy.int64)
+
+            if channel_data["configs"][0]["type"] != "string":
+                self.assertIsInstance(data.values, numpy.ndarray)
+
+        # Sub-responses of split requests are merged as columns.
+        first_response = response_format.decode_binary_response(content)
+        second_response = response_format.decode_binary_response(content)
+        merged_response = utils.merge_data_api_responses([first_response, second_response])
+
+        self.assertIsInstance(merged_response[0]["data"], response_format.EventColumns)
+        self.assert_data_equal(merged_response)
+
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            response_format.decode_binary_response(content[:-1])
+
+    def test_query_formats(self):
+        compressions = ["none", "gzip"] + (["lz4"] if response_format.lz4 is not None else [])
+
+        for data_api_response_format in response_format.RESPONSE_FORMATS:
+            for compression in compressions:
+                data_api_request = self.get_request({"data_api_response_format": data_api_response_format,
+                                                     "data_api_response_compression": compression})
+
+                data, _ = get_data_from_buffer(data_api_request)
+                self.assert_data_equal(data)
+
+                self.assert_data_equal(list(stream_data_from_buffer(data_api_request)))
+
+    def test_channel_parts(self):
+
+        for data_api_response_format in response_format.RESPONSE_FORMATS:
+            data_api_request = self.get_request({"data_api_response_format": data_api_response_format})
+
+            self.assert_data_equal(self.merge_channel_parts(stream_data_from_buffer(data_api_request,
+                                                                                    channel_parts=True)))
+
+        # The sample has the data before the configs: the events are spooled until the configs are received.
+        for json_data in ([{"data": channel_data["data"], "channel": channel_data["channel"],
+                            "configs": channel_data["configs"]} for channel_data in self.json_data],
+                          [{"channel": channel_data["channel"], "configs": channel_data["configs"],
+                            "data": channel_data["data"]} for channel_data in self.json_data]):
+
+            content = json.dumps(json_data).encode()
+            chunks = [content[index:index + 100] for index in range(0, len(content), 100)]
+
+            with patch.object(config, "DATA_API_STREAM_SPOOL_SIZE", 1000):
+                channel_parts = list(utils.iterate_json_channel_parts(chunks))
+
+            self.assertTrue(all(len(channel_part["data"]) <= 1 for channel_part in channel_parts))
+            self.assert_data_equal(self.merge_channel_parts(channel_parts))
+
+        # Strings with escaped characters and brackets, split between chunks.
+        json_data = [{"data": [{"pulseId": 1, "value": 'a "[\\]" {b}'}], "channel": {"name": "STRING"},
+                      "configs": [{"type": "string", "shape": [1]}]}]
+        content = json.dumps(json_data).encode()
+
+        channel_parts = list(utils.iterate_json_channel_parts([content[index:index + 1]
+                                                               for index in range(len(content))]))
+        self.assertListEqual(channel_parts, json_data)
+
+    @staticmethod
+    def merge_channel_parts(channel_parts):
+        data = []
+
+        for channel_part in channel_parts:
+            if data and data[-1]["channel"] == channel_part["channel"]:
+                data[-1]["data"].extend(channel_part["data"])
+            else:
+                data.append(dict(channel_part, data=list(channel_part["data"])))
+
+        return data
+
+    def test_write_images_to_file(self):
+        with open(os.path.join(self.data_folder, "camera_image_sample.json")) as input_file:
+            json_data = json.load(input_file)
+
+        server = make_server("localhost", 10204, create_data_api_app(json_data), handler_class=QuietHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        output_file = os.path.join(self.temp_folder.name, "images.h5")
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_file": output_file}
+
+        pulse_ids = [data_point["pulseId"] for data_point in json_data[0]["data"]]
+        data_api_request = {"channels": [json_data[0]["channel"]],
+                            "range": {"startPulseId": pulse_ids[0], "endPulseId": pulse_ids[-1]}}
+
+        try:
+            with patch.multiple(config, IMAGE_DATA_API_QUERY_ADDRESS="http://localhost:10204/query",
+                                IMAGE_RETRIEVAL_NATIVE=True, TRANSFORM_PULSE_ID_TO_TIMESTAMP_QUERY=True), \
+                    patch.object(utils, "transform_range_from_pulse_id_to_timestamp",
+                                 side_effect=lambda request: request) as transform:
+
+                write_function, retrieved_request, _, _ = retrieve_request(data_api_request, parameters, 0)
+
+                # Only the pulse_id windows are transformed, when they are retrieved.
+                transform.assert_not_called()
+                self.assertDictEqual(retrieved_request["range"], data_api_request["range"])
+
+                write_function()
+                self.assertTrue(transform.called)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with h5py.File(output_file, "r") as file:
+            self.assertListEqual(file["data/SARES20-PROF142-M1:FPICTURE/pulse_id"][()].tolist(), pulse_ids)
+            self.assertListEqual(file["data/SARES20-PROF142-M1:FPICTURE/data"][-1].ravel().tolist(),
+                                 json_data[0]["data"][-1]["value"])
+
+    def test_invalid_options(self):
+        with self.assertRaisesRegex(ValueError, "data_api_response_format"):
+            response_format.get_response_options({"data_api_response_format": "csv"})
+
+        with self.assertRaisesRegex(ValueError, "data_api_response_compression"):
+            response_format.get_response_options({"data_api_response_compression": "bzip2"})
+
+    def test_write_binary_response(self):
+        output_files = {}
+
+        for data_api_response_format in response_format.RESPONSE_FORMATS:
+            output_file = os.path.join(self.temp_folder.name, "%s.h5" % data_api_response_format)
+            parameters = {"general/created": "test",
+                          "general/user": "tester",
+                          "general/process": "test_process",
+                          "general/instrument": "mac",
+                          "output_file": output_file,
+                          "data_api_response_format": data_api_response_format,
+                          "data_api_response_compression": "gzip"}
+
+            data, _ = get_data_from_buffer(self.get_request(parameters))
+            write_data_to_file(parameters, data)
+
+            output_files[data_api_response_format] = output_file
+
+        with h5py.File(output_files["json"], "r") as json_file, h5py.File(output_files["binary"], "r") as binary_file:
+
+            for channel_data in self.json_data:
+                name = channel_data["channel"]["name"]
+
+                if name not in json_file["data"]:
+                    self.assertNotIn(name, binary_file["data"])
+                    continue
+
+                for dataset_name in ("data", "pulse_id", "global_date", "is_data_present"):
+                    numpy.testing.assert_array_equal(binary_file["data"][name][dataset_name][:],
+                                                     json_file["data"][name][dataset_name][:])
@@ -0,0 +1,91 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+import bottle
+import requests
+
+from sf_databuffer_writer.rest_api import register_rest_interface, ThreadedWSGIRefServer
+
+
+class SlowRetrieveManager(object):
+    """
+    Manager with a retrieve that blocks until released.
+    """
+
+    def __init__(self):
+        self.release_retrieve = Event()
+        self.lock = Lock()
+        self.n_running = 0
+        self.max_running = 0
+
+    def get_status(self):
+        return "stopped"
+
+    def retrieve(self, request=None, remote_ip=None):
+        with self.lock:
+            self.n_running += 1
+            self.max_running = max(self.max_running, self.n_running)
+
+        self.release_retrieve.wait()
+
+        with self.lock:
+            self.n_running -= 1
+
+        return {"status": "ok", "message": str(request["run"])}
+
+
+class TestThreadedRestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SlowRetrieveManager()
+        self.retrieve_executor = ThreadPoolExecutor(max_workers=2)
+
+        app = bottle.Bottle()
+        register_rest_interface(app, self.manager, retrieve_executor=self.retrieve_executor)
+
+        self.server = ThreadedWSGIRefServer(host="localhost", port=10203, quiet=True)
+        Thread(target=bottle.run, kwargs={"app": app, "server": self.server, "quiet": True}, daemon=True).start()
+
+        for _ in range(50):
+            if hasattr(self.server, "srv"):
+                break
+            sleep(0.1)
+
+        self.url = "http://localhost:10203"
+
+    def tearDown(self):
+        self.manager.release_retrieve.set()
+        self.retrieve_executor.shutdown()
+
+        self.server.srv.shutdown()
+        self.server.srv.server_close()
+
+    def test_status_during_retrieve(self):
+        retrieve_responses = []
+
+        def retrieve(run):
+            response = requests.post(self.url + "/retrieve_from_buffers", json={"run": run}, timeout=10)
+            retrieve_responses.append(response.json())
+
+        retrieve_threads = [Thread(target=retrieve, args=(run,)) for run in range(3)]
+        for thread in retrieve_threads:
+            thread.start()
+
+        sleep(0.2)
+
+        # Lightweight endpoints are served while the retrieve requests are blocked.
+        start_time = time()
+        status = requests.get(self.url + "/status", timeout=5).json()
+        self.assertEqual(status["status"], "stopped")
+        self.assertLess(time() - start_time, 1)
+
+        self.manager.release_retrieve.set()
+        for thread in retrieve_threads:
+            thread.join()
+
+        self.assertListEqual(sorted(response["message"] for response in retrieve_responses), ["0", "1", "2"])
+
+        # Retrieve requests are limited by the retrieve executor.
+        self.assertEqual(self.manager.max_running, 2)
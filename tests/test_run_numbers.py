@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from sf_databuffer_writer.run_numbers import RunNumberAllocator
+
+
+def allocate_run_numbers(run_info_directory, n_runs):
+    allocator = RunNumberAllocator()
+    return [allocator.allocate(run_info_directory) for _ in range(n_runs)]
+
+
+class TestRunNumberAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.run_info_directory = self.temp_folder.name
+        self.last_run_file = os.path.join(self.run_info_directory, "LAST_RUN")
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def read_last_run(self):
+        with open(self.last_run_file) as input_file:
+            return int(input_file.read())
+
+    def test_allocate(self):
+        allocator = RunNumberAllocator()
+
+        self.assertEqual(allocator.allocate(self.run_info_directory), 1)
+        self.assertEqual(allocator.allocate(self.run_info_directory), 2)
+        self.assertEqual(self.read_last_run(), 2)
+
+        # Run numbers set by another process are respected.
+        with open(self.last_run_file, "w") as output_file:
+            output_file.write("41")
+
+        self.assertEqual(allocator.allocate(self.run_info_directory), 42)
+        self.assertEqual(self.read_last_run(), 42)
+
+    def test_batch_reservation(self):
+        allocator = RunNumberAllocator(batch_size=10)
+
+        self.assertListEqual([allocator.allocate(self.run_info_directory) for _ in range(12)], list(range(1, 13)))
+        self.assertEqual(self.read_last_run(), 20)
+
+        # Another allocator continues after the reserved numbers.
+        self.assertEqual(RunNumberAllocator().allocate(self.run_info_directory), 21)
+
+        with self.assertRaises(ValueError):
+            RunNumberAllocator(batch_size=0)
+
+    def test_concurrent_allocation(self):
+        allocators = [RunNumberAllocator(), RunNumberAllocator()]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            run_numbers = list(executor.map(lambda index: allocators[index % 2].allocate(self.run_info_directory),
+                                            range(40)))
+
+        with multiprocessing.Pool(2) as pool:
+            for process_run_numbers in pool.starmap(allocate_run_numbers, [(self.run_info_directory, 20)] * 2):
+                run_numbers.extend(process_run_numbers)
+
+        self.assertListEqual(sorted(run_numbers), list(range(1, 81)))
+        self.assertEqual(self.read_last_run(), 80)
@@ -0,0 +1,127 @@
+import json
+import os
+import tempfile
+import unittest
+from time import sleep
+from unittest.mock import patch
+
+from sf_databuffer_writer import config
+from sf_databuffer_writer.scan_info import ScanInfoStore, get_journal_filename
+
+
+class TestScanInfoStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_folder = tempfile.TemporaryDirectory()
+        self.scan_info_file = os.path.join(self.temp_folder.name, "scan_1.json")
+
+        self.request_scan_info = {"scan_name": "scan_1",
+                                  "motors_pv_name": ["SAROP21-MOTOR"],
+                                  "motors_name": ["motor"],
+                                  "motors_offset": [0],
+                                  "motors_coefficient": [1],
+                                  "motors_value": [1.5],
+                                  "motors_readback_value": [1.49],
+                                  "motors_readback_raw": [1490],
+                                  "step_info": {"step": 1}}
+
+    def tearDown(self):
+        self.temp_folder.cleanup()
+
+    def read_scan_info(self):
+        with open(self.scan_info_file) as input_file:
+            return json.load(input_file)
+
+    def get_expected_scan_info(self, n_steps):
+        return {"scan_files": [["run_%06d.BSREAD.h5" % step] for step in range(n_steps)],
+                "scan_parameters": {"Id": ["SAROP21-MOTOR"], "name": ["motor"], "offset": [0],
+                                    "conversion_factor": [1]},
+                "scan_readbacks": [[1.49]] * n_steps,
+                "scan_step_info": [{"step": 1}] * n_steps,
+                "scan_values": [[1.5]] * n_steps,
+                "scan_readbacks_raw": [[1490]] * n_steps,
+                "pulseIds": [[step * 100, step * 100 + 99] for step in range(n_steps)]}
+
+    def add_steps(self, store, first_step, n_steps):
+        for step in range(first_step, first_step + n_steps):
+            store.add_step(self.scan_info_file, self.request_scan_info, ["run_%06d.BSREAD.h5" % step],
+                           [step * 100, step * 100 + 99])
+
+    def test_materialize_every_step(self):
+        store = ScanInfoStore(materialize_delay=0)
+
+        self.add_steps(store, 0, 3)
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(3))
+
+        # scan_parameters, 3 steps and the first materialization.
+        with open(get_journal_filename(self.scan_info_file)) as input_file:
+            self.assertEqual(len(input_file.readlines()), 5)
+
+    def test_delayed_materialization(self):
+        store = ScanInfoStore(materialize_delay=60)
+
+        self.add_steps(store, 0, 3)
+        self.assertFalse(os.path.exists(self.scan_info_file))
+        self.assertDictEqual(store.get_scan_info(self.scan_info_file), self.get_expected_scan_info(3))
+
+        store.flush()
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(3))
+
+        # A restarted broker continues the scan from the journal.
+        self.add_steps(store, 3, 1)
+        store = ScanInfoStore(materialize_delay=0)
+
+        self.add_steps(store, 4, 1)
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(5))
+
+        self.assertIsNone(store.get_scan_info(os.path.join(self.temp_folder.name, "scan_2.json")))
+
+    def test_import_legacy_scan_info(self):
+        with open(self.scan_info_file, "w") as output_file:
+            json.dump(self.get_expected_scan_info(2), output_file, indent=4)
+
+        store = ScanInfoStore(materialize_delay=0, cache_size=1)
+        self.add_steps(store, 2, 2)
+
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(4))
+
+        # Evicted scans are reloaded from the journal.
+        other_scan_info_file = os.path.join(self.temp_folder.name, "scan_2.json")
+        store.add_step(other_scan_info_file, self.request_scan_info, [], [0, 1])
+
+        self.add_steps(store, 4, 1)
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(5))
+
+    def test_retry_failed_materialization(self):
+        store = ScanInfoStore(materialize_delay=0)
+
+        # The temporary scan_info file cannot be written over a folder.
+        os.mkdir(self.scan_info_file + ".tmp")
+
+        with patch.object(config, "SCAN_INFO_RETRY_INTERVAL", 0.1):
+            self.add_steps(store, 0, 2)
+
+            self.assertFalse(os.path.exists(self.scan_info_file))
+
+            os.rmdir(self.scan_info_file + ".tmp")
+            sleep(0.5)
+
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(2))
+
+    def test_reset_deleted_scan_info(self):
+        store = ScanInfoStore(materialize_delay=0)
+        self.add_steps(store, 0, 2)
+
+        os.remove(self.scan_info_file)
+        self.assertIsNone(store.get_scan_info(self.scan_info_file))
+
+        self.add_steps(store, 0, 1)
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(1))
+        self.assertTrue(os.path.exists(get_journal_filename(self.scan_info_file) + ".old"))
+
+        # A restarted broker also starts a new scan.
+        os.remove(self.scan_info_file)
+        store = ScanInfoStore(materialize_delay=0)
+
+        self.add_steps(store, 0, 2)
+        self.assertDictEqual(self.read_scan_info(), self.get_expected_scan_info(2))
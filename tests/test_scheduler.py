@@ -0,0 +1,80 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from time import time, sleep
+
+from sf_databuffer_writer.scheduler import DelayedScheduler
+
+
+class TestDelayedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.scheduler = DelayedScheduler(self.executor)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.executor.shutdown()
+
+    def test_dispatch_in_due_order(self):
+        dispatched = []
+        start_time = time()
+
+        futures = [self.scheduler.schedule(start_time + delay, dispatched.append, delay)
+                   for delay in (0.3, 0.1, 0.2, 0)]
+
+        # Scheduling should never wait for the due time.
+        self.assertLess(time() - start_time, 0.1)
+
+        for future in futures:
+            future.result(timeout=2)
+
+        self.assertListEqual(dispatched, [0, 0.1, 0.2, 0.3])
+        self.assertGreaterEqual(time() - start_time, 0.3)
+        self.assertEqual(self.scheduler.get_n_scheduled(), 0)
+
+    def test_later_request_does_not_wait_for_earlier(self):
+        start_time = time()
+
+        slow_future = self.scheduler.schedule(start_time + 1, lambda: "slow")
+        fast_future = self.scheduler.schedule(start_time, lambda: "fast")
+
+        self.assertEqual(fast_future.result(timeout=0.5), "fast")
+        self.assertFalse(slow_future.done())
+        self.assertEqual(self.scheduler.get_n_scheduled(), 1)
+
+        self.assertEqual(slow_future.result(timeout=2), "slow")
+
+    def test_exception_is_propagated(self):
+
+        def fail():
+            raise ValueError("failed")
+
+        future = self.scheduler.schedule(time(), fail)
+
+        with self.assertRaisesRegex(ValueError, "failed"):
+            future.result(timeout=1)
+
+    def test_schedule_after_stop(self):
+        self.scheduler.stop()
+
+        with self.assertRaises(RuntimeError):
+            self.scheduler.schedule(time(), sleep, 0)
+
+    def test_replace_broken_executor(self):
+        process_executor = ProcessPoolExecutor(max_workers=1)
+        scheduler = DelayedScheduler(process_executor, executor_factory=partial(ProcessPoolExecutor, max_workers=1))
+
+        try:
+            # The worker process dies, which breaks the process pool.
+            with self.assertRaises(BrokenProcessPool):
+                scheduler.schedule(time(), os._exit, 1).result(timeout=5)
+
+            self.assertEqual(scheduler.schedule(time(), abs, -1).result(timeout=5), 1)
+            self.assertIsNot(scheduler.executor, process_executor)
+
+        finally:
+            scheduler.stop()
+            scheduler.executor.shutdown()
@@ -1,7 +1,10 @@
 import json
 import unittest
 
-from sf_databuffer_writer.utils import get_separate_writer_requests
+import os
+
+from sf_databuffer_writer.utils import get_separate_writer_requests, iterate_json_array, split_data_api_request, \
+    merge_data_api_responses, filter_unwanted_pulse_ids
 
 
 class TestUtils(unittest.TestCase):
@@ -40,3 +43,85 @@ class TestUtils(unittest.TestCase):
                                  parameters["output_file"] + "_" + channels[0]["name"][:-9] + ".h5")
 
         self.assertTrue(bsread_channels_found)
+
+    def test_iterate_json_array(self):
+        data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
+
+        with open(os.path.join(data_folder, "dispatching_layer_sample.json"), "rb") as input_file:
+            raw_data = input_file.read()
+
+        json_data = json.loads(raw_data.decode())
+
+        for chunk_size in (1, 13, 4096, len(raw_data)):
+            chunks = [raw_data[i:i + chunk_size] for i in range(0, len(raw_data), chunk_size)]
+            self.assertListEqual(list(iterate_json_array(chunks)), json_data)
+
+        # Numbers split between chunks should not be decoded too early.
+        self.assertListEqual(list(iterate_json_array([b"[1, 2", b"3]"])), [1, 23])
+        self.assertListEqual(list(iterate_json_array([b"[1", b"5000000000.", b"0, true, 12345, null]"])),
+                             [15000000000.0, True, 12345, None])
+        self.assertListEqual(list(iterate_json_array([b"[1.5e", b"3, 2", b"E-2", b" ]"])), [1500.0, 0.02])
+        self.assertListEqual(list(iterate_json_array([b"[tr", b"ue,", b"-", b"7]"])), [True, -7])
+        self.assertListEqual(list(iterate_json_array([b" [ ] "])), [])
+
+        with self.assertRaisesRegex(ValueError, "Expected a JSON array"):
+            list(iterate_json_array([b'{"status": 500}']))
+
+        with self.assertRaisesRegex(ValueError, "Truncated JSON array"):
+            list(iterate_json_array([b'[{"channel": 1}']))
+
+    def test_split_and_merge_data_api_request(self):
+        data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
+
+        with open(os.path.join(data_folder, "dispatching_layer_sample.json")) as input_file:
+            json_data = json.load(input_file)
+
+        data_api_request = {"channels": [channel_data["channel"] for channel_data in json_data],
+                            "range": {"startPulseId": 5721143344, "endPulseId": 5721143416}}
+
+        sub_requests = split_data_api_request(data_api_request, pulse_id_window=30, channels_per_query=3)
+        # 7 channels in 3 groups, 73 pulses in 3 windows.
+        self.assertEqual(len(sub_requests), 9)
+        self.assertDictEqual(sub_requests[0]["range"], {"startPulseId": 5721143344, "endPulseId": 5721143373})
+        self.assertDictEqual(sub_requests[2]["range"], {"startPulseId": 5721143404, "endPulseId": 5721143416})
+        self.assertListEqual([channel["name"] for channel in sub_requests[-1]["channels"]],
+                             ["ARRAY_NO_DATA"])
+
+        # Simulate the data api answering each sub-request.
+        responses = []
+        for sub_request in sub_requests:
+            names = [channel["name"] for channel in sub_request["channels"]]
+            start_pulse_id = sub_request["range"]["startPulseId"]
+            end_pulse_id = sub_request["range"]["endPulseId"]
+
+            responses.append([{"channel": channel_data["channel"],
+                               "configs": channel_data["configs"],
+                               "data": [data_point for data_point in channel_data["data"]
+                                        if start_pulse_id <= data_point["pulseId"] <= end_pulse_id]}
+                              for channel_data in json_data if channel_data["channel"]["name"] in names])
+
+        self.assertListEqual(merge_data_api_responses(responses), json_data)
+
+        # Time ranges cannot be split by pulse_id.
+        data_api_request["range"] = {"startSeconds": 1, "endSeconds": 2}
+        self.assertEqual(len(split_data_api_request(data_api_request, pulse_id_window=30)), 1)
+
+    def test_filter_unwanted_pulse_ids(self):
+        data_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/")
+
+        with open(os.path.join(data_folder, "dispatching_layer_sample.json")) as input_file:
+            json_data = json.load(input_file)
+
+        # Sample pulse_ids go from 5721143344 to 5721143416 in steps of 4.
+        filter_unwanted_pulse_ids(json_data, 5721143350, 5721143400)
+
+        pulse_ids = [data_point["pulseId"] for data_point in json_data[0]["data"]]
+        self.assertListEqual(pulse_ids, list(range(5721143352, 5721143401, 4)))
+
+        # SCALAR_MISSING_DATA has only 5721143360 and 5721143380.
+        self.assertListEqual([data_point["pulseId"] for data_point in json_data[3]["data"]], [5721143360, 5721143380])
+
+        # Channels out of the range are left as they are.
+        filter_unwanted_pulse_ids(json_data, 5721143500, 5721143600)
+        self.assertEqual(len(json_data[0]["data"]), len(pulse_ids))
+
@@ -1,12 +1,17 @@
 import json
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 import os
 
 import h5py
+import numpy
 
 from sf_databuffer_writer import config
 from sf_databuffer_writer.writer import write_data_to_file
+from sf_databuffer_writer.writer_format import convert_global_dates_to_ns, DataBufferH5Writer, CompactDataBufferH5Writer, \
+    ImageDataBufferH5Writer
 
 
 class TestWriter(unittest.TestCase):
@@ -94,3 +99,391 @@ class TestWriter(unittest.TestCase):
 
         self.assertEqual(len(file["data/SARES20-PROF142-M1:FPICTURE/data"]), n_pulses)
         self.assertEqual(file["data/SARES20-PROF142-M1:FPICTURE/data"].shape, tuple([n_pulses] + [659, 494][::-1]))
+
+    def test_write_compressed_data(self):
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_file": self.TEST_OUTPUT_FILE,
+                      "output_file_format": "compact",
+                      "output_compression": "gzip",
+                      "output_chunking": 10}
+
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        n_pulses = len(json_data[0]["data"])
+
+        write_data_to_file(parameters, json_data)
+
+        file = h5py.File(TestWriter.TEST_OUTPUT_FILE)
+
+        array_dataset = file["data/SAROP21-CVME-PBPS2:Lnk9Ch6-DATA-CALIBRATED/data"]
+        self.assertEqual(array_dataset.shape, (n_pulses, 1024))
+        self.assertEqual(array_dataset.compression, "gzip")
+        self.assertEqual(array_dataset.chunks, (10, 1024))
+        self.assertListEqual(array_dataset[0].tolist(),
+                             numpy.array(json_data[0]["data"][0]["value"], dtype="float32").tolist())
+
+        # Empty datasets cannot be chunked.
+        self.assertIsNone(file["data/SCALAR_NO_DATA/data"].chunks)
+
+    def test_write_global_date_formats(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+
+        for output_file_format in (None, "compact"):
+            for global_date_format in ("fixed", "int64"):
+                parameters = {"general/created": "test",
+                              "general/user": "tester",
+                              "general/process": "test_process",
+                              "general/instrument": "mac",
+                              "output_file": self.TEST_OUTPUT_FILE,
+                              "output_file_format": output_file_format,
+                              "output_global_date_format": global_date_format}
+
+                with open(test_data_file, 'r') as input_file:
+                    json_data = json.load(input_file)
+
+                write_data_to_file(parameters, json_data)
+
+                with h5py.File(TestWriter.TEST_OUTPUT_FILE, "r") as file:
+                    global_date = file["data/SAROP21-CVME-PBPS2:Lnk9Ch6-DATA-MAX/global_date"]
+                    self.assertEqual(len(global_date), len(json_data[1]["data"]))
+                    self.assertIn("format", global_date.attrs)
+
+                    if global_date_format == "fixed":
+                        self.assertEqual(global_date[0].decode(), json_data[1]["data"][0]["globalDate"])
+                    else:
+                        # 2018-06-08T14:04:51.551143344+02:00
+                        self.assertEqual(global_date[0], 1528459491551143344)
+
+                    # Pulse ids without data have an empty date in the dense format.
+                    missing_global_date = file["data/SCALAR_MISSING_DATA/global_date"][()]
+                    self.assertEqual(len(missing_global_date), 19 if output_file_format is None else 2)
+
+    def test_convert_global_dates_to_ns(self):
+        timestamps = convert_global_dates_to_ns(["2018-06-08T14:04:51.551143344+02:00",
+                                                 "2018-06-08T12:04:51.551143345Z",
+                                                 "2018-06-08T07:34:51.551143346-04:30"])
+
+        self.assertEqual(timestamps.dtype, numpy.dtype("<i8"))
+        self.assertListEqual(timestamps.tolist(), [1528459491551143344, 1528459491551143345, 1528459491551143346])
+        self.assertEqual(len(convert_global_dates_to_ns([])), 0)
+
+    def test_write_sparse_layout(self):
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_file": self.TEST_OUTPUT_FILE,
+                      "output_file_format": "dense",
+                      "output_layout": "sparse",
+                      "output_chunking": 4}
+
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        n_pulses = len(json_data[0]["data"])
+
+        write_data_to_file(parameters, json_data)
+
+        file = h5py.File(TestWriter.TEST_OUTPUT_FILE)
+
+        array_dataset = file["data/SAROP21-CVME-PBPS2:Lnk9Ch6-DATA-CALIBRATED/data"]
+        self.assertEqual(array_dataset.shape, (n_pulses, 1024))
+        self.assertListEqual(array_dataset[-1].tolist(),
+                             numpy.array(json_data[0]["data"][-1]["value"], dtype="float32").tolist())
+
+        # SCALAR_MISSING_DATA has 2 data points, in the 2nd (pulse_ids 4 to 7) and 3rd (8 to 11) chunk.
+        missing_data = file["data/SCALAR_MISSING_DATA/data"]
+        self.assertEqual(missing_data.shape, (n_pulses, 1))
+        self.assertEqual(missing_data.id.get_num_chunks(), 2)
+        self.assertListEqual(numpy.flatnonzero(missing_data[:, 0]).tolist(), [4, 9])
+        self.assertListEqual(numpy.flatnonzero(file["data/SCALAR_MISSING_DATA/is_data_present"]).tolist(), [4, 9])
+        self.assertEqual(file["data/SCALAR_MISSING_DATA/global_date"][4].decode(),
+                         json_data[3]["data"][0]["globalDate"])
+
+        self.assertEqual(file["data/SCALAR_NO_DATA/data"].id.get_num_chunks(), 0)
+        self.assertEqual(len(file["data/SCALAR_NO_DATA/pulse_id"]), n_pulses)
+
+    def test_write_sparse_layout_duplicated_pulse_ids(self):
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_layout": "sparse",
+                      "output_chunking": 4}
+
+        json_data = [{"channel": {"name": "SCALAR"}, "configs": [{"type": "float64", "shape": [1]}],
+                      "data": [{"pulseId": pulse_id, "globalDate": "2018-01-01T00:00:00.000+01:00", "value": value}
+                               for pulse_id, value in ((0, 1), (1, 2), (1, 3), (2, 4), (3, 5), (5, 6), (4, 7))]}]
+
+        for output_layout in ("dense", "sparse"):
+            writer = DataBufferH5Writer(self.TEST_OUTPUT_FILE, dict(parameters, output_layout=output_layout))
+            writer.write_data(json_data)
+            writer.close()
+
+            # The last value of a duplicated pulse_id is written, and unsorted data is put in place.
+            with h5py.File(TestWriter.TEST_OUTPUT_FILE, "r") as file:
+                self.assertListEqual(file["data/SCALAR/pulse_id"][:].tolist(), [0, 1, 2, 3, 4, 5])
+                self.assertListEqual(file["data/SCALAR/data"][:, 0].tolist(), [1, 3, 4, 5, 7, 6])
+
+    def test_invalid_output_chunking(self):
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac"}
+
+        for output_chunking in (True, False, 0, -4, 2.5, "10", [10]):
+            with self.assertRaisesRegex(ValueError, "output_chunking"):
+                DataBufferH5Writer(self.TEST_OUTPUT_FILE, dict(parameters, output_chunking=output_chunking))
+
+        for output_chunking in (None, "auto", 10):
+            writer = DataBufferH5Writer(self.TEST_OUTPUT_FILE, dict(parameters, output_chunking=output_chunking))
+            writer.close()
+
+    def test_write_data_release_input(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+
+        for writer_class in (DataBufferH5Writer, CompactDataBufferH5Writer):
+            parameters = {"general/created": "test",
+                          "general/user": "tester",
+                          "general/process": "test_process",
+                          "general/instrument": "mac"}
+
+            with open(test_data_file, 'r') as input_file:
+                json_data = json.load(input_file)
+
+            expected_values = json_data[0]["data"][-1]["value"]
+
+            writer = writer_class(self.TEST_OUTPUT_FILE, parameters)
+            writer.write_data(json_data, release_input=True)
+            writer.close()
+
+            # All the channels were removed from the input while writing.
+            self.assertListEqual(json_data, [])
+
+            with h5py.File(TestWriter.TEST_OUTPUT_FILE, "r") as file:
+                self.assertListEqual(file["data/SAROP21-CVME-PBPS2:Lnk9Ch6-DATA-CALIBRATED/data"][-1].tolist(),
+                                     numpy.array(expected_values, dtype="float32").tolist())
+                self.assertIn("data/SCALAR_MISSING_DATA/data", file)
+
+    def test_write_data_to_file_interrupted_stream(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_file": self.TEST_OUTPUT_FILE}
+
+        def interrupted_stream():
+            yield json_data[0]
+            raise ValueError("Truncated JSON array received.")
+
+        writers = []
+
+        class RecordedWriter(CompactDataBufferH5Writer):
+            def __init__(self, *args):
+                super(RecordedWriter, self).__init__(*args)
+                writers.append(self)
+
+        with patch("sf_databuffer_writer.writer.CompactDataBufferH5Writer", RecordedWriter):
+            with self.assertRaisesRegex(ValueError, "Truncated"):
+                write_data_to_file(parameters, interrupted_stream())
+
+        # The partial file was closed.
+        self.assertFalse(writers[0].file)
+
+        with h5py.File(TestWriter.TEST_OUTPUT_FILE, "r") as file:
+            self.assertIn("data/" + json_data[0]["channel"]["name"] + "/data", file)
+
+    def test_write_data_in_processes(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_conversion_processes": 2}
+
+        writer = CompactDataBufferH5Writer(self.TEST_OUTPUT_FILE, parameters)
+        writer.write_data(json_data)
+        writer.close()
+
+        self.assert_compact_file(TestWriter.TEST_OUTPUT_FILE, json_data)
+
+    def test_write_data_in_processes_concurrently(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_conversion_processes": 2}
+
+        output_files = ["%s.%d" % (TestWriter.TEST_OUTPUT_FILE, index) for index in range(4)]
+
+        def write_file(output_file):
+            writer = CompactDataBufferH5Writer(output_file, parameters)
+            writer.write_data(json_data)
+            writer.close()
+
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for future in [executor.submit(write_file, output_file) for output_file in output_files]:
+                    future.result(timeout=60)
+
+            for output_file in output_files:
+                self.assert_compact_file(output_file, json_data)
+
+        finally:
+            for output_file in output_files:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "Shared memory blocks are not listed in /dev/shm.")
+    def test_write_data_in_processes_failure(self):
+        test_data_file = os.path.join(self.data_folder, "dispatching_layer_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac",
+                      "output_conversion_processes": 2}
+
+        writer = CompactDataBufferH5Writer(self.TEST_OUTPUT_FILE, parameters)
+
+        def fail_to_write(name, data):
+            raise RuntimeError("Disk full.")
+
+        writer._write_channel_datasets = fail_to_write
+
+        with self.assertRaises(RuntimeError):
+            writer.write_data(json_data)
+
+        writer.close()
+
+        block_prefix = "sfdb%x_" % os.getpid()
+        self.assertListEqual([name for name in os.listdir("/dev/shm") if name.startswith(block_prefix)], [])
+
+    def test_get_channel_columns(self):
+        writer = CompactDataBufferH5Writer(self.TEST_OUTPUT_FILE, {"output_file": self.TEST_OUTPUT_FILE})
+
+        def get_events(values):
+            return [{"pulseId": 100 + index, "value": value,
+                     "globalDate": "2018-06-08T14:04:51.%09d+02:00" % (100 + index)}
+                    for index, value in enumerate(values)]
+
+        # Converted in bulk.
+        bulk_cases = [("float32", [1], [0.5, -1.5, 2.5]),
+                      ("int32", [3], [[1, 2, 3], [4, 5, 6]]),
+                      ("uint16", [3, 2], [[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]]),
+                      ("float64", [3, 2], [[[1, 2], [3, 4], [5, 6]], [[7, 8], [9, 10], [11, 12]]])]
+
+        # Ragged values, converted one by one.
+        fallback_cases = [("float32", [1], [[0.5], -1.5, [2.5]]),
+                          ("int32", [3], [[1, 2, 3], [4], [5, 6, 7]])]
+
+        for channel_type, channel_shape, values in bulk_cases + fallback_cases:
+            dataset_type, _ = writer._get_dataset_definition(channel_type, channel_shape, len(values))
+
+            with patch("sf_databuffer_writer.writer_format._logger") as logger:
+                pulse_ids, dataset_values, global_dates = \
+                    writer._get_channel_columns(get_events(values), dataset_type, channel_shape)
+
+            # Only the ragged values are converted one by one.
+            self.assertEqual(logger.debug.called, (channel_type, channel_shape, values) in fallback_cases)
+
+            expected_pulse_ids, expected_values, expected_global_dates = \
+                self.convert_events_one_by_one(get_events(values), dataset_type, channel_shape)
+
+            self.assertEqual(dataset_values.dtype, expected_values.dtype)
+            self.assertEqual(dataset_values.shape, expected_values.shape)
+            self.assertListEqual(dataset_values.tolist(), expected_values.tolist())
+            self.assertListEqual(pulse_ids.tolist(), expected_pulse_ids.tolist())
+            self.assertListEqual(global_dates.tolist(), expected_global_dates.tolist())
+
+        writer.close()
+
+    @staticmethod
+    def convert_events_one_by_one(data, dataset_type, channel_shape):
+        # Conversion of the writer before the values were converted in bulk.
+        n_data_points = len(data)
+
+        values = numpy.zeros(dtype=dataset_type, shape=[n_data_points] + channel_shape[::-1])
+        pulse_ids = numpy.zeros(shape=(n_data_points,), dtype="<i8")
+        global_dates = numpy.zeros(shape=(n_data_points,), dtype=h5py.special_dtype(vlen=str))
+
+        for data_index, data_point in enumerate(data):
+            value = data_point["value"]
+
+            if len(channel_shape) > 1:
+                value = numpy.array(value, dtype=dataset_type).reshape(channel_shape[::-1])
+
+            values[data_index] = value
+            pulse_ids[data_index] = data_point["pulseId"]
+            global_dates[data_index] = data_point["globalDate"]
+
+        return pulse_ids, values, global_dates
+
+    def assert_compact_file(self, output_file, json_data):
+
+        with h5py.File(output_file, "r") as file:
+            for channel_data in json_data:
+                name = channel_data["channel"]["name"]
+
+                if not channel_data["data"]:
+                    continue
+
+                self.assertListEqual(file["data/" + name + "/pulse_id"][()].tolist(),
+                                     [data_point["pulseId"] for data_point in channel_data["data"]])
+                self.assertListEqual(file["data/" + name + "/global_date"].asstr()[()].tolist(),
+                                     [data_point["globalDate"] for data_point in channel_data["data"]])
+                self.assertEqual(file["data/" + name + "/data"][-1].tolist(),
+                                 numpy.array(channel_data["data"][-1]["value"], dtype="float32").reshape(-1).tolist())
+
+    def test_append_image_data(self):
+        parameters = {"general/created": "test",
+                      "general/user": "tester",
+                      "general/process": "test_process",
+                      "general/instrument": "mac"}
+
+        test_data_file = os.path.join(self.data_folder, "camera_image_sample.json")
+        with open(test_data_file, 'r') as input_file:
+            json_data = json.load(input_file)
+
+        channel_data = json_data[0]
+        expected_values = [data_point["value"] for data_point in channel_data["data"]]
+        expected_pulse_ids = [data_point["pulseId"] for data_point in channel_data["data"]]
+
+        writer = ImageDataBufferH5Writer(self.TEST_OUTPUT_FILE, parameters, n_expected_frames=2)
+
+        # Overlapping windows, the repeated frame is written only once.
+        for window in ((0, 1), (1, 3), (3, 3)):
+            writer.write_data([{"channel": channel_data["channel"],
+                                "configs": channel_data["configs"],
+                                "data": channel_data["data"][window[0]:window[1]]}])
+
+        self.assertEqual(writer.get_n_frames(), 3)
+        writer.close()
+
+        with h5py.File(TestWriter.TEST_OUTPUT_FILE, "r") as file:
+            data = file["data/SARES20-PROF142-M1:FPICTURE/data"]
+
+            self.assertEqual(data.shape, (3, 494, 659))
+            self.assertEqual(data.chunks, (1, 494, 659))
+            self.assertListEqual(data[2].ravel().tolist(), expected_values[2])
+            self.assertListEqual(file["data/SARES20-PROF142-M1:FPICTURE/pulse_id"][()].tolist(), expected_pulse_ids)
+            self.assertEqual(len(file["data/SARES20-PROF142-M1:FPICTURE/global_date"]), 3)
@@ -0,0 +1,147 @@
+import json
+import os
+import tempfile
+import unittest
+from threading import Event, Lock, Thread
+from time import sleep, time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sf_databuffer_writer import config, writer
+from sf_databuffer_writer.journal import RequestJournal
+
+
+class StopReceiving(Exception):
+    pass
+
+
+class FakeSource(object):
+    """
+    Request source of the broker, returning n_requests write requests and then stopping the writer once they are
+    processed.
+    """
+
+    def __init__(self, n_requests, requests_processed):
+        self.n_requests = n_requests
+        self.requests_processed = requests_processed
+        self.n_received = 0
+
+    def __call__(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def receive(self):
+        if self.n_received == self.n_requests:
+            self.requests_processed.wait(timeout=5)
+            raise StopReceiving()
+
+        self.n_received += 1
+
+        data = {"data_api_request": json.dumps({"range": {"startPulseId": self.n_received}}),
+                "parameters": json.dumps({"output_file": "run_%d.h5" % self.n_received}),
+                "timestamp": time()}
+
+        return SimpleNamespace(data=SimpleNamespace(data={name: SimpleNamespace(value=value)
+                                                          for name, value in data.items()}))
+
+
+class TestProcessRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.release_requests = Event()
+        self.requests_processed = Event()
+
+        self.lock = Lock()
+        self.n_processing = 0
+        self.max_processing = 0
+        self.processed_files = []
+        self.n_expected_requests = 5
+
+    def process_request(self, data_api_request, parameters, request_timestamp):
+
+        with self.lock:
+            self.n_processing += 1
+            self.max_processing = max(self.max_processing, self.n_processing)
+
+        self.release_requests.wait()
+
+        with self.lock:
+            self.n_processing -= 1
+            self.processed_files.append(parameters["output_file"])
+
+            if len(self.processed_files) == self.n_expected_requests:
+                self.requests_processed.set()
+
+        return True
+
+    def test_max_pending_requests(self):
+        request_source = FakeSource(n_requests=5, requests_processed=self.requests_processed)
+        errors = []
+
+        def process_requests():
+            try:
+                writer.process_requests("tcp://localhost:10100", data_retrieval_delay=0, n_workers=4,
+                                        worker_type="thread", max_pending_requests=2, pipeline_queue_length=0,
+                                        journal_file="")
+            except StopReceiving:
+                pass
+            except Exception as e:
+                errors.append(e)
+
+        with patch.object(writer, "source", request_source), \
+                patch.object(writer, "process_request", self.process_request):
+
+            writer_thread = Thread(target=process_requests, daemon=True)
+            writer_thread.start()
+            sleep(0.5)
+
+            # The writer does not receive more requests while max_pending_requests are being processed.
+            self.assertEqual(request_source.n_received, 2)
+            self.assertEqual(self.n_processing, 2)
+
+            self.release_requests.set()
+            writer_thread.join(timeout=5)
+
+        self.assertFalse(writer_thread.is_alive())
+        self.assertListEqual(errors, [])
+
+        self.assertEqual(request_source.n_received, 5)
+        self.assertEqual(self.max_processing, 2)
+        self.assertSetEqual(set(self.processed_files), {"run_%d.h5" % index for index in range(1, 6)})
+
+    def test_replay_journal(self):
+        temp_folder = tempfile.TemporaryDirectory()
+        journal_file = os.path.join(temp_folder.name, "writer_journal.jsonl")
+
+        journal = RequestJournal(journal_file)
+        crashing_id = journal.accept({}, {"output_file": os.path.join(temp_folder.name, "crashing.h5")}, time())
+        interrupted_id = journal.accept({}, {"output_file": os.path.join(temp_folder.name, "interrupted.h5")}, time())
+
+        # The writer stopped every time it processed the first request.
+        for _ in range(config.WRITER_JOURNAL_MAX_ATTEMPTS):
+            journal.started(crashing_id)
+
+        journal.started(interrupted_id)
+        journal.close()
+
+        self.release_requests.set()
+        self.n_expected_requests = 1
+
+        with patch.object(writer, "source", FakeSource(n_requests=0, requests_processed=self.requests_processed)), \
+                patch.object(writer, "process_request", self.process_request):
+
+            with self.assertRaises(StopReceiving):
+                writer.process_requests("tcp://localhost:10100", data_retrieval_delay=0, n_workers=1,
+                                        worker_type="thread", pipeline_queue_length=0, journal_file=journal_file)
+
+        # Only the interrupted request is replayed, the other one is given up and written to its .err file.
+        self.assertListEqual(self.processed_files, [os.path.join(temp_folder.name, "interrupted.h5")])
+        self.assertTrue(os.path.exists(os.path.join(temp_folder.name, "crashing.h5.err")))
+        self.assertListEqual(RequestJournal(journal_file).get_unfinished(), [])
+
+        temp_folder.cleanup()